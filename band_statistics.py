@@ -0,0 +1,223 @@
+"""
+Streaming, mergeable per-band statistics (count, mean, standard deviation, min/max, histogram).
+
+BandStatistics is updated with blocks of values (one row per pixel/sample, one column per band,
+NaN for values to ignore), using Welford/Chan updates of the mean and the sum of squared
+differences from the mean (M2), so values never need to be held in memory at once. Statistics
+computed separately (e.g. by parallel workers over different tiles) can be merged exactly, in
+any order, with merge().
+
+compute_statistics() makes one (optionally parallel) pass over many tiles. The band statistics
+files (e.g. cfis_band_statistics_train.csv) have one row per band, with "mean" and "std" columns;
+pixel_statistics_dataframe() gives the pixel-level version of such a file.
+
+Histograms have a fixed number of bins per band. Bin widths are powers of 2, and bins start at
+multiples of their width, so two histograms can always be aligned: when the range of values
+grows, pairs of adjacent bins are combined (the width doubles) until it fits. The final bins
+only depend on the range of all values seen, not on the order of updates and merges.
+"""
+import concurrent.futures
+import functools
+import os
+import numpy as np
+import pandas as pd
+
+NUM_HISTOGRAM_BINS = 256
+
+# Smallest bin width (2 ** MIN_BIN_EXPONENT), used when all values of a band are equal
+MIN_BIN_EXPONENT = -40
+
+
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    # Chan et al.'s parallel update of (count, mean, M2), for each band
+    count = count_a + count_b
+    fraction_b = np.divide(count_b, count, out=np.zeros(len(count)), where=(count > 0))
+    delta = mean_b - mean_a
+    mean = mean_a + delta * fraction_b
+    m2 = m2_a + m2_b + (delta ** 2) * count_a * fraction_b
+    return count, mean, m2
+
+
+def _bin_indices(values, exponent):
+    # Index of the (width 2 ** exponent) bin containing each value, on a grid starting at 0
+    return np.floor(np.ldexp(values, -exponent)).astype(np.int64)
+
+
+class BandStatistics(object):
+    def __init__(self, columns, num_bins=NUM_HISTOGRAM_BINS):
+        self.columns = list(columns)
+        num_bands = len(self.columns)
+        self.num_bins = num_bins
+        self.count = np.zeros(num_bands, dtype=np.int64)
+        self.mean = np.zeros(num_bands)
+        self.m2 = np.zeros(num_bands)
+        self.min = np.full(num_bands, np.inf)
+        self.max = np.full(num_bands, -np.inf)
+
+        # Band b's histogram has "num_bins" bins of width 2 ** bin_exponent[b], the first one
+        # starting at bin_start[b] * (2 ** bin_exponent[b])
+        self.bin_exponent = np.full(num_bands, MIN_BIN_EXPONENT, dtype=np.int64)
+        self.bin_start = np.zeros(num_bands, dtype=np.int64)
+        self.histograms = np.zeros((num_bands, num_bins), dtype=np.int64)
+
+    def update(self, values):
+        """
+        Adds a block of values, of shape (# samples x # bands). NaN values are ignored (so each
+        band can have a different number of values).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        assert values.ndim == 2 and values.shape[1] == len(self.columns)
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+        if not np.any(count > 0):
+            return
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(values, axis=0) / count
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        mean[count == 0] = 0
+        self._add(count, mean, m2, np.min(np.where(valid, values, np.inf), axis=0),
+                  np.max(np.where(valid, values, -np.inf), axis=0))
+
+        for band in np.nonzero(count > 0)[0]:
+            band_values = values[valid[:, band], band]
+            self._fit_histogram(band)
+            bins = _bin_indices(band_values, self.bin_exponent[band]) - self.bin_start[band]
+            self.histograms[band] += np.bincount(bins, minlength=self.num_bins)
+
+    def merge(self, other):
+        """Adds the values summarized by "other" (a BandStatistics with the same columns and bins)."""
+        assert self.columns == other.columns and self.num_bins == other.num_bins
+        self._add(other.count, other.mean, other.m2, other.min, other.max)
+        for band in np.nonzero(other.count > 0)[0]:
+            self._fit_histogram(band, other.bin_exponent[band])
+            exponent = self.bin_exponent[band]
+            occupied = other.histograms[band] > 0
+            other_bins = (other.bin_start[band] + np.nonzero(occupied)[0]) >> (exponent - other.bin_exponent[band])
+            np.add.at(self.histograms[band], other_bins - self.bin_start[band], other.histograms[band][occupied])
+
+    def _add(self, count, mean, m2, band_min, band_max):
+        # Histograms are updated separately; "_fit_histogram" relies on the new min/max
+        self.count, self.mean, self.m2 = _merge_moments(self.count, self.mean, self.m2, count, mean, m2)
+        self.min = np.minimum(self.min, band_min)
+        self.max = np.maximum(self.max, band_max)
+
+    def _fit_histogram(self, band, min_exponent=MIN_BIN_EXPONENT):
+        # Widens band's bins (combining adjacent pairs) until [min, max] fits in "num_bins" bins
+        old_exponent = self.bin_exponent[band]
+        exponent = max(old_exponent, min_exponent)
+        value_range = self.max[band] - self.min[band]
+        if value_range > 0:
+            exponent = max(exponent, int(np.ceil(np.log2(value_range / self.num_bins))))
+        while _bin_indices(self.max[band], exponent) - _bin_indices(self.min[band], exponent) >= self.num_bins:
+            exponent += 1
+        start = _bin_indices(self.min[band], exponent)
+        if exponent == old_exponent and start == self.bin_start[band]:
+            return
+        occupied = self.histograms[band] > 0
+        old_bins = (self.bin_start[band] + np.nonzero(occupied)[0]) >> (exponent - old_exponent)
+        histogram = np.zeros(self.num_bins, dtype=np.int64)
+        np.add.at(histogram, old_bins - start, self.histograms[band][occupied])
+        self.histograms[band] = histogram
+        self.bin_exponent[band] = exponent
+        self.bin_start[band] = start
+
+    def std(self, ddof=1):
+        """Standard deviation of each band (NaN for bands with at most "ddof" values)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / (self.count - ddof))
+
+    def histogram(self, band):
+        """Returns (counts, bin edges) of the histogram of "band" (a column name or index)."""
+        if not isinstance(band, (int, np.integer)):
+            band = self.columns.index(band)
+        edges = np.ldexp((self.bin_start[band] + np.arange(self.num_bins + 1)).astype(np.float64),
+                         self.bin_exponent[band])
+        return self.histograms[band], edges
+
+    def to_dataframe(self, ddof=1):
+        """Returns the statistics in the format of the band statistics files (one row per band)."""
+        return pd.DataFrame({'mean': self.mean, 'std': self.std(ddof)})
+
+    def write(self, csv_file, histogram_file=None, ddof=1):
+        """Writes the statistics to "csv_file", and optionally the histograms to "histogram_file" (see write_histograms)."""
+        self.to_dataframe(ddof).to_csv(csv_file, index=False)
+        if histogram_file is not None:
+            self.write_histograms(histogram_file)
+        print('Wrote band statistics', csv_file)
+
+    def write_histograms(self, histogram_file):
+        """Writes the histograms of each band, with the count/min/max of each band, to "histogram_file" (.npz)."""
+        edges = np.stack([self.histogram(band)[1] for band in range(len(self.columns))])
+        np.savez(histogram_file, columns=np.array(self.columns), counts=self.histograms, edges=edges,
+                 count=self.count, min=self.min, max=self.max)
+
+
+def histogram_file(statistics_file):
+    """Returns the name of the histogram file written next to the band statistics file "statistics_file"."""
+    return os.path.splitext(statistics_file)[0] + '_histograms.npz'
+
+
+def pixel_statistics_dataframe(pixel_statistics, means, stds):
+    """
+    Returns pixel-level statistics in the format of the band statistics files: the (tile-level)
+    "means", and the root mean squared deviation of the pixel values in "pixel_statistics" from
+    them, so that pixels standardized by these statistics are centered like the tiles. Bands with
+    no pixel values keep their std from "stds".
+    """
+    means = np.asarray(means, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pixel_stds = np.sqrt(pixel_statistics.m2 / pixel_statistics.count + (pixel_statistics.mean - means) ** 2)
+    return pd.DataFrame({'mean': means, 'std': np.where(pixel_statistics.count > 0, pixel_stds, stds)})
+
+
+def _chunk_statistics(read_values, columns, num_statistics, chunk):
+    # Summarizes the values read from each item of "chunk" (see compute_statistics)
+    statistics = [BandStatistics(columns) for _ in range(num_statistics)]
+    for item in chunk:
+        for item_statistics, values in zip(statistics, read_values(item)):
+            item_statistics.update(values)
+    return statistics
+
+
+def compute_statistics(items, read_values, columns, num_statistics=1, num_workers=1, items_per_chunk=200,
+                       mp_context=None):
+    """
+    Computes "num_statistics" BandStatistics (with the given columns) in one pass over "items"
+    (e.g. tile files or metadata rows). read_values(item) returns a tuple of "num_statistics" blocks
+    of values, one for each BandStatistics.
+
+    Items are summarized in chunks of "items_per_chunk". If num_workers > 1, chunks are summarized
+    by worker processes (started with "mp_context"), so "read_values" must be picklable, or the
+    workers forked. Returns the list of merged BandStatistics.
+    """
+    items = list(items)
+    chunks = [items[i:i+items_per_chunk] for i in range(0, len(items), items_per_chunk)]
+    summarize_chunk = functools.partial(_chunk_statistics, read_values, columns, num_statistics)
+    statistics = [BandStatistics(columns) for _ in range(num_statistics)]
+    if num_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp_context)
+        chunk_results = executor.map(summarize_chunk, chunks)
+    else:
+        executor = None
+        chunk_results = map(summarize_chunk, chunks)
+    for chunk_idx, chunk_statistics in enumerate(chunk_results):
+        for merged_statistics, summary in zip(statistics, chunk_statistics):
+            merged_statistics.merge(summary)
+        print('Processed', min((chunk_idx + 1) * items_per_chunk, len(items)), 'of', len(items), 'tiles')
+    if executor is not None:
+        executor.shutdown()
+    return statistics
+
+
+def cfis_pixel_values(tile, fine_sif, fine_sif_mask, fine_soundings, min_sif, min_soundings, missing_reflectance_idx=-1):
+    """
+    Returns the values (bands of "tile", then SIF) of two sets of pixels of a CFIS tile: the fine
+    CFIS train pixels (valid fine SIF of at least "min_sif", with at least "min_soundings"
+    soundings), and all non-cloudy pixels (with NaN SIF where it is invalid).
+    """
+    pixels = tile.reshape((tile.shape[0], -1)).T
+    valid_sif = ~fine_sif_mask.flatten()
+    sif = np.where(valid_sif, fine_sif.flatten(), np.nan)
+    selected = valid_sif & (fine_soundings.flatten() >= min_soundings) & (fine_sif.flatten() >= min_sif)
+    not_cloudy = (pixels[:, missing_reflectance_idx] == 0)
+    return np.column_stack((pixels[selected], sif[selected])), np.column_stack((pixels[not_cloudy], sif[not_cloudy]))
@@ -0,0 +1,86 @@
+"""
+Recomputes the band statistics of the CFIS train set in one (parallel) pass over its tiles. (The
+same pass is run at the end of create_cfis_grid.py; this script re-runs it on an existing
+dataset.) Writes two files:
+    cfis_band_statistics_train.csv:        statistics of the fine CFIS train pixels, i.e. the
+                                           rows of cfis_fine_metadata.csv used for training
+                                           (used to standardize inputs and SIF)
+    cfis_band_statistics_pixels_train.csv: pixel-level statistics of all non-cloudy pixels of the
+                                           train tiles (SIF over pixels with valid fine SIF),
+                                           around the means of the first file
+Each file has "mean" and "std" columns, with one row per column of STATISTICS_COLUMNS, and the
+histograms of each column are written next to it ("<name>_histograms.npz"). See band_statistics.py.
+
+Tiles are read from the tile shards (see create_tile_shards.py) if they exist and are not
+quantized, otherwise from the individual tile files.
+"""
+import multiprocessing
+import os
+
+import band_statistics
+import metadata_store
+import tile_storage
+
+DATA_DIR = "/mnt/beegfs/bulk/mirror/jyf6/datasets/SIF"
+METADATA_DIR = os.path.join(DATA_DIR, "metadata/CFIS_OCO2_dataset")
+CFIS_COARSE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_coarse_metadata.csv')
+BAND_STATISTICS_FILE = os.path.join(METADATA_DIR, 'cfis_band_statistics_train.csv')
+PIXEL_STATISTICS_FILE = os.path.join(METADATA_DIR, 'cfis_band_statistics_pixels_train.csv')
+SHARD_DIR = os.path.join(DATA_DIR, "tiles/shards_CFIS_OCO2")
+
+# Same filters as the fine CFIS train pixels in create_cfis_grid.py
+TRAIN_FOLDS = [0, 1, 2]  # 0-indexed
+MIN_SIF_CLIP = 0.1
+MIN_FINE_CFIS_SOUNDINGS_FILTER = 30
+MISSING_REFLECTANCE_IDX = -1
+
+# Columns to compute statistics for: the bands of the tile, then SIF
+STATISTICS_COLUMNS = ['ref_1', 'ref_2', 'ref_3', 'ref_4', 'ref_5', 'ref_6', 'ref_7',
+                      'ref_10', 'ref_11', 'Rainf_f_tavg', 'SWdown_f_tavg', 'Tair_f_tavg',
+                      'grassland_pasture', 'corn', 'soybean', 'shrubland',
+                      'deciduous_forest', 'evergreen_forest', 'spring_wheat',
+                      'developed_open_space', 'other_hay_non_alfalfa', 'winter_wheat',
+                      'herbaceous_wetlands', 'woody_wetlands', 'open_water', 'alfalfa',
+                      'fallow_idle_cropland', 'sorghum', 'developed_low_intensity',
+                      'barren', 'durum_wheat',
+                      'canola', 'sunflower', 'dry_beans', 'developed_med_intensity',
+                      'millet', 'sugarbeets', 'oats', 'mixed_forest', 'peas', 'barley',
+                      'lentils', 'missing_reflectance', 'SIF']
+NUM_WORKERS = 8
+TILES_PER_CHUNK = 200
+
+
+def read_pixel_values(row):
+    """Returns the (fine train pixel, non-cloudy pixel) values of the tile of metadata row "row"."""
+    if tile_store is not None:
+        fine_sif, fine_sif_mask, fine_soundings = tile_store.read_fine_sif(row['label_offset'])
+        tile = tile_store.read_tile(row['tile_offset'])
+    else:
+        fine_sif, fine_sif_mask, fine_soundings = tile_storage.load_fine_sif_labels(row['fine_sif_file'], row.get('fine_soundings_file'))
+        tile = tile_storage.load_tile(row['tile_file'])
+    return band_statistics.cfis_pixel_values(tile, fine_sif, fine_sif_mask, fine_soundings, MIN_SIF_CLIP,
+                                             MIN_FINE_CFIS_SOUNDINGS_FILTER, MISSING_REFLECTANCE_IDX)
+
+
+# Read train tiles
+cfis_metadata = metadata_store.read_metadata(CFIS_COARSE_METADATA_FILE, folds=TRAIN_FOLDS)
+print('Number of train tiles:', len(cfis_metadata))
+tile_store = None
+if (os.path.isfile(tile_storage.shard_index_file(SHARD_DIR, CFIS_COARSE_METADATA_FILE)) and
+        not os.path.isfile(tile_storage.shard_array_file(SHARD_DIR, 'continuous_scale'))):
+    tile_store = tile_storage.TileShardStore(SHARD_DIR)
+    cfis_metadata = tile_store.attach_offsets(cfis_metadata, CFIS_COARSE_METADATA_FILE)
+    print('Reading tiles from shards in', SHARD_DIR)
+
+# Summarize the tiles (in worker processes forked so that they share the globals above)
+fine_statistics, pixel_statistics = band_statistics.compute_statistics(
+    cfis_metadata.to_dict('records'), read_pixel_values, STATISTICS_COLUMNS, num_statistics=2,
+    num_workers=NUM_WORKERS, items_per_chunk=TILES_PER_CHUNK, mp_context=multiprocessing.get_context("fork"))
+
+print('Number of fine CFIS train pixels:', fine_statistics.count[-1])
+print("Band means", fine_statistics.mean)
+print("Band stds", fine_statistics.std())
+fine_statistics.write(BAND_STATISTICS_FILE, band_statistics.histogram_file(BAND_STATISTICS_FILE))
+band_statistics.pixel_statistics_dataframe(pixel_statistics, fine_statistics.mean, fine_statistics.std()).to_csv(PIXEL_STATISTICS_FILE, index=False)
+pixel_statistics.write_histograms(band_statistics.histogram_file(PIXEL_STATISTICS_FILE))
+print('Wrote pixel statistics', PIXEL_STATISTICS_FILE)
@@ -19,6 +19,7 @@ from sklearn.preprocessing import MinMaxScaler, StandardScaler
 from sklearn.tree import DecisionTreeRegressor
 
 from sif_utils import plot_histogram, print_stats
+import metadata_store
 
 # Set random seed
 np.random.seed(0)
@@ -54,34 +55,29 @@ BAND_STATISTICS_CSV_FILE = os.path.join(CFIS_DIR, 'cfis_band_statistics_train.cs
 
 
 # Read datasets
-cfis_fine_train_set = pd.read_csv(FINE_AVERAGES_TRAIN_FILE)
-cfis_fine_val_set = pd.read_csv(FINE_AVERAGES_VAL_FILE)
-cfis_fine_test_set = pd.read_csv(FINE_AVERAGES_TEST_FILE)
-cfis_coarse_train_set = pd.read_csv(COARSE_AVERAGES_TRAIN_FILE)
-cfis_coarse_val_set = pd.read_csv(COARSE_AVERAGES_VAL_FILE)
-cfis_coarse_test_set = pd.read_csv(COARSE_AVERAGES_TEST_FILE)
-oco2_train_set = pd.read_csv(OCO2_METADATA_TRAIN_FILE)
-oco2_val_set = pd.read_csv(OCO2_METADATA_VAL_FILE)
-oco2_test_set = pd.read_csv(OCO2_METADATA_TEST_FILE)
-
-# Only include CFIS tiles with enough valid pixels
-cfis_coarse_train_set = cfis_coarse_train_set[(cfis_coarse_train_set['fraction_valid'] >= MIN_COARSE_FRACTION_VALID_PIXELS) &
-                                              (cfis_coarse_train_set['SIF'] >= MIN_SIF_CLIP)]
-cfis_coarse_val_set = cfis_coarse_val_set[(cfis_coarse_val_set['fraction_valid'] >= MIN_COARSE_FRACTION_VALID_PIXELS) &
-                                          (cfis_coarse_val_set['SIF'] >= MIN_SIF_CLIP)]
-cfis_coarse_test_set = cfis_coarse_test_set[(cfis_coarse_test_set['fraction_valid'] >= MIN_COARSE_FRACTION_VALID_PIXELS) &
-                                            (cfis_coarse_test_set['SIF'] >= MIN_SIF_CLIP)]
-
-# Filter OCO2 sets
-oco2_train_set = oco2_train_set[(oco2_train_set['num_soundings'] >= MIN_OCO2_SOUNDINGS) &
-                                (oco2_train_set['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
+cfis_fine_train_set = metadata_store.read_metadata(FINE_AVERAGES_TRAIN_FILE)
+cfis_fine_val_set = metadata_store.read_metadata(FINE_AVERAGES_VAL_FILE)
+cfis_fine_test_set = metadata_store.read_metadata(FINE_AVERAGES_TEST_FILE)
+cfis_coarse_train_set = metadata_store.read_metadata(COARSE_AVERAGES_TRAIN_FILE, min_fraction_valid=MIN_COARSE_FRACTION_VALID_PIXELS)
+cfis_coarse_val_set = metadata_store.read_metadata(COARSE_AVERAGES_VAL_FILE, min_fraction_valid=MIN_COARSE_FRACTION_VALID_PIXELS)
+cfis_coarse_test_set = metadata_store.read_metadata(COARSE_AVERAGES_TEST_FILE, min_fraction_valid=MIN_COARSE_FRACTION_VALID_PIXELS)
+oco2_train_set = metadata_store.read_metadata(OCO2_METADATA_TRAIN_FILE, min_num_soundings=MIN_OCO2_SOUNDINGS)
+oco2_val_set = metadata_store.read_metadata(OCO2_METADATA_VAL_FILE, min_num_soundings=MIN_OCO2_SOUNDINGS)
+oco2_test_set = metadata_store.read_metadata(OCO2_METADATA_TEST_FILE, min_num_soundings=MIN_OCO2_SOUNDINGS)
+
+# Only include CFIS tiles with enough valid pixels (already applied by read_metadata), and with
+# SIF above the clip value
+cfis_coarse_train_set = cfis_coarse_train_set[cfis_coarse_train_set['SIF'] >= MIN_SIF_CLIP]
+cfis_coarse_val_set = cfis_coarse_val_set[cfis_coarse_val_set['SIF'] >= MIN_SIF_CLIP]
+cfis_coarse_test_set = cfis_coarse_test_set[cfis_coarse_test_set['SIF'] >= MIN_SIF_CLIP]
+
+# Filter OCO2 sets (the minimum number of soundings was applied by read_metadata)
+oco2_train_set = oco2_train_set[(oco2_train_set['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
                                 (oco2_train_set['SIF'] >= MIN_SIF_CLIP)]
-oco2_val_set = oco2_val_set[(oco2_val_set['num_soundings'] >= MIN_OCO2_SOUNDINGS) &
-                            (oco2_val_set['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
+oco2_val_set = oco2_val_set[(oco2_val_set['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
                             (oco2_val_set['SIF'] >= MIN_SIF_CLIP)]
-oco2_test_set = oco2_test_set[(oco2_test_set['num_soundings'] >= MIN_OCO2_SOUNDINGS) &
-                            (oco2_test_set['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
-                            (oco2_test_set['SIF'] >= MIN_SIF_CLIP)]
+oco2_test_set = oco2_test_set[(oco2_test_set['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
+                              (oco2_test_set['SIF'] >= MIN_SIF_CLIP)]
 
 cfis_coarse_train_set = cfis_coarse_train_set.sample(frac=1).reset_index(drop=True)
 oco2_train_set = oco2_train_set.sample(frac=1).reset_index(drop=True)
@@ -0,0 +1,41 @@
+"""
+One-time conversion of old fine SIF files (pickled masked arrays, written with
+MaskedArray.dump) into the fine SIF label format in tile_storage.py. Each file is converted
+in place (so the metadata files don't need to change); files that were already converted
+are skipped. If the metadata file has a manifest (see tile_manifest.py), the entries of the
+converted files are updated.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+import tile_manifest
+import tile_storage
+
+DATA_DIR = "/mnt/beegfs/bulk/mirror/jyf6/datasets/SIF"
+METADATA_DIR = os.path.join(DATA_DIR, "metadata/CFIS_OCO2_dataset")
+CFIS_COARSE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_coarse_metadata.csv')
+
+cfis_coarse_metadata = pd.read_csv(CFIS_COARSE_METADATA_FILE)
+if 'fine_soundings_file' not in cfis_coarse_metadata.columns:
+    print('Fine SIF files of', CFIS_COARSE_METADATA_FILE, 'were written in the label format; nothing to convert')
+    exit(0)
+manifest_writer = tile_manifest.ManifestWriter('convert_fine_sif_labels')
+num_converted = 0
+for fine_sif_file, fine_soundings_file in zip(cfis_coarse_metadata['fine_sif_file'], cfis_coarse_metadata['fine_soundings_file']):
+    if not tile_storage.is_pickled_fine_sif_file(fine_sif_file):
+        continue
+    fine_sif, fine_sif_mask, fine_soundings = tile_storage.load_fine_sif_labels(fine_sif_file, fine_soundings_file)
+    labels = tile_storage.pack_fine_sif_labels(fine_sif, fine_sif_mask, fine_soundings)
+
+    # Write to a temporary file first, so that an interrupted run never leaves a truncated label file
+    temp_file = fine_sif_file + '.tmp.npy'
+    np.save(temp_file, labels)
+    os.replace(temp_file, fine_sif_file)
+    manifest_writer.add(fine_sif_file)
+    num_converted += 1
+
+print('Converted', num_converted, 'of', len(cfis_coarse_metadata), 'fine SIF files')
+manifest_filename = tile_manifest.manifest_file(CFIS_COARSE_METADATA_FILE)
+if num_converted > 0 and os.path.isfile(manifest_filename):
+    manifest_writer.write(manifest_filename, append=True)
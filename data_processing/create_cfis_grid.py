@@ -1,8 +1,8 @@
 """
 Creates tiles of CFIS SIF pixels from raw CFIS point measurements. 
 """
-import csv
 import math
+import multiprocessing
 import os
 import random
 import matplotlib.pyplot as plt
@@ -11,7 +11,12 @@ import pandas as pd
 import xarray as xr
 
 import visualization_utils
+import band_statistics
+import incremental_build
 import sif_utils
+import metadata_store
+import tile_manifest
+import tile_storage
 
 # Set random seed
 RANDOM_STATE = 1
@@ -28,6 +33,7 @@ OCO2_FILES = [os.path.join(RAW_OCO2_DIR, "oco2_20160615_20160629_3km.nc"),
               os.path.join(RAW_OCO2_DIR, "oco2_20160801_20160816_3km.nc")]
 
 MIN_SOUNDINGS_FINE = 1
+CFIS_CHUNK_SIZE = 1000000  # Number of CFIS soundings to grid at a time
 MIN_FRACTION_VALID_PIXELS = 0.1  # Max fraction of invalid pixels when computing coarse-resolution SIF
 MIN_CDL_COVERAGE = 0.5  # Exclude areas where there is no CDL coverage (e.g. Canada)
 CDL_INDICES = list(range(12, 42))
@@ -64,27 +70,24 @@ BAND_AVERAGE_COLUMNS = ['fold', 'grid_fold', 'lon', 'lat', 'date', 'tile_file',
                         'millet', 'sugarbeets', 'oats', 'mixed_forest', 'peas', 'barley',
                         'lentils', 'missing_reflectance', 'SIF', 'num_soundings']
 FINE_CFIS_AVERAGE_COLUMNS = BAND_AVERAGE_COLUMNS + ['coarse_sif']
-COARSE_CFIS_AVERAGE_COLUMNS = BAND_AVERAGE_COLUMNS + ['fraction_valid', 'fine_sif_file', 'fine_soundings_file']
+COARSE_CFIS_AVERAGE_COLUMNS = BAND_AVERAGE_COLUMNS + ['fraction_valid', 'fine_sif_file']
 
 # CFIS coarse/fine averages
 CFIS_FINE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_fine_metadata.csv')
-cfis_fine_metadata = []
+cfis_fine_metadata_writer = metadata_store.MetadataWriter(CFIS_FINE_METADATA_FILE, FINE_CFIS_AVERAGE_COLUMNS)
 CFIS_COARSE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_coarse_metadata.csv')
 cfis_coarse_metadata = []
 
-# Columns to compute statistics for
-STATISTICS_COLUMNS = ['ref_1', 'ref_2', 'ref_3', 'ref_4', 'ref_5', 'ref_6', 'ref_7',
-                      'ref_10', 'ref_11', 'Rainf_f_tavg', 'SWdown_f_tavg', 'Tair_f_tavg',
-                      'grassland_pasture', 'corn', 'soybean', 'shrubland',
-                      'deciduous_forest', 'evergreen_forest', 'spring_wheat',
-                      'developed_open_space', 'other_hay_non_alfalfa', 'winter_wheat',
-                      'herbaceous_wetlands', 'woody_wetlands', 'open_water', 'alfalfa',
-                      'fallow_idle_cropland', 'sorghum', 'developed_low_intensity',
-                      'barren', 'durum_wheat',
-                      'canola', 'sunflower', 'dry_beans', 'developed_med_intensity',
-                      'millet', 'sugarbeets', 'oats', 'mixed_forest', 'peas', 'barley',
-                      'lentils', 'missing_reflectance', 'SIF']
+# Band statistics of the train set (see band_statistics.py): statistics of the fine CFIS train
+# pixels (used for standardization), and pixel-level statistics of all non-cloudy train pixels.
+# Columns are the bands, then SIF.
+STATISTICS_COLUMNS = BAND_AVERAGE_COLUMNS[6:-1]
 BAND_STATISTICS_FILE = os.path.join(METADATA_DIR, 'cfis_band_statistics_train.csv')
+PIXEL_STATISTICS_FILE = os.path.join(METADATA_DIR, 'cfis_band_statistics_pixels_train.csv')
+STATISTICS_WORKERS = 8
+
+# Records every tile/label file written (see tile_manifest.py)
+manifest_writer = tile_manifest.ManifestWriter('create_cfis_grid')
 
 # Lat/lon bounds. Note: *region indices* refer to the pixel index relative to the
 # top left corner (TOP_BOUND, LEFT_BOUND). (0, 0) is the top-left pixel, and
@@ -101,6 +104,20 @@ REFLECTANCE_PIXELS = 371
 INPUT_CHANNELS = 43
 MISSING_REFLECTANCE_IDX = -1
 
+# Memory budget for reflectance tiles kept in memory when extracting input tiles (dense
+# reflectance tiles are about 24 MB)
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+
+# True to only rebuild the tiles whose inputs (reflectance tiles and SIF labels) changed since the
+# last run (see incremental_build.py). Tiles that are not rebuilt keep their previous metadata rows,
+# including their fold.
+INCREMENTAL = False
+BUILD_STATE_FILE = os.path.join(METADATA_DIR, 'cfis_grid_build_state.json')
+build_state = incremental_build.BuildState(BUILD_STATE_FILE)
+
+# Settings that affect every output tile
+BUILD_PARAMS = [RES, TILE_SIZE_PIXELS, MIN_SOUNDINGS_FINE, MIN_FRACTION_VALID_PIXELS, MIN_CDL_COVERAGE]
+
 # Divide the region into 0.5x0.5 degree large grid areas. Split them between folds.
 GRID_AREA_DEGREES = 0.2
 num_lat_squares = int((50-38) / GRID_AREA_DEGREES)
@@ -152,6 +169,7 @@ for date_idx, DATE in enumerate(DATES):
     # Data directories for this date
     MONTH = MONTHS[date_idx]
     INPUT_TILES_DIR = os.path.join(DATA_DIR, "tiles/tiles_" + DATE)
+    REFLECTANCE_MOSAIC_DIR = os.path.join(DATA_DIR, "tiles/reflectance_mosaic_" + DATE)
     OUTPUT_TILES_DIR = os.path.join(DATA_DIR, "tiles/cfis_tiles_" + DATE)
     if not os.path.exists(OUTPUT_TILES_DIR):
         os.makedirs(OUTPUT_TILES_DIR)
@@ -159,70 +177,42 @@ for date_idx, DATE in enumerate(DATES):
     # Output tile prefixes. TODO turn to relative path!
     INPUT_TILE_PREFIX = os.path.join(OUTPUT_TILES_DIR, 'input_tile_')
     FINE_SIF_PREFIX = os.path.join(OUTPUT_TILES_DIR, 'fine_sif_')
-    FINE_SOUNDINGS_PREFIX = os.path.join(OUTPUT_TILES_DIR, 'fine_soundings_')
+
+    # If a reflectance mosaic was built for this date (data_processing/create_reflectance_mosaic.py),
+    # read each tile's input data as a window of the mosaic. Otherwise, extract it from the
+    # reflectance tiles.
+    reflectance_mosaic = None
+    if os.path.exists(os.path.join(REFLECTANCE_MOSAIC_DIR, tile_storage.MOSAIC_INFO_FILE)):
+        reflectance_mosaic = tile_storage.ReflectanceMosaic(REFLECTANCE_MOSAIC_DIR)
+        if (reflectance_mosaic.info['top_bound'], reflectance_mosaic.info['left_bound']) != (TOP_BOUND, LEFT_BOUND) or \
+                tuple(reflectance_mosaic.info['res']) != RES:
+            print('Reflectance mosaic', REFLECTANCE_MOSAIC_DIR, 'does not use the same region indices; rebuild it')
+            exit(1)
 
     # Maps from *region indices* of the upper/left corner of each output tile to:
     # sum SIF, avg SIF, number of soundings
     tile_to_sum_cfis_sif_array = dict()
     tile_to_avg_cfis_sif_array = dict()
     tile_to_cfis_soundings_array = dict()
-    tile_to_oco2_sif = dict()
-    tile_to_oco2_soundings = dict()
 
     # Read CFIS data
-    lons = np.load(os.path.join(RAW_CFIS_DIR, "lons_" + MONTH + ".npy"), allow_pickle=True)
-    lats = np.load(os.path.join(RAW_CFIS_DIR, "lats_" + MONTH + ".npy"), allow_pickle=True)
-    sifs = np.load(os.path.join(RAW_CFIS_DIR, "dcsif_" + MONTH + ".npy"), allow_pickle=True)
+    lons = sif_utils.load_sounding_array(os.path.join(RAW_CFIS_DIR, "lons_" + MONTH + ".npy"))
+    lats = sif_utils.load_sounding_array(os.path.join(RAW_CFIS_DIR, "lats_" + MONTH + ".npy"))
+    sifs = sif_utils.load_sounding_array(os.path.join(RAW_CFIS_DIR, "dcsif_" + MONTH + ".npy"))
     print('Lons shape', lons.shape)
     print('Lats shape', lats.shape)
     print('Sifs shape', sifs.shape)
 
-    # Loop through all CFIS soundings. The arrays in "tile_to_sum_cfis_sif_array" will store the SUM
-    # of all SIF soundings per pixel. Then we will divide by the number of soundings (computed in
-    # "tile_to_cfis_soundings_array") to get the AVERAGE.
-    for i in range(lons.shape[0]):
-        if lats[i] < BOTTOM_BOUND or lats[i] > TOP_BOUND or lons[i] < LEFT_BOUND or \
-                                     lons[i] > RIGHT_BOUND:
-            # print('Sounding was outside region of interest! lat', lats[i], 'lon', lons[i])
-            continue
-
-        # Find the *region indices* (relative to the (top, left) corner of the entire region)
-        # that the sounding falls in.
-        lat_idx, lon_idx = sif_utils.lat_long_to_index(lats[i], lons[i], TOP_BOUND, LEFT_BOUND, RES)
-        if (lat_idx < OCO2_LAT_OFFSET or lon_idx < OCO2_LON_OFFSET):
-            print('Attention - point outside OCO2 grid: lat', lats[i], 'lon', lons[i])
-            continue
-
-        # We're breaking the region into large tiles of size "TILE_SIZE_PIXELS", but with the upper-left
-        # corner of the grid being at (OCO2_LAT_OFFSET, OCO2_LON_OFFSET).
-        # For example, if OCO2_LAT_OFFSET is 3 and TILE_SIZE_PIXELS is 100, the latitude grid lines are at
-        # indices (3, 103, 203, 303, etc.) This code computes the upper-left corner of the grid square
-        # containing the sounding at (lat_idx, lon_idx)
-        tile_indices = (sif_utils.round_down(lat_idx - OCO2_LAT_OFFSET, TILE_SIZE_PIXELS) + OCO2_LAT_OFFSET,
-                        sif_utils.round_down(lon_idx - OCO2_LON_OFFSET, TILE_SIZE_PIXELS) + OCO2_LON_OFFSET)
-
-        # If this SIF tile is not yet in "tile_to_sum_cfis_sif_array", add it. Otherwise, extract
-        # the SIF tile.
-        if tile_indices not in tile_to_sum_cfis_sif_array:
-            tile_sum_sifs = np.zeros([TILE_SIZE_PIXELS, TILE_SIZE_PIXELS])
-            tile_soundings = np.zeros([TILE_SIZE_PIXELS, TILE_SIZE_PIXELS])
-        else:
-            tile_sum_sifs = tile_to_sum_cfis_sif_array[tile_indices]
-            tile_soundings = tile_to_cfis_soundings_array[tile_indices]
-
-        # Get the index of the current pixel within this SIF tile
-        within_tile_lat_idx = lat_idx - tile_indices[0]
-        within_tile_lon_idx = lon_idx - tile_indices[1]
-
-        # Add this sounding's SIF to the sum of SIFs for this pixel
-        tile_sum_sifs[within_tile_lat_idx, within_tile_lon_idx] += sifs[i]
-
-        # Increment sounding count for this pixel
-        tile_soundings[within_tile_lat_idx, within_tile_lon_idx] += 1
-
-        # Store the SIF tile and sounding counts
-        tile_to_sum_cfis_sif_array[tile_indices] = tile_sum_sifs
-        tile_to_cfis_soundings_array[tile_indices] = tile_soundings
+    # Grid all CFIS soundings (in chunks of CFIS_CHUNK_SIZE). The arrays in "tile_to_sum_cfis_sif_array"
+    # will store the SUM of all SIF soundings per pixel. Then we will divide by the number of soundings
+    # (computed in "tile_to_cfis_soundings_array") to get the AVERAGE.
+    # We're breaking the region into large tiles of size "TILE_SIZE_PIXELS", but with the upper-left
+    # corner of the grid being at (OCO2_LAT_OFFSET, OCO2_LON_OFFSET).
+    # For example, if OCO2_LAT_OFFSET is 3 and TILE_SIZE_PIXELS is 100, the latitude grid lines are at
+    # indices (3, 103, 203, 303, etc.)
+    sif_utils.grid_soundings(lats, lons, sifs, (TOP_BOUND, BOTTOM_BOUND, LEFT_BOUND, RIGHT_BOUND), RES, TILE_SIZE_PIXELS,
+                             tile_to_sum_cfis_sif_array, tile_to_cfis_soundings_array,
+                             grid_offset=(OCO2_LAT_OFFSET, OCO2_LON_OFFSET), chunk_size=CFIS_CHUNK_SIZE)
 
 
     # Now, compute the average CFIS SIF for each fine pixel
@@ -252,45 +242,61 @@ for date_idx, DATE in enumerate(DATES):
             grid_squares_with_cfis.add(grid_square_upper_left)
 
 
-    # Loop through all OCO-2 grid squares
-    for oco2_lon_idx in range(len(oco2_lons)):
-        for oco2_lat_idx in range(len(oco2_lats)):
-            oco2_sif = oco2_sifs[oco2_lat_idx, oco2_lon_idx, 0]
-            oco2_num_soundings_point = oco2_num_soundings[oco2_lat_idx, oco2_lon_idx, 0]
-
-            # Ignore grid squares where there is no SIF data
-            if math.isnan(oco2_sif):
-                continue
-
-            # Find lon/lat of the OCO-2 tile's top-left corner 
-            oco2_left_lon = oco2_lons[oco2_lon_idx] - TILE_SIZE_DEGREES / 2
-            oco2_top_lat = oco2_lats[oco2_lat_idx] + TILE_SIZE_DEGREES / 2    
-
-            # # Compute the lat/lon grid square this OCO-2 tile is in. Again this computation is based
-            # # on the upper-left corner of the tile. If it overlaps with a CFIS region, skip this tile.
-            # grid_square = sif_utils.get_large_grid_area_coordinates_lat_first(oco2_top_lat, oco2_left_lon, GRID_AREA_DEGREES)
-            # if grid_square in grid_squares_with_cfis:
-            #     print('Grid square', grid_square, 'had CFIS data!!!!!')
-            #     # continue
-            # else:
-                # print('Grid square', grid_square, 'has no CFIS data :)')
-            # print('=============================')
-
-            # Compute *region indices* of the top-left corner
-            lat_idx, lon_idx = sif_utils.lat_long_to_index(oco2_top_lat, oco2_left_lon, TOP_BOUND, LEFT_BOUND, RES)
-
-            # Record OCO-2 SIF / num soundings in dictionary
-            tile_indices = (lat_idx, lon_idx)
-            tile_to_oco2_sif[tile_indices] = oco2_sif * OCO2_SCALING_FACTOR
-            tile_to_oco2_soundings[tile_indices] = oco2_num_soundings_point
-
-
-    # For each CFIS and/or OCO2 SIF tile, extract reflectance/crop cover data.
-    all_tile_indices = tile_to_avg_cfis_sif_array.keys() | tile_to_oco2_sif.keys()  # Union ("OR") of CFIS/OCO-2 tiles
-    print('CFIS tile indices', len(tile_to_avg_cfis_sif_array))
-    print('OCO2 tile indices', len(tile_to_oco2_sif))
+    # Find all OCO-2 grid squares with SIF data (in the order of a loop over lons, then lats)
+    oco2_lon_indices, oco2_lat_indices = np.nonzero(~np.isnan(oco2_sifs[:, :, 0].T))
+    oco2_sif_points = oco2_sifs[oco2_lat_indices, oco2_lon_indices, 0]
+    oco2_soundings_points = oco2_num_soundings[oco2_lat_indices, oco2_lon_indices, 0]
+
+    # Find lon/lat of each OCO-2 tile's top-left corner, and compute its *region indices*
+    oco2_left_lons = oco2_lons[oco2_lon_indices] - TILE_SIZE_DEGREES / 2
+    oco2_top_lats = oco2_lats[oco2_lat_indices] + TILE_SIZE_DEGREES / 2
+    oco2_lat_region_indices, oco2_lon_region_indices = sif_utils.lat_long_to_indices(oco2_top_lats, oco2_left_lons, TOP_BOUND, LEFT_BOUND, RES)
+
+    oco2_tile_indices = np.stack((oco2_lat_region_indices, oco2_lon_region_indices), axis=1)
+    oco2_tile_sifs = oco2_sif_points * OCO2_SCALING_FACTOR
+
+    # Union ("OR") of CFIS/OCO-2 tiles, as a sorted array of tile indices. Tile indices are
+    # encoded as single integers (in lat-major order), so the union is a merge of sorted arrays.
+    cfis_tile_indices = np.array(list(tile_to_avg_cfis_sif_array.keys()), dtype=np.int64).reshape((-1, 2))
+    candidate_tile_indices = np.concatenate((cfis_tile_indices, oco2_tile_indices))
+    min_tile_indices = candidate_tile_indices.min(axis=0, initial=0)
+    key_stride = candidate_tile_indices[:, 1].max(initial=0) - min_tile_indices[1] + 1
+    def tile_keys(tile_indices):
+        return (tile_indices[:, 0] - min_tile_indices[0]) * key_stride + (tile_indices[:, 1] - min_tile_indices[1])
+
+    # If several OCO-2 grid squares map to the same tile, the last one (in the order above) is kept
+    oco2_keys = tile_keys(oco2_tile_indices)
+    unique_oco2_keys, last_reversed_positions = np.unique(oco2_keys[::-1], return_index=True)
+    oco2_rows = len(oco2_keys) - 1 - last_reversed_positions
+    oco2_tile_sifs, oco2_soundings_points = oco2_tile_sifs[oco2_rows], oco2_soundings_points[oco2_rows]
+    all_tile_keys = np.union1d(tile_keys(cfis_tile_indices), unique_oco2_keys)
+    all_tile_indices = np.stack((all_tile_keys // key_stride + min_tile_indices[0],
+                                 all_tile_keys % key_stride + min_tile_indices[1]), axis=1)
+
+    # Row of each tile in the (deduplicated) OCO-2 arrays, or -1 if the tile has no OCO-2 data
+    tile_oco2_rows = np.searchsorted(unique_oco2_keys, all_tile_keys)
+    has_oco2 = (tile_oco2_rows < len(unique_oco2_keys))
+    has_oco2[has_oco2] = (unique_oco2_keys[tile_oco2_rows[has_oco2]] == all_tile_keys[has_oco2])
+    tile_oco2_rows[~has_oco2] = -1
+    print('CFIS tile indices', len(cfis_tile_indices))
+    print('OCO2 tile indices', len(unique_oco2_keys))
     print('All tile indices', len(all_tile_indices))
-    for tile_indices in all_tile_indices:
+
+    # Draw each tile's random fold up front (indexed by the tile's position in the sorted
+    # "all_tile_keys"), so that the folds don't depend on the order in which tiles are visited below.
+    tile_random_folds = np.random.randint(NUM_FOLDS, size=len(all_tile_keys))
+
+    # Visit tiles grouped by the reflectance tile containing their top-left corner (as
+    # create_reflectance_mosaic.py does), so that neighbouring tiles, which read the same
+    # reflectance tiles, are extracted one after the other.
+    tile_max_lats = TOP_BOUND - (all_tile_indices[:, 0] * RES[0])
+    tile_min_lons = LEFT_BOUND + (all_tile_indices[:, 1] * RES[1])
+    visit_order = np.lexsort((all_tile_indices[:, 1], all_tile_indices[:, 0],
+                              np.floor(tile_min_lons * 10), -np.ceil(tile_max_lats * 10)))
+    load_reflectance_tile = tile_storage.TileCache(TILE_CACHE_BYTES)
+    for tile_idx in visit_order:
+        tile_indices = (int(all_tile_indices[tile_idx, 0]), int(all_tile_indices[tile_idx, 1]))
+        oco2_row = tile_oco2_rows[tile_idx]
 
         # From region indices, compute lat/lon bounds on this tile
         tile_max_lat = TOP_BOUND - (tile_indices[0] * RES[0])
@@ -299,7 +305,7 @@ for date_idx, DATE in enumerate(DATES):
         tile_max_lon = tile_min_lon + (TILE_SIZE_PIXELS * RES[1])
 
         # Compute which 1x1-degree grid square the tile is in, and what fold it is in
-        random_fold_number = random.randint(0, NUM_FOLDS - 1)
+        random_fold_number = int(tile_random_folds[tile_idx])
         grid_square = sif_utils.get_large_grid_area_coordinates_lat_first(tile_max_lat, tile_min_lon, GRID_AREA_DEGREES)
         if grid_square not in large_grid_areas:
             print('Large grid areas:', large_grid_areas)
@@ -307,18 +313,41 @@ for date_idx, DATE in enumerate(DATES):
             exit(1)
         grid_fold_number = large_grid_areas[grid_square]
 
-        # Extract input data for this region from files
-        input_tile = sif_utils.extract_input_subtile(tile_min_lon, tile_max_lon, tile_min_lat, tile_max_lat,
-                                                     INPUT_TILES_DIR, TILE_SIZE_PIXELS, RES)
-        if input_tile is None:
-            print('No input tiles found')
-            continue
-
         # Tile description
         tile_center_lat = round((tile_min_lat + tile_max_lat) / 2, 5)
         tile_center_lon = round((tile_min_lon + tile_max_lon) / 2, 5)
         tile_description = 'lat_' + str(tile_center_lat) + '_lon_' + str(tile_center_lon) + '_' + DATE
 
+        # Skip tiles that were built before from the same reflectance tiles and SIF labels (inputs
+        # are only hashed for incremental builds, since hashing reads every reflectance tile)
+        tile_inputs_hash = None
+        if INCREMENTAL:
+            reflectance_files = [tile_storage.find_tile_file(name) or name + tile_storage.PACKED_TILE_EXTENSION
+                                 for column in sif_utils.reflectance_tile_names(tile_min_lon, tile_max_lon, tile_min_lat, tile_max_lat, INPUT_TILES_DIR)
+                                 for name in column]
+            label_params = [None, None]
+            if oco2_row >= 0:
+                label_params = [oco2_tile_sifs[oco2_row], oco2_soundings_points[oco2_row]]
+            if tile_indices in tile_to_avg_cfis_sif_array:
+                label_params += [tile_to_avg_cfis_sif_array[tile_indices].data,
+                                 np.ma.getmaskarray(tile_to_avg_cfis_sif_array[tile_indices]),
+                                 tile_to_cfis_soundings_array[tile_indices]]
+            tile_inputs_hash = build_state.inputs_hash(reflectance_files, params=label_params + BUILD_PARAMS)
+            if not build_state.needs_build(tile_description, tile_inputs_hash):
+                continue
+        tile_outputs = build_state.start_unit(tile_description, tile_inputs_hash)
+
+        # Extract input data for this region from files
+        if reflectance_mosaic is not None:
+            input_tile = reflectance_mosaic.read_window(tile_indices[0], tile_indices[1], TILE_SIZE_PIXELS, TILE_SIZE_PIXELS)
+        else:
+            input_tile = sif_utils.extract_input_subtile(tile_min_lon, tile_max_lon, tile_min_lat, tile_max_lat,
+                                                         INPUT_TILES_DIR, TILE_SIZE_PIXELS, RES,
+                                                         tile_loader=load_reflectance_tile)
+        if input_tile is None:
+            print('No input tiles found')
+            continue
+
         # Check CDL coverage
         cdl_coverage = np.mean(np.sum(input_tile[CDL_INDICES, :, :], axis=0))
         assert cdl_coverage >= 0 and cdl_coverage <= 1
@@ -326,18 +355,20 @@ for date_idx, DATE in enumerate(DATES):
             print('CDL coverage too low', tile_description)
             continue
 
-        # Save input data to file
-        input_tile_filename = INPUT_TILE_PREFIX + tile_description + '.npy'
-        np.save(input_tile_filename, input_tile)
+        # Save input data to file (in packed format)
+        input_tile_filename = INPUT_TILE_PREFIX + tile_description + tile_storage.PACKED_TILE_EXTENSION
+        tile_storage.save_packed_tile(input_tile_filename, input_tile)
+        manifest_writer.add(input_tile_filename)
+        tile_outputs.append(input_tile_filename)
 
         # Tile should definitely not be in both OCO-2 and CFIS
-        # assert not (tile_indices in tile_to_oco2_sif and tile_indices in tile_to_avg_cfis_sif_array)
+        # assert not (oco2_row >= 0 and tile_indices in tile_to_avg_cfis_sif_array)
 
         # If there is OCO-2 data for this tile, get OCO-2 SIF and number of soundings
-        if tile_indices in tile_to_oco2_sif:
-            oco2_sif = tile_to_oco2_sif[tile_indices]
-            oco2_soundings = tile_to_oco2_soundings[tile_indices]
-            average_input_features = sif_utils.compute_band_averages(input_tile, input_tile[MISSING_REFLECTANCE_IDX])
+        if oco2_row >= 0:
+            oco2_sif = oco2_tile_sifs[oco2_row]
+            oco2_soundings = oco2_soundings_points[oco2_row]
+            average_input_features = sif_utils.compute_block_band_averages(input_tile, input_tile[MISSING_REFLECTANCE_IDX], input_tile.shape[1:])[:, 0, 0]
             oco2_tile_metadata = [random_fold_number, grid_fold_number, tile_center_lon, tile_center_lat, DATE, input_tile_filename] + \
                                   average_input_features.tolist() + [oco2_sif, oco2_soundings]
             oco2_metadata.append(oco2_tile_metadata)
@@ -361,15 +392,14 @@ for date_idx, DATE in enumerate(DATES):
             # and total number of soundings for this subregion
             tile_sif = fine_sif_array.mean()
             tile_soundings = fine_soundings_array.sum()
-            average_input_features = sif_utils.compute_band_averages(input_tile, fine_sif_array.mask)
+            average_input_features = sif_utils.compute_block_band_averages(input_tile, fine_sif_array.mask, input_tile.shape[1:])[:, 0, 0]
 
-            # Fine SIF/soundings file names to output to
+            # Write fine SIF labels (SIF, invalid mask and soundings) to a file. (Old datasets also
+            # have a "fine_soundings_file" column, which is only needed for old, pickled fine SIF files.)
             fine_sif_filename = FINE_SIF_PREFIX + tile_description + '.npy'
-            fine_soundings_filename = FINE_SOUNDINGS_PREFIX + tile_description + '.npy'
-
-            # Write fine SIF tile and fine soundings tile to files
-            fine_sif_array.dump(fine_sif_filename)
-            np.save(fine_soundings_filename, fine_soundings_array)
+            tile_storage.save_fine_sif_labels(fine_sif_filename, fine_sif_array, fine_soundings_array)
+            manifest_writer.add(fine_sif_filename)
+            tile_outputs.append(fine_sif_filename)
 
             # Plot tile
             # cdl_utils.plot_tile(input_tile, coarse_sif_array_masked, fine_sif_array, center_lon, center_lat, TILE_SIZE_DEGREES, tile_description)
@@ -377,39 +407,49 @@ for date_idx, DATE in enumerate(DATES):
             # Create row: reflectance/crop cover tile, fine SIF, coarse SIF.
             tile_metadata = [random_fold_number, grid_fold_number, tile_center_lon, tile_center_lat, DATE, input_tile_filename] + \
                             average_input_features.tolist() + \
-                            [tile_sif, tile_soundings, fraction_valid, fine_sif_filename, fine_soundings_filename]
-
-            # For each *valid* fine-resolution SIF pixel, extract features, and add to dataset.
-            fine_sif_points = []
-            pixel_sif_sum = 0
-            for i in range(fine_sif_array.shape[0]):
-                for j in range(fine_sif_array.shape[1]):
-                    # Exclude pixels where SIF is invalid
-                    if fine_sif_array.mask[i, j]:
-                        continue
-                    input_features = input_tile[:, i, j]
-                    if input_features[MISSING_REFLECTANCE_IDX] == 1:
-                        print('BUG!! SIF was not marked invalid, even though the Landsat pixel is cloudy')
-                        exit(1)
-                    pixel_lat = tile_max_lat - RES[0] * i
-                    pixel_lon = tile_min_lon + RES[1] * j
-                    pixel_sif = fine_sif_array[i, j]
-                    pixel_sif_sum += pixel_sif
-                    pixel_soundings = fine_soundings_array[i, j]
-                    assert pixel_soundings >= MIN_SOUNDINGS_FINE
-                    fine_sif_points.append([random_fold_number, grid_fold_number, pixel_lon, pixel_lat, DATE, input_tile_filename] + input_features.tolist() + [pixel_sif, pixel_soundings, tile_sif])
+                            [tile_sif, tile_soundings, fraction_valid, fine_sif_filename]
+
+            # For each *valid* fine-resolution SIF pixel, extract features, and add to dataset
+            # (in row-major order).
+            valid_i, valid_j = np.nonzero(~fine_sif_array.mask)
+            input_features = input_tile[:, valid_i, valid_j].T.astype(np.float64)
+            if np.any(input_features[:, MISSING_REFLECTANCE_IDX] == 1):
+                print('BUG!! SIF was not marked invalid, even though the Landsat pixel is cloudy')
+                exit(1)
+            pixel_soundings = fine_soundings_array[valid_i, valid_j]
+            assert np.all(pixel_soundings >= MIN_SOUNDINGS_FINE)
+            fine_sif_points = {'fold': random_fold_number, 'grid_fold': grid_fold_number,
+                               'lon': tile_min_lon + RES[1] * valid_j, 'lat': tile_max_lat - RES[0] * valid_i,
+                               'date': DATE, 'tile_file': input_tile_filename,
+                               'SIF': fine_sif_array.data[valid_i, valid_j], 'num_soundings': pixel_soundings,
+                               'coarse_sif': tile_sif}
+            for band_idx, column in enumerate(BAND_AVERAGE_COLUMNS[6:-2]):
+                fine_sif_points[column] = input_features[:, band_idx]
 
             cfis_coarse_metadata.append(tile_metadata)
-            cfis_fine_metadata.extend(fine_sif_points)
+            cfis_fine_metadata_writer.append(fine_sif_points)
+    load_reflectance_tile.print_stats()
 
 
-# Construct DataFrames
+# Construct DataFrames. If INCREMENTAL, keep the previous rows of tiles that were not rebuilt.
 oco2_metadata_df = pd.DataFrame(oco2_metadata, columns=BAND_AVERAGE_COLUMNS)
-oco2_metadata_df.to_csv(OCO2_METADATA_FILE)
-cfis_fine_metadata_df = pd.DataFrame(cfis_fine_metadata, columns=FINE_CFIS_AVERAGE_COLUMNS)
-cfis_fine_metadata_df.to_csv(CFIS_FINE_METADATA_FILE)
+cfis_fine_metadata_df = cfis_fine_metadata_writer.to_dataframe()
 cfis_coarse_metadata_df = pd.DataFrame(cfis_coarse_metadata, columns=COARSE_CFIS_AVERAGE_COLUMNS)
-cfis_coarse_metadata_df.to_csv(CFIS_COARSE_METADATA_FILE)
+if INCREMENTAL:
+    oco2_metadata_df = build_state.merge_metadata(incremental_build.read_previous_metadata(OCO2_METADATA_FILE, index_col=0), oco2_metadata_df)
+    cfis_fine_metadata_df = build_state.merge_metadata(incremental_build.read_previous_metadata(CFIS_FINE_METADATA_FILE, index_col=0), cfis_fine_metadata_df)
+    cfis_coarse_metadata_df = build_state.merge_metadata(incremental_build.read_previous_metadata(CFIS_COARSE_METADATA_FILE, index_col=0), cfis_coarse_metadata_df)
+metadata_store.write_metadata(oco2_metadata_df, OCO2_METADATA_FILE)
+metadata_store.write_metadata(cfis_fine_metadata_df, CFIS_FINE_METADATA_FILE)
+metadata_store.write_metadata(cfis_coarse_metadata_df, CFIS_COARSE_METADATA_FILE)
+build_state.save()
+
+# Write manifests of the files referenced by each metadata file
+manifest_writer.write(tile_manifest.manifest_file(OCO2_METADATA_FILE), oco2_metadata_df['tile_file'], append=INCREMENTAL)
+manifest_writer.write(tile_manifest.manifest_file(CFIS_FINE_METADATA_FILE), cfis_fine_metadata_df['tile_file'], append=INCREMENTAL)
+manifest_writer.write(tile_manifest.manifest_file(CFIS_COARSE_METADATA_FILE),
+                      np.concatenate([cfis_coarse_metadata_df['tile_file'].values, cfis_coarse_metadata_df['fine_sif_file'].values]),
+                      append=INCREMENTAL)
 
 print('Number of OCO-2 SIF points:', len(oco2_metadata_df))
 print('OCO2 by random fold:', oco2_metadata_df['fold'].value_counts())
@@ -440,23 +480,22 @@ print('Number of fine CFIS SIF points:', len(cfis_fine_metadata_df))
 # coarse_averages_val_df.to_csv(COARSE_AVERAGES_VAL_FILE)
 # coarse_averages_test_df.to_csv(COARSE_AVERAGES_TEST_FILE)
 
-# Compute averages for each band
-fine_averages_train_df = cfis_fine_metadata_df[(cfis_fine_metadata_df['fold'].isin(TRAIN_FOLDS)) &
-                                               (cfis_fine_metadata_df['SIF'] >= MIN_SIF_CLIP) &
-                                               (cfis_fine_metadata_df['tile_file'].isin(set(cfis_coarse_metadata_df['tile_file']))) &
-                                               (cfis_fine_metadata_df['num_soundings'] >= MIN_FINE_CFIS_SOUNDINGS_FILTER)]
-selected_columns = fine_averages_train_df[STATISTICS_COLUMNS]
-print("Band values ARRAY shape", selected_columns.shape)
-band_means = selected_columns.mean(axis=0)
-band_stds = selected_columns.std(axis=0)
-print("Band means", band_means)
-print("Band stds", band_stds)
-
-# Write band averages to file
-statistics_rows = [['mean', 'std']]
-for i, mean in enumerate(band_means):
-    statistics_rows.append([band_means[i], band_stds[i]])
-with open(BAND_STATISTICS_FILE, 'w') as output_csv_file:
-    csv_writer = csv.writer(output_csv_file, delimiter=",", quoting=csv.QUOTE_MINIMAL)
-    for row in statistics_rows:
-        csv_writer.writerow(row)
+# Compute the band statistics of the train set, in one pass over the train tiles (in worker
+# processes forked so that they share the globals above). compute_band_statistics.py re-runs this
+# pass on an existing dataset.
+def read_pixel_values(row):
+    fine_sif, fine_sif_mask, fine_soundings = tile_storage.load_fine_sif_labels(row['fine_sif_file'], row.get('fine_soundings_file'))
+    return band_statistics.cfis_pixel_values(tile_storage.load_tile(row['tile_file']), fine_sif, fine_sif_mask, fine_soundings,
+                                             MIN_SIF_CLIP, MIN_FINE_CFIS_SOUNDINGS_FILTER, MISSING_REFLECTANCE_IDX)
+
+cfis_coarse_metadata_train_df = cfis_coarse_metadata_df[cfis_coarse_metadata_df['fold'].isin(TRAIN_FOLDS)]
+fine_statistics, pixel_statistics = band_statistics.compute_statistics(
+    cfis_coarse_metadata_train_df.to_dict('records'), read_pixel_values, STATISTICS_COLUMNS, num_statistics=2,
+    num_workers=STATISTICS_WORKERS, mp_context=multiprocessing.get_context("fork"))
+print('Number of fine CFIS train pixels:', fine_statistics.count[-1])
+print("Band means", fine_statistics.mean)
+print("Band stds", fine_statistics.std())
+fine_statistics.write(BAND_STATISTICS_FILE, band_statistics.histogram_file(BAND_STATISTICS_FILE))
+band_statistics.pixel_statistics_dataframe(pixel_statistics, fine_statistics.mean, fine_statistics.std()).to_csv(PIXEL_STATISTICS_FILE, index=False)
+pixel_statistics.write_histograms(band_statistics.histogram_file(PIXEL_STATISTICS_FILE))
+print('Wrote pixel statistics', PIXEL_STATISTICS_FILE)
@@ -1,10 +1,12 @@
 """
 Outputs a dataset mapping large tiles to TROPOMI SIF.
-Each row in the dataset contains a filename of an .npy file. The ``tile_file'' field contains the
+Each row in the dataset contains a filename of an .npz file. The ``tile_file'' field contains the
 name of a file, which stores a tensor of shape (band x lat x long); each band is either a 
-reflectance band, a FLDAS band, a mask of a specific crop cover type.
+reflectance band, a FLDAS band, a mask of a specific crop cover type. Tiles are stored in the
+packed format from tile_storage.py (use tile_storage.load_tile to read them).
 Each row also contains the latitude and longitude of that tile, as well as the total SIF of the tile.
 """
+import concurrent.futures
 import csv
 import math
 import os
@@ -20,7 +22,10 @@ from rasterio.plot import show
 from rasterio.warp import Resampling, calculate_default_transform, reproject
 
 from sif_utils import lat_long_to_index, plot_histogram
+import incremental_build
 import sif_utils
+import tile_manifest
+import tile_storage
 
 # Plot corn pixels and print the most frequent crop types (sorted by percentage)
 # "covers" should be a 2-D array of pixels, with a single integer at each pixel representin the crop type (according
@@ -70,6 +75,9 @@ SIF_TILE_COLUMNS = IMAGE_COLUMNS + ['SIF', 'tropomi_cloud_fraction', 'num_soundi
 # for what these numbers correspond to). I included all cover types that are >1% of the region.
 COVERS_TO_MASK = [176, 1, 5, 152, 141, 142, 23, 121, 37, 24, 195, 190, 111, 36, 61, 4, 122, 131, 22, 31, 6, 42, 123, 29, 41, 28, 143, 53, 21, 52]  # [176, 152, 1, 5, 141, 142, 23, 121, 37, 190, 195, 111, 36, 24, 61, 0]
 
+# Lookup table from CDL code to cover class (see tile_storage.py)
+COVER_CLASS_TABLE = tile_storage.cover_class_table(COVERS_TO_MASK)
+
 SIF_TILE_DEGREE_SIZE = 0.1  # Size of output tiles, in degrees
 IMAGE_DEGREE_SIZE = 1
 FLOAT_EQUALITY_TOLERANCE = 1e-10
@@ -80,6 +88,14 @@ MAX_MISSING_REFLECTANCE = 0.8
 # True if you want to append to the output csv file, False to overwrite
 APPEND = False
 
+# Number of processes to extract tiles with (each processes one reflectance file at a time).
+# The output is the same whatever the number of processes.
+NUM_WORKERS = 1
+
+# True to only process the reflectance files whose inputs (reflectance, cover, FLDAS and SIF files)
+# changed since the last run, keeping the other rows of the output csv file (see incremental_build.py)
+INCREMENTAL = False
+
 # # Date ranges of Landsat data
 # DATE_RANGES = [pd.date_range(start="2018-06-10", end="2018-06-23"),
 #                pd.date_range(start="2018-07-08", end="2018-07-21"),
@@ -102,378 +118,499 @@ DATE_RANGES = [pd.date_range(start="2016-06-15", end="2016-06-29"),
                pd.date_range(start="2016-08-01", end="2016-08-16")]
 
 
-for DATE_RANGE in DATE_RANGES:
-    start_date = DATE_RANGE.date[0]
-    start_date_string = str(start_date)
-    middle_date = DATE_RANGE.date[int(len(DATE_RANGE.date) / 2)]
-    year = str(middle_date.year)
-    month = str(middle_date.month)
-    month = month.rjust(2, '0')  # Pad month to 2-digits (e.g. 5 becomes 05)
-
-    # Directory containing Landsat data (may contain multiple .tif files)
-    REFLECTANCE_DIR = os.path.join(DATA_DIR, "raw_data/LandsatReflectance", start_date_string)
-
-    # File containing FLDAS data
-    FLDAS_FILE = os.path.join(DATA_DIR, "raw_data/FLDAS/FLDAS_NOAH01_C_GL_M.A" + year + month + ".001.nc.SUB.nc4")
-    print("FLDAS file", FLDAS_FILE)
-    FLDAS_VARS = ["Rainf_f_tavg", "SWdown_f_tavg", "Tair_f_tavg"]
-
-    # Directory containing CDL (crop type) data
-    COVER_DIR = os.path.join(DATA_DIR, "raw_data/CDL_" + year)
-
-    # File containing SIF data
-    SIF_FILE = os.path.join(DATA_DIR, "raw_data/SIF_TROPOMI/TROPO-SIF_01deg_biweekly_Apr18-Jan20.nc")
-
-    # Output directories
-    OUTPUT_DATASET_DIR = os.path.join(DATA_DIR, "metadata/dataset_" + start_date_string)  # Directory containing list of tiles
-    OUTPUT_TILES_DIR = os.path.join(DATA_DIR, "tiles/tiles_" + start_date_string)  # Directory containing 0.1x0.1 degree tiles
-    OUTPUT_CSV_FILE = os.path.join(OUTPUT_DATASET_DIR, "reflectance_cover_to_sif.csv")  # Output csv file referencing all tiles
-    if not os.path.exists(OUTPUT_DATASET_DIR):
-        os.makedirs(OUTPUT_DATASET_DIR)
-    if not os.path.exists(OUTPUT_TILES_DIR):
-        os.makedirs(OUTPUT_TILES_DIR)
+# Resampled cover dataset of the last cover file processed (in this process), keyed by
+# (cover file, target resolution)
+reprojected_covers_cache = dict()
+
+
+def process_reflectance_file(date_range_inputs, cover_file, reflectance_file, partial_csv_file):
+    """
+    Extracts all SIF tiles covered by both "reflectance_file" and "cover_file", writes them to
+    the output tiles directory, and writes their metadata rows to "partial_csv_file". Returns the
+    reflectance coverage of each tile, and the tile files written.
+    "date_range_inputs" holds the directories and the SIF/FLDAS data of the current date range
+    (see date_range_inputs in the main loop below).
+    """
+    COVER_DIR = date_range_inputs['cover_dir']
+    REFLECTANCE_DIR = date_range_inputs['reflectance_dir']
+    OUTPUT_TILES_DIR = date_range_inputs['output_tiles_dir']
+    start_date_string = date_range_inputs['start_date_string']
+    fldas_dataset = date_range_inputs['fldas_dataset']
+    FLDAS_VARS = date_range_inputs['fldas_vars']
+    tropomi_sifs = date_range_inputs['tropomi_sifs']
+    tropomi_cloud_fraction = date_range_inputs['tropomi_cloud_fraction']
+    tropomi_n = date_range_inputs['tropomi_n']
 
-
-    # Dataset format: lon/lat, date, image file name, SIF
-    dataset_rows = []
-    if not APPEND:
-        dataset_rows.append(SIF_TILE_COLUMNS)
-    # image_rows = []
-    # if not APPEND:
-    #     image_rows.append(IMAGE_COLUMNS)
-
-    # For each tile, keep track of how much reflectance data is present
     reflectance_coverage = []
-
-    # Open up the SIF file
-    sif_dataset = xr.open_dataset(SIF_FILE)
-
-    # Read SIF values that fall in the appropriate date range
-    tropomi_sifs = sif_dataset.sif_dc.sel(time=slice(DATE_RANGE.date[0], DATE_RANGE.date[-1]))
-    tropomi_cloud_fraction = sif_dataset.cloud_fraction.sel(time=slice(DATE_RANGE.date[0], DATE_RANGE.date[-1]))
-    tropomi_n = sif_dataset.n.sel(time=slice(DATE_RANGE.date[0], DATE_RANGE.date[-1]))
-
-    print("SIF array:", tropomi_sifs)
-
-    # Check if SIF is available for any date in time range. If there is, take the mean
-    # over all dates in the time period. Otherwise, ask if we should still create the
-    # dataset, but without the SIF label.
-    if len(tropomi_sifs['time'].values) >= 1:
-        tropomi_sifs = tropomi_sifs.mean(dim='time')
-        tropomi_cloud_fraction = tropomi_cloud_fraction.mean(dim='time')
-        tropomi_n = tropomi_n.mean(dim='time')
-    else:
-        response = input("No SIF data available for any date between " + str(DATE_RANGE.date[0]) +
-                            " and " + str(DATE_RANGE.date[-1]) +
-                            ". Create dataset anyways without total SIF label? (y/n) ")
-        if response != 'y' and response != 'Y':
-            exit(1)
-        tropomi_sifs = None
-        tropomi_cloud_fraction = None
-        tropomi_n = None
-
-    # Open up FLDAS dataset
-    fldas_dataset = xr.open_dataset(FLDAS_FILE).mean(dim='time')
-    # print("FLDAS dataset", fldas_dataset)
-
-    # Open crop cover files
-    for cover_file in os.listdir(COVER_DIR):
-        with rio.open(os.path.join(COVER_DIR, cover_file)) as cover_dataset:
-            # Print stats about cover dataset
+    tile_filenames = []
+    with rio.open(os.path.join(COVER_DIR, cover_file)) as cover_dataset, open(partial_csv_file, "w") as partial_file:
+        csv_writer = csv.writer(partial_file, delimiter=",", quoting=csv.QUOTE_MINIMAL)
+        with rio.open(os.path.join(REFLECTANCE_DIR, reflectance_file)) as reflectance_dataset:
+            # Print stats about reflectance file
+            print('===================================================')
+            print('REFLECTANCE DATASET', reflectance_file)
+            print('Bounds:', reflectance_dataset.bounds)
+            print('Transform:', reflectance_dataset.transform)
+            print('Metadata:', reflectance_dataset.meta)
+            print('Resolution:', reflectance_dataset.res)
+            print('Number of layers:', reflectance_dataset.count)
+            print('Coordinate reference system:', reflectance_dataset.crs)
+            print('Shape:', reflectance_dataset.shape)
             print('===================================================')
-            print('COVER DATASET', cover_file)
-            print('Bounds:', cover_dataset.bounds)
-            print('Transform', cover_dataset.transform)
-            print('Metadata:', cover_dataset.meta)
-            print('Resolution:', cover_dataset.res)
-            print('Number of layers:', cover_dataset.count)
-            print('Coordinate reference system:', cover_dataset.crs)
-            print('Shape:', cover_dataset.shape)
-            print('Width:', cover_dataset.width)
-            print('Height:', cover_dataset.height)
-
-            # Print stats about cover dataset
-            #plot_and_print_covers(cover_dataset.read(1), 'original_covers_corn_big_r2.png')
-            #exit(1)
-
-            # Stores a version of cover dataset, reprojected to the resolution of
-            # the reflectance dataset
-            reprojected_covers = None
-            reprojected_fldas = None
+
+            target_res = (reflectance_dataset.res[0], reflectance_dataset.res[1])
+            TARGET_TILE_SIZE = int(SIF_TILE_DEGREE_SIZE / target_res[0])
+            #print("target tile size", TARGET_TILE_SIZE)
+
+            # Resample cover data into target resolution, if we haven't done so already and the
+            # cover dataset is in a different resolution. Each process keeps the last cover dataset
+            # it resampled, since all reflectance files are processed with the same cover file in turn.
+            cover_key = (os.path.join(COVER_DIR, cover_file), target_res)
+            reprojected_covers = reprojected_covers_cache.get(cover_key)
+            if reprojected_covers is None:
+                if abs(cover_dataset.res[0] - target_res[0]) < FLOAT_EQUALITY_TOLERANCE and abs(cover_dataset.res[1] - target_res[1]) < FLOAT_EQUALITY_TOLERANCE:
+                    reprojected_covers = cover_dataset.read(1)
+                    print('No need to reproject cover dataset, as it already has the same resolution as the reflectance dataset')
+                else:
+                    cover_height_upscale_factor = cover_dataset.res[0] / target_res[0]
+                    cover_width_upscale_factor = cover_dataset.res[1] / target_res[1]
+                    print('Reprojecting cover dataset to match reflectance!')
+                    print('Upscale factor: height', cover_height_upscale_factor, 'width', cover_width_upscale_factor)
+                    reprojected_covers = cover_dataset.read(
+                        out_shape=(
+                            int(cover_dataset.height * cover_height_upscale_factor),
+                            int(cover_dataset.width * cover_width_upscale_factor)
+                        ),
+                        resampling=Resampling.mode
+                    )
+                reprojected_covers = np.squeeze(reprojected_covers)
+                reprojected_covers_cache.clear()
+                reprojected_covers_cache[cover_key] = reprojected_covers
+
+            # print('REPROJECTED COVER DATASET: shape', reprojected_covers.shape, 'dtype:', reprojected_covers.dtype)
+
+            # Resample reflectance data into target resolution (don't need this now since we're
+            # projecting everything to the reflectance dataset's resolution)
+            # reflectance_height_upscale_factor = reflectance_dataset.res[0] / target_res[0]
+            # reflectance_width_upscale_factor = reflectance_dataset.res[1] / target_res[1]
+            # reprojected_reflectances = reflectance_dataset.read(
+            #    out_shape=(
+            #        int(reflectance_dataset.height * reflectance_height_upscale_factor),
+            #        int(reflectance_dataset.width * reflectance_width_upscale_factor)
+            #    ),
+            #    resampling=Resampling.bilinear
+            # 
+            # )
+
+            # Read reflectance dataset into numpy array: CxHxW
+            # Note that index (0, 0) is at the upper left corner!
+            reprojected_reflectances = reflectance_dataset.read()
+            print('REPROJECTED REFLECTANCE DATASET: shape', reprojected_reflectances.shape, 'Dtype:', reprojected_reflectances.dtype)
+
+            #plot_histogram(reprojected_reflectances[1].flatten(), 'blue_reflectance_values.png')
+            #plot_histogram(reprojected_reflectances[2].flatten(), 'green_reflectance_values.png')
+            #plot_histogram(reprojected_reflectances[3].flatten(), 'red_reflectance_values.png')
+
+            # Plot distribution of specific crop
+            # plot_and_print_covers(reprojected_covers, filename="reprojected_cover_corn_big.png")
+
+            # Read reflectance data into numpy array
+            # reflectance_numpy = reflectance_dataset.read()
+            # print('Reflectance numpy array shape', reflectance_numpy.shape)
+            # print('Lat/Long of Upper Left Corner', reflectance_dataset.xy(0, 0))
+            # print('Lat/Long of index (1000, 1000)', reflectance_dataset.xy(1000, 1000))
+
+            # Just for testing
+            # point = (44.9, -88.9)
+            # left_idx, top_idx = reprojected_reflectances.index(point[1], point[0])  # reflectance_dataset.bounds.left, reflectance_dataset.bounds.top)
+            # print('===================================================')
+            # print('TEST CASE: Point lat=', point[0], 'long=', point[1])
+            # print('Using index method', left_idx, top_idx)
+
+            # reflectance_height_idx, reflectance_width_idx = lat_long_to_index(point[0], point[1],
+            #                                                                  reflectance_dataset.bounds.top,
+            #                                                                  reflectance_dataset.bounds.left,
+            #                                                                  target_res)
+            # print("indices in reflectance:", reflectance_height_idx, reflectance_width_idx)
+            # cover_height_idx, cover_width_idx = lat_long_to_index(point[0], point[1], cover_dataset.bounds.top,
+            #                                                       cover_dataset.bounds.left, target_res)
+            # print("indices in cover:", cover_height_idx, cover_width_idx)
+            # print('===================================================')
+
+            # Convert bounds to indices in the cover and reflectance datasets. Note that (0,0)
+            # is the upper-left corner!
+            #cover_top_idx, cover_left_idx = lat_long_to_index(combined_top_bound,
+            #                                                  combined_left_bound,
+            #                                                  cover_dataset.bounds.top,
+            #                                                  cover_dataset.bounds.left,
+            #                                                  target_res)
+            #reflectance_top_idx, reflectance_left_idx = lat_long_to_index(combined_top_bound,
+            #                                                              combined_left_bound,
+            #                                                              reflectance_dataset.bounds.top,
+            #                                                              reflectance_dataset.bounds.left,
+            #                                                              target_res)
+            #height_pixels = int((combined_top_bound - combined_bottom_bound) / target_res[0])
+            #width_pixels = int((combined_right_bound - combined_left_bound) / target_res[1])
+            #cover_right_idx = cover_left_idx + width_pixels
+            #reflectance_right_idx = reflectance_left_idx + width_pixels
+            #cover_bottom_idx = cover_top_idx + height_pixels
+            #reflectance_bottom_idx = reflectance_top_idx + height_pixels
+            #print('Cover: top', cover_top_idx, 'bottom', cover_bottom_idx, 'left', cover_left_idx, 'right', cover_right_idx)
+            #print('Reflectance: top', reflectance_top_idx, 'bottom', reflectance_bottom_idx, 'left', reflectance_left_idx, 'right', reflectance_right_idx)
+            #assert(reflectance_top_idx >= 0)
+            #assert(cover_top_idx >= 0)
+            #assert(cover_right_idx <= reprojected_covers.shape[1])  # Recall right_idx is exclusive
+            #assert(reflectance_right_idx <= reprojected_reflectances.shape[2])
+
+            # Extract bounds of the intersection of reflectance/cover coverage
+            combined_left_bound = max(reflectance_dataset.bounds.left, cover_dataset.bounds.left)
+            combined_right_bound = min(reflectance_dataset.bounds.right, cover_dataset.bounds.right)
+            combined_bottom_bound = max(reflectance_dataset.bounds.bottom, cover_dataset.bounds.bottom)
+            combined_top_bound = min(reflectance_dataset.bounds.top, cover_dataset.bounds.top)
+            print("Bounds: lon:", combined_left_bound, "to", combined_right_bound, "lat:", combined_bottom_bound, "to", combined_top_bound)
+
+            # Round boundaries to the nearest 0.1 degree
+            LEFT_BOUND = math.ceil(combined_left_bound * 10) / 10  # -100.2
+            RIGHT_BOUND = math.floor(combined_right_bound * 10) / 10  # -81.6
+            BOTTOM_BOUND = math.ceil(combined_bottom_bound * 10) / 10  # 38.2
+            TOP_BOUND = math.floor(combined_top_bound * 10) / 10  # 46.6
+            print("Rounded bounds: lon:", LEFT_BOUND, "to", RIGHT_BOUND, "lat:", BOTTOM_BOUND, "to", TOP_BOUND)
+
+            # Iterate through all 0.1 degree intervals
+            num_tiles_lon = int(round((RIGHT_BOUND - LEFT_BOUND) / SIF_TILE_DEGREE_SIZE))
+            num_tiles_lat = int(round((TOP_BOUND - BOTTOM_BOUND) / SIF_TILE_DEGREE_SIZE))
+            if num_tiles_lon <= 0 or num_tiles_lat <= 0:
+                print("No overlap between reflectance and cover dataset!")
+                return reflectance_coverage, tile_filenames
+            tile_lefts = np.linspace(LEFT_BOUND, RIGHT_BOUND, num_tiles_lon, endpoint=False)
+            tile_tops = np.linspace(TOP_BOUND, BOTTOM_BOUND, num_tiles_lat, endpoint=False)
+            print('Tile lefts', tile_lefts)
+            print('Tile tops', tile_tops)
+
+            # Resample FLDAS data into target resolution, once for the whole scene. The new coordinates
+            # are the pixel coordinates of each SIF tile (as computed for a single tile), concatenated,
+            # so that the FLDAS data of each tile is a slice of "fldas_scene".
+            new_lat = np.concatenate([np.linspace(top_degrees, top_degrees - (TARGET_TILE_SIZE * target_res[0]), TARGET_TILE_SIZE, endpoint=False)
+                                      for top_degrees in tile_tops])
+            new_lon = np.concatenate([np.linspace(left_degrees, left_degrees + (TARGET_TILE_SIZE * target_res[1]), TARGET_TILE_SIZE, endpoint=False)
+                                      for left_degrees in tile_lefts])
+            reprojected_fldas_dataset = fldas_dataset.interp(X=new_lon, Y=new_lat)
+            fldas_layers = []
+            #print('FLDAS data vars', reprojected_fldas_dataset.data_vars)
+            for data_var in reprojected_fldas_dataset.data_vars:
+                assert(data_var in FLDAS_VARS)
+                fldas_layers.append(reprojected_fldas_dataset[data_var].data.astype(np.float32))
+            fldas_scene = np.stack(fldas_layers)
+
+            # Look up the TROPOMI SIF labels of all tiles at once (at the grid cells nearest to the
+            # tile centers)
+            if tropomi_sifs is not None:
+                tile_sifs, tile_cloud_fractions, tile_num_soundings = sif_utils.nearest_grid_values(
+                    [tropomi_sifs, tropomi_cloud_fraction, tropomi_n],
+                    np.round(tile_tops - SIF_TILE_DEGREE_SIZE / 2, 2), np.round(tile_lefts + SIF_TILE_DEGREE_SIZE / 2, 2))
+
+            # For each "SIF tile", extract the tile of the reflectance data that maps to it
+            for lon_tile_idx, left_degrees in enumerate(tile_lefts):
+                for lat_tile_idx, top_degrees in enumerate(tile_tops):
+                    bottom_degrees = top_degrees - (TARGET_TILE_SIZE * target_res[0])
+                    right_degrees = left_degrees + (TARGET_TILE_SIZE * target_res[1])
+                    # print('-----------------------------------------------------------')
+                    # print('Extracting tile: longitude', left_degrees, 'to', right_degrees, 'latitude', bottom_degrees, 'to', top_degrees)
+
+                    # Find indices of tile in reflectance and cover datasets
+                    reflectance_top_idx, reflectance_left_idx = lat_long_to_index(top_degrees, left_degrees, reflectance_dataset.bounds.top, reflectance_dataset.bounds.left, target_res)
+                    reflectance_bottom_idx = reflectance_top_idx + TARGET_TILE_SIZE
+                    reflectance_right_idx = reflectance_left_idx + TARGET_TILE_SIZE
+                    cover_top_idx, cover_left_idx = lat_long_to_index(top_degrees, left_degrees, cover_dataset.bounds.top, cover_dataset.bounds.left, target_res)
+                    cover_bottom_idx = cover_top_idx + TARGET_TILE_SIZE
+                    cover_right_idx = cover_left_idx + TARGET_TILE_SIZE
+                    #print("Reflectance dataset idx: top", reflectance_top_idx, "bottom", reflectance_bottom_idx,
+                    #      "left", reflectance_left_idx, "right", reflectance_right_idx)
+                    # print("Cover dataset idx: top", cover_top_idx, "bottom", cover_bottom_idx,
+                    #     "left", cover_left_idx, "right", cover_right_idx)
+
+                    # If the selected region (box) goes outside the range of the cover or reflectance dataset, that's a bug!
+                    if reflectance_top_idx < 0 or reflectance_left_idx < 0:
+                        print("Reflectance index was negative!")
+                        exit(1)
+                    if (reflectance_bottom_idx >= reprojected_reflectances.shape[1] or reflectance_right_idx >= reprojected_reflectances.shape[2]):
+                        print("Reflectance index went beyond edge of array!")
+                        exit(1)
+                    if cover_top_idx < 0 or cover_left_idx < 0:
+                        print("Cover index was negative!")
+                        exit(1)
+                    if (cover_bottom_idx >= reprojected_covers.shape[0] or cover_right_idx >= reprojected_covers.shape[1]):
+                        print("Cover index went beyond edge of array!")
+                        exit(1)
+
+                    # FLDAS data for this tile (resampled for the whole scene above)
+                    fldas_tile = fldas_scene[:, lat_tile_idx * TARGET_TILE_SIZE:(lat_tile_idx + 1) * TARGET_TILE_SIZE,
+                                             lon_tile_idx * TARGET_TILE_SIZE:(lon_tile_idx + 1) * TARGET_TILE_SIZE]
+                    if np.isnan(fldas_tile).any():
+                        print('ATTENTION: FLDAS tile had NaNs!!!')
+                        continue
+
+                    # Extract the areas from cover and reflectance datasets that map to this SIF value.
+                    # Again, index (0, 0) is in the upper-left corner. For "reprojected_covers",
+                    # the first axis is latitude (higher indices = lower latitudes / south), and the
+                    # second axis is longitude (higher indices = higher longitudes / east). For 
+                    # "reprojected_reflectances", it's similar, but there is a "channel" axis first.
+                    cover_tile = reprojected_covers[cover_top_idx:cover_bottom_idx,
+                                                    cover_left_idx:cover_right_idx]
+                    reflectance_tile = reprojected_reflectances[:, reflectance_top_idx:reflectance_bottom_idx,
+                                                                reflectance_left_idx:reflectance_right_idx]
+                    #print('Cover tile shape', cover_tile.shape, 'dtype', cover_tile.dtype)
+                    #print('Reflectance tile shape (should be the same!)', reflectance_tile.shape, 'dtype', reflectance_tile.dtype)
+                    #print('FLDAS tile shape (should be the same!)', fldas_tile.shape, 'dtype', fldas_tile.dtype)
+
+                    # Find the cover class of each pixel (index of its cover mask, see tile_storage.py),
+                    # with a single table lookup per pixel
+                    cover_class = tile_storage.encode_cover_classes(cover_tile, COVER_CLASS_TABLE)
+
+                    # Also create a binary mask, which is 1 for pixels where reflectance
+                    # data (for all bands) is missing (due to cloud cover)
+                    missing_reflectance_mask = (reflectance_tile.sum(axis=0) == 0)
+
+                    # The tile's planes: reflectance and FLDAS bands, cover classes, and missing reflectance mask
+                    assert reflectance_tile.dtype == np.float32 and fldas_tile.dtype == np.float32
+                    continuous_tile = np.concatenate((reflectance_tile, fldas_tile), axis=0)
+
+                    # Compute averages of each band (over non-cloudy pixels), straight from the planes
+                    average_input_features = tile_storage.band_averages(continuous_tile, cover_class, missing_reflectance_mask)
+                    reflectance_coverage.append(1 - average_input_features[MISSING_REFLECTANCE_IDX])
+                    if average_input_features[MISSING_REFLECTANCE_IDX] > MAX_MISSING_REFLECTANCE:
+                        continue
+
+                    # Extract corresponding SIF value
+                    center_lat = round(top_degrees - SIF_TILE_DEGREE_SIZE / 2, 2)
+                    center_lon = round(left_degrees + SIF_TILE_DEGREE_SIZE / 2, 2)
+                    if tropomi_sifs is not None:
+                        total_sif = tile_sifs[lat_tile_idx, lon_tile_idx].item()
+                        cloud_fraction = tile_cloud_fractions[lat_tile_idx, lon_tile_idx].item()
+                        num_soundings = tile_num_soundings[lat_tile_idx, lon_tile_idx].item()
+                        if np.isnan(total_sif):  # If there's no SIF value, ignore this tile
+                            continue
+                    else:
+                        total_sif = float("nan")
+                        cloud_fraction = float("nan")
+                        num_soundings = float("nan")
+
+
+                    # Write reflectance/cover pixels tile to .npz file (in packed format,
+                    # see tile_storage.py)
+                    tile_filename = os.path.join(OUTPUT_TILES_DIR, "reflectance_lat_" + str(
+                        center_lat) + "_lon_" + str(center_lon) + tile_storage.PACKED_TILE_EXTENSION)
+                    tile_storage.save_packed_tile_planes(tile_filename, continuous_tile, cover_class, missing_reflectance_mask)
+                    tile_filenames.append(tile_filename)
+
+                    # Add metadata about the tile to csv
+                    csv_row = [center_lon, center_lat, start_date_string, tile_filename] + average_input_features.tolist() + [total_sif, cloud_fraction, num_soundings]
+                    csv_writer.writerow(csv_row)
+    return reflectance_coverage, tile_filenames
+
+
+# Inputs of the current date range, in a worker process (set by init_worker)
+worker_date_range_inputs = None
+
+
+def init_worker(date_range_inputs):
+    """
+    Initializer of the worker processes: receives the inputs of the date range once per worker,
+    rather than once per reflectance file.
+    """
+    global worker_date_range_inputs
+    worker_date_range_inputs = date_range_inputs
+
+
+def process_reflectance_file_in_worker(cover_file, reflectance_file, partial_csv_file):
+    return process_reflectance_file(worker_date_range_inputs, cover_file, reflectance_file, partial_csv_file)
+
+
+# Spawned workers import this script, so only run the main loop in the main process
+if __name__ == "__main__":
+    for DATE_RANGE in DATE_RANGES:
+        start_date = DATE_RANGE.date[0]
+        start_date_string = str(start_date)
+        middle_date = DATE_RANGE.date[int(len(DATE_RANGE.date) / 2)]
+        year = str(middle_date.year)
+        month = str(middle_date.month)
+        month = month.rjust(2, '0')  # Pad month to 2-digits (e.g. 5 becomes 05)
+
+        # Directory containing Landsat data (may contain multiple .tif files)
+        REFLECTANCE_DIR = os.path.join(DATA_DIR, "raw_data/LandsatReflectance", start_date_string)
+
+        # File containing FLDAS data
+        FLDAS_FILE = os.path.join(DATA_DIR, "raw_data/FLDAS/FLDAS_NOAH01_C_GL_M.A" + year + month + ".001.nc.SUB.nc4")
+        print("FLDAS file", FLDAS_FILE)
+        FLDAS_VARS = ["Rainf_f_tavg", "SWdown_f_tavg", "Tair_f_tavg"]
+
+        # Directory containing CDL (crop type) data
+        COVER_DIR = os.path.join(DATA_DIR, "raw_data/CDL_" + year)
+
+        # File containing SIF data
+        SIF_FILE = os.path.join(DATA_DIR, "raw_data/SIF_TROPOMI/TROPO-SIF_01deg_biweekly_Apr18-Jan20.nc")
+
+        # Output directories
+        OUTPUT_DATASET_DIR = os.path.join(DATA_DIR, "metadata/dataset_" + start_date_string)  # Directory containing list of tiles
+        OUTPUT_TILES_DIR = os.path.join(DATA_DIR, "tiles/tiles_" + start_date_string)  # Directory containing 0.1x0.1 degree tiles
+        OUTPUT_CSV_FILE = os.path.join(OUTPUT_DATASET_DIR, "reflectance_cover_to_sif.csv")  # Output csv file referencing all tiles
+        PARTIAL_METADATA_DIR = os.path.join(OUTPUT_DATASET_DIR, "partial_metadata")  # Metadata rows of each work unit
+        if not os.path.exists(OUTPUT_DATASET_DIR):
+            os.makedirs(OUTPUT_DATASET_DIR)
+        if not os.path.exists(OUTPUT_TILES_DIR):
+            os.makedirs(OUTPUT_TILES_DIR)
+        if not os.path.exists(PARTIAL_METADATA_DIR):
+            os.makedirs(PARTIAL_METADATA_DIR)
+
+        # image_rows = []
+        # if not APPEND:
+        #     image_rows.append(IMAGE_COLUMNS)
+
+        # For each tile, keep track of how much reflectance data is present
+        reflectance_coverage = []
+
+        # Records every tile written (see tile_manifest.py)
+        manifest_writer = tile_manifest.ManifestWriter('create_datasets')
+
+        # Inputs hash and outputs of each (cover file, reflectance file) pair processed
+        build_state = incremental_build.BuildState(os.path.join(OUTPUT_DATASET_DIR, "build_state.json"))
+
+        # Open up the SIF file
+        sif_dataset = xr.open_dataset(SIF_FILE)
+
+        # Read SIF values that fall in the appropriate date range
+        tropomi_sifs = sif_dataset.sif_dc.sel(time=slice(DATE_RANGE.date[0], DATE_RANGE.date[-1]))
+        tropomi_cloud_fraction = sif_dataset.cloud_fraction.sel(time=slice(DATE_RANGE.date[0], DATE_RANGE.date[-1]))
+        tropomi_n = sif_dataset.n.sel(time=slice(DATE_RANGE.date[0], DATE_RANGE.date[-1]))
+
+        print("SIF array:", tropomi_sifs)
+
+        # Check if SIF is available for any date in time range. If there is, take the mean
+        # over all dates in the time period. Otherwise, ask if we should still create the
+        # dataset, but without the SIF label.
+        if len(tropomi_sifs['time'].values) >= 1:
+            tropomi_sifs = tropomi_sifs.mean(dim='time')
+            tropomi_cloud_fraction = tropomi_cloud_fraction.mean(dim='time')
+            tropomi_n = tropomi_n.mean(dim='time')
+        else:
+            response = input("No SIF data available for any date between " + str(DATE_RANGE.date[0]) +
+                                " and " + str(DATE_RANGE.date[-1]) +
+                                ". Create dataset anyways without total SIF label? (y/n) ")
+            if response != 'y' and response != 'Y':
+                exit(1)
+            tropomi_sifs = None
+            tropomi_cloud_fraction = None
+            tropomi_n = None
+
+        # Open up FLDAS dataset
+        fldas_dataset = xr.open_dataset(FLDAS_FILE).mean(dim='time')
+        # print("FLDAS dataset", fldas_dataset)
+
+        # Work units: one per (cover file, reflectance file) pair
+        units = []
+        for cover_file in os.listdir(COVER_DIR):
+            with rio.open(os.path.join(COVER_DIR, cover_file)) as cover_dataset:
+                # Print stats about cover dataset
+                print('===================================================')
+                print('COVER DATASET', cover_file)
+                print('Bounds:', cover_dataset.bounds)
+                print('Transform', cover_dataset.transform)
+                print('Metadata:', cover_dataset.meta)
+                print('Resolution:', cover_dataset.res)
+                print('Number of layers:', cover_dataset.count)
+                print('Coordinate reference system:', cover_dataset.crs)
+                print('Shape:', cover_dataset.shape)
+                print('Width:', cover_dataset.width)
+                print('Height:', cover_dataset.height)
 
             # If you select a large region, Google Earth Engine breaks the reflectance data
             # into multiple files; loop through all of them.
             for reflectance_file in sorted(os.listdir(REFLECTANCE_DIR)):
-                try:
-                    with rio.open(os.path.join(REFLECTANCE_DIR, reflectance_file)) as reflectance_dataset:
-                        # Print stats about reflectance file
-                        print('===================================================')
-                        print('REFLECTANCE DATASET', reflectance_file)
-                        print('Bounds:', reflectance_dataset.bounds)
-                        print('Transform:', reflectance_dataset.transform)
-                        print('Metadata:', reflectance_dataset.meta)
-                        print('Resolution:', reflectance_dataset.res)
-                        print('Number of layers:', reflectance_dataset.count)
-                        print('Coordinate reference system:', reflectance_dataset.crs)
-                        print('Shape:', reflectance_dataset.shape)
-                        print('===================================================')
-
-                        target_res = (reflectance_dataset.res[0], reflectance_dataset.res[1])
-                        TARGET_TILE_SIZE = int(SIF_TILE_DEGREE_SIZE / target_res[0])
-                        #print("target tile size", TARGET_TILE_SIZE)
-
-                        # Resample cover data into target resolution, if we haven't done so already and the
-                        # cover dataset is in a different resolution
-                        if reprojected_covers is None:
-                            if abs(cover_dataset.res[0] - target_res[0]) < FLOAT_EQUALITY_TOLERANCE and abs(cover_dataset.res[1] - target_res[1]) < FLOAT_EQUALITY_TOLERANCE:
-                                reprojected_covers = cover_dataset.read(1)
-                                print('No need to reproject cover dataset, as it already has the same resolution as the reflectance dataset')
-                            else:
-                                cover_height_upscale_factor = cover_dataset.res[0] / target_res[0]
-                                cover_width_upscale_factor = cover_dataset.res[1] / target_res[1]
-                                print('Reprojecting cover dataset to match reflectance!')
-                                print('Upscale factor: height', cover_height_upscale_factor, 'width', cover_width_upscale_factor)
-                                reprojected_covers = cover_dataset.read(
-                                    out_shape=(
-                                        int(cover_dataset.height * cover_height_upscale_factor),
-                                        int(cover_dataset.width * cover_width_upscale_factor)
-                                    ),
-                                    resampling=Resampling.mode
-                                )
-                            reprojected_covers = np.squeeze(reprojected_covers)
-
-                        # print('REPROJECTED COVER DATASET: shape', reprojected_covers.shape, 'dtype:', reprojected_covers.dtype)
-
-                        # Resample reflectance data into target resolution (don't need this now since we're
-                        # projecting everything to the reflectance dataset's resolution)
-                        # reflectance_height_upscale_factor = reflectance_dataset.res[0] / target_res[0]
-                        # reflectance_width_upscale_factor = reflectance_dataset.res[1] / target_res[1]
-                        # reprojected_reflectances = reflectance_dataset.read(
-                        #    out_shape=(
-                        #        int(reflectance_dataset.height * reflectance_height_upscale_factor),
-                        #        int(reflectance_dataset.width * reflectance_width_upscale_factor)
-                        #    ),
-                        #    resampling=Resampling.bilinear
-                        # 
-                        # )
-
-                        # Read reflectance dataset into numpy array: CxHxW
-                        # Note that index (0, 0) is at the upper left corner!
-                        reprojected_reflectances = reflectance_dataset.read()
-                        print('REPROJECTED REFLECTANCE DATASET: shape', reprojected_reflectances.shape, 'Dtype:', reprojected_reflectances.dtype)
-
-                        #plot_histogram(reprojected_reflectances[1].flatten(), 'blue_reflectance_values.png')
-                        #plot_histogram(reprojected_reflectances[2].flatten(), 'green_reflectance_values.png')
-                        #plot_histogram(reprojected_reflectances[3].flatten(), 'red_reflectance_values.png')
-
-                        # Plot distribution of specific crop
-                        # plot_and_print_covers(reprojected_covers, filename="reprojected_cover_corn_big.png")
-
-                        # Read reflectance data into numpy array
-                        # reflectance_numpy = reflectance_dataset.read()
-                        # print('Reflectance numpy array shape', reflectance_numpy.shape)
-                        # print('Lat/Long of Upper Left Corner', reflectance_dataset.xy(0, 0))
-                        # print('Lat/Long of index (1000, 1000)', reflectance_dataset.xy(1000, 1000))
-
-                        # Just for testing
-                        # point = (44.9, -88.9)
-                        # left_idx, top_idx = reprojected_reflectances.index(point[1], point[0])  # reflectance_dataset.bounds.left, reflectance_dataset.bounds.top)
-                        # print('===================================================')
-                        # print('TEST CASE: Point lat=', point[0], 'long=', point[1])
-                        # print('Using index method', left_idx, top_idx)
-
-                        # reflectance_height_idx, reflectance_width_idx = lat_long_to_index(point[0], point[1],
-                        #                                                                  reflectance_dataset.bounds.top,
-                        #                                                                  reflectance_dataset.bounds.left,
-                        #                                                                  target_res)
-                        # print("indices in reflectance:", reflectance_height_idx, reflectance_width_idx)
-                        # cover_height_idx, cover_width_idx = lat_long_to_index(point[0], point[1], cover_dataset.bounds.top,
-                        #                                                       cover_dataset.bounds.left, target_res)
-                        # print("indices in cover:", cover_height_idx, cover_width_idx)
-                        # print('===================================================')
-
-                        # Convert bounds to indices in the cover and reflectance datasets. Note that (0,0)
-                        # is the upper-left corner!
-                        #cover_top_idx, cover_left_idx = lat_long_to_index(combined_top_bound,
-                        #                                                  combined_left_bound,
-                        #                                                  cover_dataset.bounds.top,
-                        #                                                  cover_dataset.bounds.left,
-                        #                                                  target_res)
-                        #reflectance_top_idx, reflectance_left_idx = lat_long_to_index(combined_top_bound,
-                        #                                                              combined_left_bound,
-                        #                                                              reflectance_dataset.bounds.top,
-                        #                                                              reflectance_dataset.bounds.left,
-                        #                                                              target_res)
-                        #height_pixels = int((combined_top_bound - combined_bottom_bound) / target_res[0])
-                        #width_pixels = int((combined_right_bound - combined_left_bound) / target_res[1])
-                        #cover_right_idx = cover_left_idx + width_pixels
-                        #reflectance_right_idx = reflectance_left_idx + width_pixels
-                        #cover_bottom_idx = cover_top_idx + height_pixels
-                        #reflectance_bottom_idx = reflectance_top_idx + height_pixels
-                        #print('Cover: top', cover_top_idx, 'bottom', cover_bottom_idx, 'left', cover_left_idx, 'right', cover_right_idx)
-                        #print('Reflectance: top', reflectance_top_idx, 'bottom', reflectance_bottom_idx, 'left', reflectance_left_idx, 'right', reflectance_right_idx)
-                        #assert(reflectance_top_idx >= 0)
-                        #assert(cover_top_idx >= 0)
-                        #assert(cover_right_idx <= reprojected_covers.shape[1])  # Recall right_idx is exclusive
-                        #assert(reflectance_right_idx <= reprojected_reflectances.shape[2])
-
-                        # Extract bounds of the intersection of reflectance/cover coverage
-                        combined_left_bound = max(reflectance_dataset.bounds.left, cover_dataset.bounds.left)
-                        combined_right_bound = min(reflectance_dataset.bounds.right, cover_dataset.bounds.right)
-                        combined_bottom_bound = max(reflectance_dataset.bounds.bottom, cover_dataset.bounds.bottom)
-                        combined_top_bound = min(reflectance_dataset.bounds.top, cover_dataset.bounds.top)
-                        print("Bounds: lon:", combined_left_bound, "to", combined_right_bound, "lat:", combined_bottom_bound, "to", combined_top_bound)
-
-                        # Round boundaries to the nearest 0.1 degree
-                        LEFT_BOUND = math.ceil(combined_left_bound * 10) / 10  # -100.2
-                        RIGHT_BOUND = math.floor(combined_right_bound * 10) / 10  # -81.6
-                        BOTTOM_BOUND = math.ceil(combined_bottom_bound * 10) / 10  # 38.2
-                        TOP_BOUND = math.floor(combined_top_bound * 10) / 10  # 46.6
-                        print("Rounded bounds: lon:", LEFT_BOUND, "to", RIGHT_BOUND, "lat:", BOTTOM_BOUND, "to", TOP_BOUND)
-
-                        # Iterate through all 0.1 degree intervals
-                        num_tiles_lon = int(round((RIGHT_BOUND - LEFT_BOUND) / SIF_TILE_DEGREE_SIZE))
-                        num_tiles_lat = int(round((TOP_BOUND - BOTTOM_BOUND) / SIF_TILE_DEGREE_SIZE))
-                        if num_tiles_lon <= 0 or num_tiles_lat <= 0:
-                            print("No overlap between reflectance and cover dataset!")
-                            continue
-                        tile_lefts = np.linspace(LEFT_BOUND, RIGHT_BOUND, num_tiles_lon, endpoint=False)
-                        tile_tops = np.linspace(TOP_BOUND, BOTTOM_BOUND, num_tiles_lat, endpoint=False)
-                        print('Tile lefts', tile_lefts)
-                        print('Tile tops', tile_tops)
-
-                        # For each "SIF tile", extract the tile of the reflectance data that maps to it
-                        for left_degrees in tile_lefts:
-                            for top_degrees in tile_tops:
-                                bottom_degrees = top_degrees - (TARGET_TILE_SIZE * target_res[0])
-                                right_degrees = left_degrees + (TARGET_TILE_SIZE * target_res[1])
-                                # print('-----------------------------------------------------------')
-                                # print('Extracting tile: longitude', left_degrees, 'to', right_degrees, 'latitude', bottom_degrees, 'to', top_degrees)
-
-                                # Find indices of tile in reflectance and cover datasets
-                                reflectance_top_idx, reflectance_left_idx = lat_long_to_index(top_degrees, left_degrees, reflectance_dataset.bounds.top, reflectance_dataset.bounds.left, target_res)
-                                reflectance_bottom_idx = reflectance_top_idx + TARGET_TILE_SIZE
-                                reflectance_right_idx = reflectance_left_idx + TARGET_TILE_SIZE
-                                cover_top_idx, cover_left_idx = lat_long_to_index(top_degrees, left_degrees, cover_dataset.bounds.top, cover_dataset.bounds.left, target_res)
-                                cover_bottom_idx = cover_top_idx + TARGET_TILE_SIZE
-                                cover_right_idx = cover_left_idx + TARGET_TILE_SIZE
-                                #print("Reflectance dataset idx: top", reflectance_top_idx, "bottom", reflectance_bottom_idx,
-                                #      "left", reflectance_left_idx, "right", reflectance_right_idx)
-                                # print("Cover dataset idx: top", cover_top_idx, "bottom", cover_bottom_idx,
-                                #     "left", cover_left_idx, "right", cover_right_idx)
-
-                                # If the selected region (box) goes outside the range of the cover or reflectance dataset, that's a bug!
-                                if reflectance_top_idx < 0 or reflectance_left_idx < 0:
-                                    print("Reflectance index was negative!")
-                                    exit(1)
-                                if (reflectance_bottom_idx >= reprojected_reflectances.shape[1] or reflectance_right_idx >= reprojected_reflectances.shape[2]):
-                                    print("Reflectance index went beyond edge of array!")
-                                    exit(1)
-                                if cover_top_idx < 0 or cover_left_idx < 0:
-                                    print("Cover index was negative!")
-                                    exit(1)
-                                if (cover_bottom_idx >= reprojected_covers.shape[0] or cover_right_idx >= reprojected_covers.shape[1]):
-                                    print("Cover index went beyond edge of array!")
-                                    exit(1)
-
-                                # Resample FLDAS data for this tile into target resolution (if we haven't already)
-                                new_lat = np.linspace(top_degrees, bottom_degrees, TARGET_TILE_SIZE, endpoint=False)  # bottom_bound, combined_top_bound, height_pixels)
-                                new_lon = np.linspace(left_degrees, right_degrees, TARGET_TILE_SIZE, endpoint=False)  # combined_left_bound, combined_right_bound, width_pixels)
-                                reprojected_fldas_dataset = fldas_dataset.interp(X=new_lon, Y=new_lat)
-                                fldas_layers = []
-                                #print('FLDAS data vars', reprojected_fldas_dataset.data_vars)
-                                for data_var in reprojected_fldas_dataset.data_vars:
-                                    assert(data_var in FLDAS_VARS)
-                                    fldas_layers.append(reprojected_fldas_dataset[data_var].data.astype(np.float32))
-                                fldas_tile = np.stack(fldas_layers)
-                                if np.isnan(fldas_tile).any():
-                                    print('ATTENTION: FLDAS tile had NaNs!!!')
-                                    continue
-
-                                # Extract the areas from cover and reflectance datasets that map to this SIF value.
-                                # Again, index (0, 0) is in the upper-left corner. For "reprojected_covers",
-                                # the first axis is latitude (higher indices = lower latitudes / south), and the
-                                # second axis is longitude (higher indices = higher longitudes / east). For 
-                                # "reprojected_reflectances", it's similar, but there is a "channel" axis first.
-                                cover_tile = reprojected_covers[cover_top_idx:cover_bottom_idx,
-                                                                cover_left_idx:cover_right_idx]
-                                reflectance_tile = reprojected_reflectances[:, reflectance_top_idx:reflectance_bottom_idx,
-                                                                            reflectance_left_idx:reflectance_right_idx]
-                                #print('Cover tile shape', cover_tile.shape, 'dtype', cover_tile.dtype)
-                                #print('Reflectance tile shape (should be the same!)', reflectance_tile.shape, 'dtype', reflectance_tile.dtype)
-                                #print('FLDAS tile shape (should be the same!)', fldas_tile.shape, 'dtype', fldas_tile.dtype)
-
-                                # Create cover bands (binary masks)
-                                masks = []
-                                for i, cover_type in enumerate(COVERS_TO_MASK):
-                                    crop_mask = np.zeros_like(cover_tile, dtype=bool)
-                                    crop_mask[cover_tile == cover_type] = 1.
-                                    masks.append(crop_mask)
-
-                                # Also create a binary mask, which is 1 for pixels where reflectance
-                                # data (for all bands) is missing (due to cloud cover)
-                                reflectance_sum_bands = reflectance_tile.sum(axis=0)
-                                missing_reflectance_mask = np.zeros_like(reflectance_sum_bands, dtype=bool)
-                                missing_reflectance_mask[reflectance_sum_bands == 0] = 1.
-                                masks.append(missing_reflectance_mask)
-
-                                # Stack masks on top of each other
-                                masks = np.stack(masks, axis=0)
-
-                                # Stack reflectance bands and masks on top of each other
-                                combined_tile = np.concatenate((reflectance_tile, fldas_tile, masks), axis=0)
-                                assert combined_tile.dtype == np.float32
-
-                                # Compute averages of each band (over non-cloudy pixels)
-                                average_input_features = sif_utils.compute_band_averages(combined_tile, combined_tile[MISSING_REFLECTANCE_IDX])
-                                reflectance_coverage.append(1 - average_input_features[MISSING_REFLECTANCE_IDX])
-                                if average_input_features[MISSING_REFLECTANCE_IDX] > MAX_MISSING_REFLECTANCE:
-                                    continue
-
-                                # Extract corresponding SIF value
-                                center_lat = round(top_degrees - SIF_TILE_DEGREE_SIZE / 2, 2)
-                                center_lon = round(left_degrees + SIF_TILE_DEGREE_SIZE / 2, 2)
-                                if tropomi_sifs is not None:
-                                    total_sif = tropomi_sifs.sel(lat=center_lat, lon=center_lon, method='nearest').values.item()
-                                    cloud_fraction = tropomi_cloud_fraction.sel(lat=center_lat, lon=center_lon, method='nearest').values.item()
-                                    num_soundings = tropomi_n.sel(lat=center_lat, lon=center_lon, method='nearest').values.item()
-                                    if np.isnan(total_sif):  # If there's no SIF value, ignore this tile
-                                        continue
-                                else:
-                                    total_sif = float("nan")
-                                    cloud_fraction = float("nan")
-                                    num_soundings = float("nan")
-
-
-                                # Write reflectance/cover pixels tile (as Numpy array) to .npy file
-                                tile_filename = os.path.join(OUTPUT_TILES_DIR, "reflectance_lat_" + str(
-                                    center_lat) + "_lon_" + str(center_lon) + ".npy")
-                                np.save(tile_filename, combined_tile)
-
-                                # Add metadata about the tile to csv
-                                csv_row = [center_lon, center_lat, start_date_string, tile_filename] + average_input_features.tolist() + [total_sif, cloud_fraction, num_soundings]
-                                dataset_rows.append(csv_row)
-
-                except Exception as error:
-                    print("Reading reflectance file", reflectance_file, "failed")
-                    print(traceback.format_exc())
-                    exit(1)
-
-    # If APPEND is true, we're appending rows to an existing .csv.
-    # Otherwise, we're overwriting.
-    if APPEND:
-        mode = "a+"
-    else:
-        mode = "w"
-
-    # Write information about each tile to the output csv file
-    with open(OUTPUT_CSV_FILE, mode) as output_csv_file:
-        csv_writer = csv.writer(output_csv_file, delimiter=",", quoting=csv.QUOTE_MINIMAL)
-        for row in dataset_rows:
-            csv_writer.writerow(row)
-
-    # Plot histogram of reflectance coverage per tile
-    plot_histogram(np.array(reflectance_coverage), "reflectance_coverage_" + start_date_string + ".png")
+                # Skip reflectance files that were processed before from the same inputs (inputs are
+                # only hashed for incremental builds, since hashing reads every raw file)
+                unit = cover_file + "/" + reflectance_file
+                unit_inputs_hash = None
+                if INCREMENTAL:
+                    unit_inputs_hash = build_state.inputs_hash(
+                        [os.path.join(COVER_DIR, cover_file), os.path.join(REFLECTANCE_DIR, reflectance_file), FLDAS_FILE, SIF_FILE],
+                        params=[str(DATE_RANGE.date[0]), str(DATE_RANGE.date[-1]), FLDAS_VARS, COVERS_TO_MASK,
+                                SIF_TILE_DEGREE_SIZE, MAX_MISSING_REFLECTANCE])
+                    if not build_state.needs_build(unit, unit_inputs_hash):
+                        print('Skipping reflectance file', reflectance_file, '(inputs unchanged)')
+                        continue
+                unit_outputs = build_state.start_unit(unit, unit_inputs_hash)
+                partial_csv_file = os.path.join(PARTIAL_METADATA_DIR, os.path.splitext(cover_file)[0] + "_" +
+                                                os.path.splitext(reflectance_file)[0] + ".csv")
+                units.append((cover_file, reflectance_file, partial_csv_file, unit_outputs))
+
+        # Everything process_reflectance_file needs for this date range
+        date_range_inputs = {'cover_dir': COVER_DIR, 'reflectance_dir': REFLECTANCE_DIR, 'output_tiles_dir': OUTPUT_TILES_DIR,
+                             'start_date_string': start_date_string, 'fldas_dataset': fldas_dataset, 'fldas_vars': FLDAS_VARS,
+                             'tropomi_sifs': tropomi_sifs, 'tropomi_cloud_fraction': tropomi_cloud_fraction, 'tropomi_n': tropomi_n}
+
+        # Process the units, in worker processes if NUM_WORKERS > 1. Each worker receives the inputs
+        # of the date range through its initializer, so any start method works.
+        executor = None
+        if NUM_WORKERS > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(NUM_WORKERS, initializer=init_worker, initargs=(date_range_inputs,))
+            futures = [executor.submit(process_reflectance_file_in_worker, cover_file, reflectance_file, partial_csv_file)
+                       for cover_file, reflectance_file, partial_csv_file, _ in units]
+        for unit_idx, (cover_file, reflectance_file, partial_csv_file, unit_outputs) in enumerate(units):
+            try:
+                if executor is not None:
+                    unit_coverage, tile_filenames = futures[unit_idx].result()
+                else:
+                    unit_coverage, tile_filenames = process_reflectance_file(date_range_inputs, cover_file, reflectance_file, partial_csv_file)
+            except (Exception, SystemExit) as error:
+                print("Reading reflectance file", reflectance_file, "failed")
+                print(traceback.format_exc())
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                exit(1)
+            reflectance_coverage.extend(unit_coverage)
+            for tile_filename in tile_filenames:
+                manifest_writer.add(tile_filename)
+            unit_outputs.extend(tile_filenames)
+        if executor is not None:
+            executor.shutdown()
+
+        # Merge the partial metadata files in unit order, so that the rows are in the same order
+        # whatever the number of workers.
+        # Dataset format: lon/lat, date, image file name, SIF
+        dataset_rows = []
+        for _, _, partial_csv_file, _ in units:
+            with open(partial_csv_file) as partial_file:
+                dataset_rows.extend(csv.reader(partial_file))
+            os.remove(partial_csv_file)
+
+        if INCREMENTAL:
+            # Replace the rows of rebuilt tiles in the existing .csv, and keep all other rows
+            # (the rows read from the partial files are strings)
+            new_metadata = pd.DataFrame(dataset_rows, columns=SIF_TILE_COLUMNS)
+            new_metadata = new_metadata.astype({column: float for column in SIF_TILE_COLUMNS if column not in ['date', 'tile_file']})
+            metadata = build_state.merge_metadata(incremental_build.read_previous_metadata(OUTPUT_CSV_FILE), new_metadata)
+            metadata.to_csv(OUTPUT_CSV_FILE, index=False)
+            manifest_writer.write(tile_manifest.manifest_file(OUTPUT_CSV_FILE), files=metadata['tile_file'], append=True)
+        else:
+            # If APPEND is true, we're appending rows to an existing .csv.
+            # Otherwise, we're overwriting.
+            if APPEND:
+                mode = "a+"
+            else:
+                mode = "w"
+
+            # Write information about each tile to the output csv file
+            with open(OUTPUT_CSV_FILE, mode) as output_csv_file:
+                csv_writer = csv.writer(output_csv_file, delimiter=",", quoting=csv.QUOTE_MINIMAL)
+                if not APPEND:
+                    csv_writer.writerow(SIF_TILE_COLUMNS)
+                for row in dataset_rows:
+                    csv_writer.writerow(row)
+            manifest_writer.write(tile_manifest.manifest_file(OUTPUT_CSV_FILE), append=APPEND)
+        build_state.save()
+
+        # Plot histogram of reflectance coverage per tile
+        plot_histogram(np.array(reflectance_coverage), "reflectance_coverage_" + start_date_string + ".png")
 
 
                         # ============================ OLD CODE ============================
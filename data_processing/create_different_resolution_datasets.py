@@ -1,11 +1,20 @@
 """
 Downsample fine-resolution CFIS SIF (30m) to various resolutions 
 (e.g. 30, 90, 150, 300, 600m) for experimentation
+
+Each tile (and its fine SIF/soundings) is read once, and all resolutions are computed from it:
+band averages with sif_utils.compute_block_band_averages, and SIF/soundings from summed-area
+tables (see sif_utils.summed_area_table), so every resolution's subregion averages are a few
+array operations. The slow loop-based downsampling
+(sif_utils.downsample_sif_for_loop / compute_band_averages) is only run on a random sample of
+VERIFY_FRACTION of the tiles, as a check.
 """
 import numpy as np
 import os
 import pandas as pd
+import metadata_store
 import sif_utils
+import tile_storage
 import time
 import torch
 
@@ -32,54 +41,89 @@ TILE_SIZE_PIXELS = 100  # Size of output tile, in Landsat pixels
 TILE_SIZE_DEGREES = TILE_SIZE_PIXELS * RES_DEGREES[0]
 MISSING_REFLECTANCE_IDX = -1
 
+VERIFY_FRACTION = 0.01  # Fraction of tiles to double-check against the loop-based method
+VERIFY_SEED = 0
+
+
+def compute_pyramid(input_tile, fine_sif, valid_sif_mask, fine_soundings, resolutions_pixels):
+    """
+    For each resolution (in pixels), computes (band averages, SIF, fraction valid, num soundings)
+    of every subregion, as arrays of shape (# channels x H x W) and (H x W). Band averages are over
+    pixels with valid SIF, except for the missing-reflectance band, which is averaged over all pixels.
+    Subregions with no valid pixels have NaN averages and SIF.
+    """
+    valid = valid_sif_mask.astype(np.float64)
+    valid_sat = sif_utils.summed_area_table(valid)
+    sif_sat = sif_utils.summed_area_table(np.where(valid_sif_mask, fine_sif, 0))
+    soundings_sat = sif_utils.summed_area_table(np.where(valid_sif_mask, fine_soundings, 0))
+
+    pyramid = dict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for resolution_pixels in resolutions_pixels:
+            num_valid = sif_utils.block_sums(valid_sat, resolution_pixels)
+            band_averages = sif_utils.compute_block_band_averages(input_tile, ~valid_sif_mask, resolution_pixels, MISSING_REFLECTANCE_IDX)
+            res_sifs = sif_utils.block_sums(sif_sat, resolution_pixels) / num_valid
+            fraction_valid = num_valid / (resolution_pixels ** 2)
+            res_soundings = sif_utils.block_sums(soundings_sat, resolution_pixels)
+            pyramid[resolution_pixels] = (band_averages, res_sifs, fraction_valid, res_soundings)
+    return pyramid
+
+
+def verify_pyramid(input_tile, fine_sif, valid_sif_mask, fine_soundings, pyramid):
+    """Checks "pyramid" (see compute_pyramid) against the loop-based downsampling."""
+    for resolution_pixels, (band_averages, res_sifs, fraction_valid, res_soundings) in pyramid.items():
+        res_sifs_2, fraction_valid_2, res_soundings_2 = sif_utils.downsample_sif_for_loop(torch.tensor(fine_sif), torch.tensor(valid_sif_mask),
+                                                                                           torch.tensor(fine_soundings, dtype=torch.float),
+                                                                                           resolution_pixels)
+        for i, j in zip(*np.nonzero(fraction_valid > 0)):
+            assert abs(res_sifs[i, j] - res_sifs_2[i, j]) < 1e-5, 'methods should compute same sif'
+            assert abs(res_soundings[i, j] - res_soundings_2[i, j]) < 1e-5, 'methods should compute same num soundings'
+            assert abs(fraction_valid[i, j] - fraction_valid_2[i, j]) < 1e-5, 'methods should compute same fraction_valid'
+            input_subregion = input_tile[:, i*resolution_pixels:(i+1)*resolution_pixels,
+                                            j*resolution_pixels:(j+1)*resolution_pixels]
+            invalid_mask_subregion = ~valid_sif_mask[i*resolution_pixels:(i+1)*resolution_pixels,
+                                                     j*resolution_pixels:(j+1)*resolution_pixels]
+            average_input_features = sif_utils.compute_band_averages(input_subregion, invalid_mask_subregion)
+            assert np.allclose(band_averages[:, i, j], average_input_features, rtol=1e-4, atol=1e-5), 'methods should compute same band averages'
+
+
 # Read CFIS coarse metadata
-cfis_metadata = pd.read_csv(COARSE_AVERAGE_FILE) 
+cfis_metadata = metadata_store.read_metadata(COARSE_AVERAGE_FILE)
 
+res_metadata_writers = dict()
 for resolution_pixels in FINE_PIXELS_PER_COARSE:
     resolution_meters = str(30 * resolution_pixels)
-    res_metadata = []
     RES_AVERAGES_FILE = os.path.join(CFIS_DIR, 'cfis_metadata_' + resolution_meters + 'm.csv')
-    for idx, row in cfis_metadata.iterrows():
-        fine_sifs_numpy = np.load(row['fine_sif_file'], allow_pickle=True)
-        fine_soundings_numpy = np.load(row['fine_soundings_file'], allow_pickle=True)
-        input_tile = np.load(row['tile_file'], allow_pickle=True)
-        tile_max_lat = row['lat'] + (TILE_SIZE_DEGREES / 2)
-        tile_min_lon = row['lon'] - (TILE_SIZE_DEGREES / 2)
-
-        sif_array = torch.tensor(fine_sifs_numpy.data)
-        invalid_sif_mask = torch.tensor(fine_sifs_numpy.mask)
-        valid_sif_mask = torch.logical_not(invalid_sif_mask)
-        soundings_array = torch.tensor(fine_soundings_numpy)
-        before = time.time()
-        res_sifs, fraction_valid, res_soundings = sif_utils.downsample_sif(torch.unsqueeze(sif_array, 0),
-                                                                            torch.unsqueeze(valid_sif_mask, 0),
-                                                                            torch.unsqueeze(soundings_array, 0),
-                                                                            resolution_pixels)
-        res_sifs = torch.squeeze(res_sifs, 0)
-        fraction_valid = torch.squeeze(fraction_valid, 0)
-        res_soundings = torch.squeeze(res_soundings, 0)
-        before = time.time()
-        res_sifs_2, fraction_valid_2, res_soundings_2 = sif_utils.downsample_sif_for_loop(sif_array, valid_sif_mask, soundings_array, resolution_pixels)
-
-        for i in range(res_sifs.shape[0]):
-            for j in range(res_sifs.shape[1]):
-                if fraction_valid[i, j] <= 0:
-                    continue
-                assert abs(res_sifs[i, j].item() - res_sifs_2[i, j]) < 1e-5, 'methods should compute same sif'
-                assert abs(res_soundings[i, j].item() - res_soundings_2[i, j]) < 1e-5, 'methods should compute same num soundings'
-                assert abs(fraction_valid[i, j].item() - fraction_valid_2[i, j]) < 1e-5, 'methods should compute same fraction_valid'
-                input_subregion = input_tile[:, i*resolution_pixels:(i+1)*resolution_pixels,
-                                                j*resolution_pixels:(j+1)*resolution_pixels]
-                invalid_mask_subregion = invalid_sif_mask[i*resolution_pixels:(i+1)*resolution_pixels,
-                                                          j*resolution_pixels:(j+1)*resolution_pixels]
-                average_input_features = sif_utils.compute_band_averages(input_subregion, invalid_mask_subregion)
-                subregion_lat = tile_max_lat - RES_DEGREES[0] * resolution_pixels * (i + 0.5)
-                subregion_lon = tile_min_lon + RES_DEGREES[1] * resolution_pixels * (j + 0.5)
-                subregion_sif = res_sifs[i, j]
-                subregion_row = [row['fold'], row['grid_fold'], subregion_lon, subregion_lat, row['date'], row['tile_file']] + average_input_features.tolist() + \
-                                [res_sifs[i, j].item(), round(res_soundings[i, j].item(), 1), row['SIF'], fraction_valid[i, j].item()]
-                res_metadata.append(subregion_row)
-    res_df = pd.DataFrame(res_metadata, columns=RES_AVERAGE_COLUMNS)
-    res_df.to_csv(RES_AVERAGES_FILE)
+    res_metadata_writers[resolution_pixels] = (RES_AVERAGES_FILE, metadata_store.MetadataWriter(RES_AVERAGES_FILE, RES_AVERAGE_COLUMNS))
+
+verify_rng = np.random.default_rng(VERIFY_SEED)
+num_verified = 0
+before = time.time()
+for tile_count, (_, row) in enumerate(cfis_metadata.iterrows()):
+    fine_sif, fine_sif_mask, fine_soundings = tile_storage.load_fine_sif_labels(row['fine_sif_file'], row.get('fine_soundings_file'))
+    input_tile = tile_storage.load_tile(row['tile_file'])
+    tile_max_lat = row['lat'] + (TILE_SIZE_DEGREES / 2)
+    tile_min_lon = row['lon'] - (TILE_SIZE_DEGREES / 2)
+    valid_sif_mask = np.logical_not(fine_sif_mask)
+    pyramid = compute_pyramid(input_tile, fine_sif, valid_sif_mask, fine_soundings, FINE_PIXELS_PER_COARSE)
+    if verify_rng.random() < VERIFY_FRACTION:
+        verify_pyramid(input_tile, fine_sif, valid_sif_mask, fine_soundings, pyramid)
+        num_verified += 1
 
+    for resolution_pixels, (band_averages, res_sifs, fraction_valid, res_soundings) in pyramid.items():
+        rows, cols = np.nonzero(fraction_valid > 0)
+        subregions = {'fold': row['fold'], 'grid_fold': row['grid_fold'],
+                      'lon': tile_min_lon + RES_DEGREES[1] * resolution_pixels * (cols + 0.5),
+                      'lat': tile_max_lat - RES_DEGREES[0] * resolution_pixels * (rows + 0.5),
+                      'date': row['date'], 'tile_file': row['tile_file'],
+                      'SIF': res_sifs[rows, cols], 'num_soundings': np.round(res_soundings[rows, cols], 1),
+                      'coarse_sif': row['SIF'], 'fraction_valid': fraction_valid[rows, cols]}
+        for band_idx, column in enumerate(RES_AVERAGE_COLUMNS[6:-4]):
+            subregions[column] = band_averages[band_idx, rows, cols]
+        res_metadata_writers[resolution_pixels][1].append(subregions)
+    if tile_count % 1000 == 0:
+        print('Processed', tile_count, 'tiles (' + str(round(time.time() - before, 1)) + ' seconds)')
+print('Verified', num_verified, 'tiles against the loop-based method')
 
+for res_averages_file, res_metadata_writer in res_metadata_writers.values():
+    metadata_store.write_metadata(res_metadata_writer.to_dataframe(), res_averages_file)
@@ -0,0 +1,113 @@
+"""
+Builds a chunked reflectance mosaic for each date (see "Reflectance mosaic" in tile_storage.py)
+from the 0.1-degree reflectance tiles, with chunks aligned to the CFIS/OCO-2 tile grid used by
+create_cfis_grid.py. create_cfis_grid.py then reads each tile as a single chunk, instead of
+loading and concatenating up to four whole reflectance tiles.
+
+Each chunk is extracted with sif_utils.extract_input_subtile, so a chunk contains exactly the
+pixels that create_cfis_grid.py would have extracted for a tile in the same position.
+"""
+import glob
+import math
+import os
+import re
+import xarray as xr
+
+import sif_utils
+import tile_storage
+
+DATA_DIR = "/mnt/beegfs/bulk/mirror/jyf6/datasets/SIF"
+RAW_OCO2_DIR = os.path.join(DATA_DIR, "raw_data/SIF_OCO2")
+DATES = ["2016-06-15", "2016-08-01"]
+OCO2_FILES = [os.path.join(RAW_OCO2_DIR, "oco2_20160615_20160629_3km.nc"),
+              os.path.join(RAW_OCO2_DIR, "oco2_20160801_20160816_3km.nc")]
+
+# Must match create_cfis_grid.py
+LEFT_BOUND = -108
+TOP_BOUND = 48.7
+RES = (0.00026949458523585647, 0.00026949458523585647)  # Degrees per Landsat pixel
+TILE_SIZE_PIXELS = 100  # Size of CFIS/OCO-2 tile (and mosaic chunk), in Landsat pixels
+TILE_SIZE_DEGREES = TILE_SIZE_PIXELS * RES[0]
+REFLECTANCE_PIXELS = 371
+
+# Memory budget for reflectance tiles kept in memory (dense tiles are about 24 MB). Chunks are
+# processed grouped by the reflectance tile containing their top-left corner, so each group needs
+# at most 4 reflectance tiles.
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+
+REFLECTANCE_FILE_REGEX = re.compile(r'reflectance_lat_(-?[\d.]+)_lon_(-?[\d.]+)\.np[yz]$')
+
+for date_idx, DATE in enumerate(DATES):
+    INPUT_TILES_DIR = os.path.join(DATA_DIR, "tiles/tiles_" + DATE)
+    MOSAIC_DIR = os.path.join(DATA_DIR, "tiles/reflectance_mosaic_" + DATE)
+
+    # Start the chunk grid at the upper-left corner of the OCO-2 grid (computed as in create_cfis_grid.py)
+    dataset = xr.open_dataset(OCO2_FILES[date_idx])
+    oco2_grid_top_degrees = dataset.lat.values[0] + TILE_SIZE_DEGREES / 2
+    oco2_grid_left_degrees = dataset.lon.values[0] - TILE_SIZE_DEGREES / 2
+    oco2_grid_top_idx, oco2_grid_left_idx = sif_utils.lat_long_to_index(oco2_grid_top_degrees, oco2_grid_left_degrees, TOP_BOUND, LEFT_BOUND, RES)
+    origin_row = oco2_grid_top_idx % TILE_SIZE_PIXELS
+    origin_col = oco2_grid_left_idx % TILE_SIZE_PIXELS
+
+    # Lat/lon bounds of a chunk (computed the same way as tile bounds in create_cfis_grid.py)
+    def chunk_bounds(chunk):
+        chunk_max_lat = TOP_BOUND - ((origin_row + chunk[0] * TILE_SIZE_PIXELS) * RES[0])
+        chunk_min_lat = chunk_max_lat - (TILE_SIZE_PIXELS * RES[0])
+        chunk_min_lon = LEFT_BOUND + ((origin_col + chunk[1] * TILE_SIZE_PIXELS) * RES[1])
+        chunk_max_lon = chunk_min_lon + (TILE_SIZE_PIXELS * RES[1])
+        return chunk_min_lon, chunk_max_lon, chunk_min_lat, chunk_max_lat
+
+    # Find candidate chunks near each reflectance tile. (Region indices of neighbouring tiles can
+    # be 371 or 372 pixels apart, so include one extra pixel on the bottom/right.)
+    existing_tile_names = set()
+    candidate_chunks = set()
+    for reflectance_file in glob.glob(os.path.join(INPUT_TILES_DIR, "reflectance_lat_*_lon_*.np[yz]")):
+        match = REFLECTANCE_FILE_REGEX.search(os.path.basename(reflectance_file))
+        if match is None:
+            continue
+        existing_tile_names.add(os.path.splitext(reflectance_file)[0])
+        file_top_lat = float(match.group(1)) + 0.05
+        file_left_lon = float(match.group(2)) - 0.05
+        file_top_idx, file_left_idx = sif_utils.lat_long_to_index(file_top_lat, file_left_lon, TOP_BOUND, LEFT_BOUND, RES)
+        for chunk_row in range((file_top_idx - origin_row) // TILE_SIZE_PIXELS,
+                               (file_top_idx + REFLECTANCE_PIXELS - origin_row) // TILE_SIZE_PIXELS + 1):
+            for chunk_col in range((file_left_idx - origin_col) // TILE_SIZE_PIXELS,
+                                   (file_left_idx + REFLECTANCE_PIXELS - origin_col) // TILE_SIZE_PIXELS + 1):
+                candidate_chunks.add((chunk_row, chunk_col))
+
+    # Only keep chunks for which extract_input_subtile would find at least one reflectance file
+    chunks = set()
+    for chunk in candidate_chunks:
+        large_tile_names = sif_utils.reflectance_tile_names(*chunk_bounds(chunk), INPUT_TILES_DIR)
+        if any(name in existing_tile_names for column in large_tile_names for name in column):
+            chunks.add(chunk)
+    if len(chunks) == 0:
+        print('No reflectance tiles found in', INPUT_TILES_DIR)
+        continue
+
+    # Group chunks by the reflectance tile containing their top-left corner
+    def reflectance_tile_key(chunk):
+        chunk_min_lon, _, _, chunk_max_lat = chunk_bounds(chunk)
+        return (-math.ceil(chunk_max_lat * 10), math.floor(chunk_min_lon * 10), chunk[0], chunk[1])
+    chunks = sorted(chunks, key=reflectance_tile_key)
+    print(DATE, '- number of chunks:', len(chunks))
+
+    mosaic = tile_storage.create_reflectance_mosaic(MOSAIC_DIR, chunks, TILE_SIZE_PIXELS, origin_row, origin_col,
+                                                    TOP_BOUND, LEFT_BOUND, RES)
+    load_reflectance_tile = tile_storage.TileCache(TILE_CACHE_BYTES)
+    for offset, chunk in enumerate(chunks):
+        chunk_min_lon, chunk_max_lon, chunk_min_lat, chunk_max_lat = chunk_bounds(chunk)
+        chunk_tile = sif_utils.extract_input_subtile(chunk_min_lon, chunk_max_lon, chunk_min_lat, chunk_max_lat,
+                                                     INPUT_TILES_DIR, TILE_SIZE_PIXELS, RES,
+                                                     tile_loader=load_reflectance_tile)
+        assert chunk_tile is not None
+        packed_chunk = tile_storage.pack_tile(chunk_tile)
+        for array_name in tile_storage.MOSAIC_ARRAYS:
+            mosaic[array_name][offset] = packed_chunk[array_name]
+        if offset % 10000 == 0:
+            print('Wrote', offset, 'chunks')
+
+    load_reflectance_tile.print_stats()
+    for array in mosaic.values():
+        array.flush()
+    print('Wrote mosaic', MOSAIC_DIR)
@@ -0,0 +1,98 @@
+"""
+Packs every input tile (and fine SIF label) referenced by the CFIS/OCO-2 metadata files into a
+few large memory-mapped arrays (see "Tile shards" in tile_storage.py), so that datasets can read
+tiles as slices of the shards, instead of opening several small files per sample.
+
+If QUANTIZE_CONTINUOUS_BANDS is True, the continuous bands are stored as int16, using the band
+statistics of the train set (see "Quantized continuous bands" in tile_storage.py). This halves the
+size of the shards; run data_processing/validate_quantization.py afterwards to check the error.
+"""
+import os
+import pandas as pd
+
+import tile_manifest
+import tile_storage
+
+DATA_DIR = "/mnt/beegfs/bulk/mirror/jyf6/datasets/SIF"
+METADATA_DIR = os.path.join(DATA_DIR, "metadata/CFIS_OCO2_dataset")
+CFIS_COARSE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_coarse_metadata.csv')
+OCO2_METADATA_FILE = os.path.join(METADATA_DIR, 'oco2_metadata.csv')
+METADATA_FILES = [CFIS_COARSE_METADATA_FILE, OCO2_METADATA_FILE]
+BAND_STATISTICS_FILE = os.path.join(METADATA_DIR, 'cfis_band_statistics_train.csv')
+SHARD_DIR = os.path.join(DATA_DIR, "tiles/shards_CFIS_OCO2")
+QUANTIZE_CONTINUOUS_BANDS = False
+
+# Read metadata files
+all_metadata = [pd.read_csv(metadata_file) for metadata_file in METADATA_FILES]
+
+# Assign each distinct tile (and each distinct fine SIF file) an offset in the shards.
+# CFIS and OCO-2 rows can refer to the same tile file, which is only stored once.
+# Old datasets also have a fine soundings file for each fine SIF file (only needed to read
+# old, pickled fine SIF files).
+tile_file_to_offset = dict()
+fine_sif_file_to_offset = dict()
+fine_sif_file_to_soundings_file = dict()
+for metadata in all_metadata:
+    for tile_file in metadata['tile_file']:
+        if tile_file not in tile_file_to_offset:
+            tile_file_to_offset[tile_file] = len(tile_file_to_offset)
+    if 'fine_sif_file' in metadata.columns:
+        for row in metadata.to_dict('records'):
+            if row['fine_sif_file'] not in fine_sif_file_to_offset:
+                fine_sif_file_to_offset[row['fine_sif_file']] = len(fine_sif_file_to_offset)
+                fine_sif_file_to_soundings_file[row['fine_sif_file']] = row.get('fine_soundings_file')
+print('Number of tiles:', len(tile_file_to_offset))
+print('Number of fine SIF tiles:', len(fine_sif_file_to_offset))
+if len(tile_file_to_offset) == 0:
+    print('No tiles found in metadata files')
+    exit(1)
+
+quantization = None
+if QUANTIZE_CONTINUOUS_BANDS:
+    quantization = tile_storage.read_quantization_params(BAND_STATISTICS_FILE)
+
+# All tiles must have the same shape
+first_tile = tile_storage.load_tile(next(iter(tile_file_to_offset)))
+height, width = first_tile.shape[1:]
+shards = tile_storage.create_tile_shards(SHARD_DIR, len(tile_file_to_offset), len(fine_sif_file_to_offset), height, width,
+                                         quantization=quantization)
+
+# Copy tiles into shards
+for tile_file, tile_offset in tile_file_to_offset.items():
+    packed_tile = tile_storage.pack_tile(tile_storage.load_tile(tile_file), quantization=quantization)
+    if quantization is None:
+        shards['tiles_continuous'][tile_offset] = packed_tile['continuous']
+    else:
+        shards['tiles_continuous'][tile_offset] = packed_tile['continuous_quantized']
+    shards['tiles_cover_class'][tile_offset] = packed_tile['cover_class']
+    shards['tiles_missing_reflectance'][tile_offset] = packed_tile['missing_reflectance']
+    if tile_offset % 1000 == 0:
+        print('Copied', tile_offset, 'tiles')
+
+# Copy fine SIF labels into shards
+for fine_sif_file, label_offset in fine_sif_file_to_offset.items():
+    fine_sif, fine_sif_mask, fine_soundings = tile_storage.load_fine_sif_labels(fine_sif_file, fine_sif_file_to_soundings_file[fine_sif_file])
+    shards['fine_sif_labels'][label_offset] = tile_storage.pack_fine_sif_labels(fine_sif, fine_sif_mask, fine_soundings)[0]
+
+for shard in shards.values():
+    shard.flush()
+
+# Write a manifest of the shard arrays (see tile_manifest.py)
+manifest_writer = tile_manifest.ManifestWriter('create_tile_shards')
+for array_name in tile_storage.TILE_SHARD_ARRAYS + tile_storage.FINE_SIF_SHARD_ARRAYS:
+    manifest_writer.add(tile_storage.shard_array_file(SHARD_DIR, array_name))
+if quantization is not None:
+    manifest_writer.add(tile_storage.shard_array_file(SHARD_DIR, 'continuous_scale'))
+    manifest_writer.add(tile_storage.shard_array_file(SHARD_DIR, 'continuous_offset'))
+manifest_writer.write(tile_manifest.shard_manifest_file(SHARD_DIR))
+
+# For each metadata file, write the mapping from metadata row to shard offsets
+for metadata_file, metadata in zip(METADATA_FILES, all_metadata):
+    shard_index = pd.DataFrame({'tile_file': metadata['tile_file'].values,
+                                'tile_offset': [tile_file_to_offset[tile_file] for tile_file in metadata['tile_file']]})
+    if 'fine_sif_file' in metadata.columns:
+        shard_index['label_offset'] = [fine_sif_file_to_offset[fine_sif_file] for fine_sif_file in metadata['fine_sif_file']]
+    else:
+        shard_index['label_offset'] = -1
+    shard_index.to_csv(tile_storage.shard_index_file(SHARD_DIR, metadata_file), index=False)
+    print('Wrote shard index for', metadata_file)
@@ -6,6 +6,7 @@ import copy
 import csv
 import pickle
 import math
+import multiprocessing
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -24,7 +25,9 @@ import torch.optim as optim
 from reflectance_cover_sif_dataset import ReflectanceCoverSIFDataset
 from subtile_embedding_dataset import SubtileEmbeddingDataset
 
+import band_statistics
 import sif_utils
+import tile_storage
 import tile_transforms
 
 
@@ -41,6 +44,8 @@ INFO_FILE_TRAIN = os.path.join(DATASET_DIR, "tile_info_train.csv")
 BAND_STATISTICS_FILE = os.path.join(DATASET_DIR, "band_statistics_train.csv")
 PIXEL_STATISTICS_FILE = os.path.join(DATASET_DIR, "band_statistics_pixels.csv")
 MISSING_REFLECTANCE_IDX = -1
+PLOT_DIR = "/mnt/beegfs/bulk/mirror/jyf6/datasets/SIF/exploratory_plots"
+NUM_WORKERS = 8
 
 # INFO_FILE_CFIS = os.path.join(DATASET_DIR, "cfis_subtiles_filtered.csv")
 
@@ -68,62 +73,41 @@ sif_mean = train_means[-1]
 band_stds = train_stds[:-1]
 sif_std = train_stds[-1]
 
-# Read all large tile files, extract pixel values
-pixel_arrays = []
-sum_squared_differences = np.zeros_like(band_means)  # For each band, keep track of the sum of squared differences from mean
-i = 0
-total_pixels = 0
-for large_tile_file in train_metadata['tile_file']:
-    tile = np.load(large_tile_file)
 
-    # Compute averages of each band (over non-cloudy pixels)
-    # Reshape tile into a list of pixels (pixels x channels)
-    pixels = np.moveaxis(tile, 0, -1)
-    pixels = pixels.reshape((-1, pixels.shape[2]))
-
-    # NOTE: Exclude missing (cloudy) pixels
+def read_pixel_values(large_tile_file):
+    """Returns the values of the non-cloudy pixels of a tile (with NaN SIF, which is only known per tile)."""
+    tile = tile_storage.load_tile(large_tile_file)
+    pixels = tile.reshape((tile.shape[0], -1)).T
     pixels_with_data = pixels[pixels[:, MISSING_REFLECTANCE_IDX] == 0]
-
-    # Remove tiles where no pixels have data (it's completely covered by clouds)
-    num_pixels_with_data = pixels_with_data.shape[0]
-    if num_pixels_with_data == 0:
-        continue
-    total_pixels += num_pixels_with_data
-
-    # Compute squared differences from mean
-    squared_differences = (pixels_with_data - band_means) ** 2
-    sum_squared_differences += np.sum(squared_differences, axis=0)
-
-    # Sample some pixels for plotting purposes
-    num_pixels_to_sample = math.ceil(num_pixels_with_data / 1000)
-    random_indices = np.random.choice(num_pixels_with_data, num_pixels_to_sample)
-    pixel_arrays.append(pixels_with_data[random_indices, :])
-
-    # Compute average of the reflectance, over the non-cloudy pixels
-    # reflectance_averages = np.mean(pixels_with_data[:, REFLECTANCE_BANDS], axis=0)
-    # tile_averages[REFLECTANCE_BANDS] = reflectance_averages
-    # pixel_arrays.append(pixels)
-    i += 1
-    if i % 100 == 0:
-        print('large tile', i)
-
-# Compute standard deviation of pixels for each band, and write those statistics to a file
-pixels_stds = np.sqrt(sum_squared_differences / total_pixels)
-pixels_stds = np.append(pixels_stds, sif_std)
-train_statistics['std'] = pixels_stds
-print('New pixel statistics', train_statistics)
-train_statistics.to_csv(PIXEL_STATISTICS_FILE)
-
-# Combine all sampled pixels into an array, for plotting
-pixel_values = np.concatenate(pixel_arrays, axis=0)
-
-# Plot histograms
+    return (np.column_stack((pixels_with_data, np.full(len(pixels_with_data), np.nan))),)
+
+
+def plot_band_histogram(counts, edges, plot_filename, title):
+    plt.stairs(counts, edges, fill=True, facecolor='blue', alpha=0.5)
+    plt.title(title)
+    plt.savefig(os.path.join(PLOT_DIR, plot_filename))
+    plt.close()
+
+
+# Summarize the pixels of all large tiles in one pass (in worker processes forked so that they
+# share the globals above), and write the pixel-level statistics to a file: the tile-level mean,
+# and the deviation of the pixels from it (see band_statistics.py).
+pixel_statistics, = band_statistics.compute_statistics(train_metadata['tile_file'], read_pixel_values,
+                                                       train_statistics.index, num_workers=NUM_WORKERS,
+                                                       mp_context=multiprocessing.get_context("fork"))
+print('Number of pixels with data:', pixel_statistics.count[0])
+pixel_statistics_df = band_statistics.pixel_statistics_dataframe(pixel_statistics, train_means, train_stds)
+pixels_stds = pixel_statistics_df['std'].to_numpy()
+print('New pixel statistics', pixel_statistics_df)
+pixel_statistics_df.to_csv(PIXEL_STATISTICS_FILE, index=False)
+pixel_statistics.write_histograms(band_statistics.histogram_file(PIXEL_STATISTICS_FILE))
+
+# Plot histograms of the pixel values (raw, and standardized by the tile-level and pixel-level std)
 for idx, column in enumerate(COLUMNS):
-    sif_utils.plot_histogram(pixel_values[:, idx], "pixels_histogram_" + column + "_train_tropomi.png", title=column + ' (TROPOMI pixels)')
-    standardized_pixel_values = (pixel_values[:, idx] - band_means[idx]) / band_stds[idx]
-    sif_utils.plot_histogram(standardized_pixel_values, "pixels_histogram_" + column + "_train_tropomi_std.png", title=column + ' (TROPOMI pixels, std. by tile std dev)')
-    standardized_pixel_values_by_pixel_std = (pixel_values[:, idx] - band_means[idx]) / pixels_stds[idx]
-    sif_utils.plot_histogram(standardized_pixel_values_by_pixel_std, "pixels_histogram_" + column + "_train_tropomi_pixel_std.png", title=column + ' (TROPOMI pixels, std. by pixel std dev)')
+    counts, edges = pixel_statistics.histogram(idx)
+    plot_band_histogram(counts, edges, "pixels_histogram_" + column + "_train_tropomi.png", title=column + ' (TROPOMI pixels)')
+    plot_band_histogram(counts, (edges - band_means[idx]) / band_stds[idx], "pixels_histogram_" + column + "_train_tropomi_std.png", title=column + ' (TROPOMI pixels, std. by tile std dev)')
+    plot_band_histogram(counts, (edges - band_means[idx]) / pixels_stds[idx], "pixels_histogram_" + column + "_train_tropomi_pixel_std.png", title=column + ' (TROPOMI pixels, std. by pixel std dev)')
 
 
 # # Read through CFIS subtiles, extract pixel values
@@ -0,0 +1,66 @@
+"""
+Checks tile shards with quantized continuous bands (created by create_tile_shards.py with
+QUANTIZE_CONTINUOUS_BANDS = True) against the original tile files. For each continuous band,
+reports the maximum error after standardization (in units of the band's standard deviation),
+both before and after clipping to [MIN_INPUT, MAX_INPUT] (as ClipTile does in training), and how
+many values were saturated.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+import tile_storage
+
+DATA_DIR = "/mnt/beegfs/bulk/mirror/jyf6/datasets/SIF"
+METADATA_DIR = os.path.join(DATA_DIR, "metadata/CFIS_OCO2_dataset")
+CFIS_COARSE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_coarse_metadata.csv')
+OCO2_METADATA_FILE = os.path.join(METADATA_DIR, 'oco2_metadata.csv')
+METADATA_FILES = [CFIS_COARSE_METADATA_FILE, OCO2_METADATA_FILE]
+BAND_STATISTICS_FILE = os.path.join(METADATA_DIR, 'cfis_band_statistics_train.csv')
+SHARD_DIR = os.path.join(DATA_DIR, "tiles/shards_CFIS_OCO2")
+MIN_INPUT = -3
+MAX_INPUT = 3
+MAX_TILES_TO_CHECK = None  # If set, only check a random sample of this many tiles
+
+# Allowance for float32 rounding when dequantizing
+FLOAT32_TOLERANCE = 1e-5
+
+# Read band statistics (for standardization)
+band_statistics = pd.read_csv(BAND_STATISTICS_FILE)
+band_means = band_statistics['mean'].values[tile_storage.CONTINUOUS_BANDS, np.newaxis, np.newaxis]
+band_stds = band_statistics['std'].values[tile_storage.CONTINUOUS_BANDS, np.newaxis, np.newaxis]
+
+# Find all tiles stored in the shards
+shard_indices = [pd.read_csv(tile_storage.shard_index_file(SHARD_DIR, metadata_file)) for metadata_file in METADATA_FILES]
+tiles = pd.concat(shard_indices)[['tile_file', 'tile_offset']].drop_duplicates()
+if MAX_TILES_TO_CHECK is not None and len(tiles) > MAX_TILES_TO_CHECK:
+    tiles = tiles.sample(n=MAX_TILES_TO_CHECK, random_state=0)
+print('Checking', len(tiles), 'tiles')
+
+tile_store = tile_storage.TileShardStore(SHARD_DIR)
+num_bands = len(tile_storage.CONTINUOUS_BANDS)
+max_error = np.zeros(num_bands)
+max_clipped_error = np.zeros(num_bands)
+num_saturated = np.zeros(num_bands, dtype=int)
+num_values = 0
+for tile_file, tile_offset in zip(tiles['tile_file'], tiles['tile_offset']):
+    packed_tile = tile_store.read_packed_tile(tile_offset)
+    if 'continuous_quantized' not in packed_tile:
+        print('Shards in', SHARD_DIR, 'are not quantized')
+        exit(1)
+    original = (tile_storage.load_tile(tile_file)[tile_storage.CONTINUOUS_BANDS] - band_means) / band_stds
+    dequantized = (tile_storage.unpack_continuous(packed_tile) - band_means) / band_stds
+    max_error = np.maximum(max_error, np.max(np.abs(original - dequantized), axis=(1, 2)))
+    max_clipped_error = np.maximum(max_clipped_error, np.max(np.abs(np.clip(original, MIN_INPUT, MAX_INPUT) -
+                                                                    np.clip(dequantized, MIN_INPUT, MAX_INPUT)), axis=(1, 2)))
+    num_saturated += np.sum(np.abs(packed_tile['continuous_quantized']) == tile_storage.QUANTIZED_MAX, axis=(1, 2))
+    num_values += original.shape[1] * original.shape[2]
+
+print('Error bound (std devs, non-saturated values):', tile_storage.MAX_QUANTIZATION_ERROR_STDS)
+for i, band in enumerate(tile_storage.CONTINUOUS_BANDS):
+    print('Band', band, '- max error:', max_error[i], '- max error after clipping:', max_clipped_error[i],
+          '- saturated:', num_saturated[i], '/', num_values)
+if np.max(max_clipped_error) > tile_storage.MAX_QUANTIZATION_ERROR_STDS + FLOAT32_TOLERANCE:
+    print('Quantization error after clipping exceeds the bound!')
+    exit(1)
+print('OK')
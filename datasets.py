@@ -1,14 +1,22 @@
 from __future__ import print_function, division
+import collections
+import concurrent.futures
+import hashlib
+import math
 import os
+import shutil
 import torch
 import pandas as pd
 from skimage import io, transform
 import numpy as np
 import numpy.ma as ma
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 from PIL import Image
 from torchvision import transforms
 import sif_utils
+import tile_storage
+import tile_transforms
 import time
 
 # Ignore warnings
@@ -42,58 +50,405 @@ class CombinedDataset(Dataset):
             batch[dataset_name] = dataset[dataset_idx]
         return batch
 
+    def __getitems__(self, indices):
+        batch = dict()
+        for dataset_name, dataset in self.datasets.items():
+            dataset_indices = [idx % len(dataset) for idx in indices]
+            if hasattr(dataset, '__getitems__'):
+                batch[dataset_name] = dataset.__getitems__(dataset_indices)
+            else:
+                batch[dataset_name] = default_collate([dataset[dataset_idx] for dataset_idx in dataset_indices])
+        return batch
+
+
+def collate_batch(batch):
+    """
+    collate_fn for DataLoaders over the datasets below. The DataLoader fetches each batch with the
+    dataset's __getitems__, which already returns a collated batch (a dict), so it is returned as is.
+    (Lists of samples, from datasets without __getitems__, are collated with default_collate.)
+    """
+    if isinstance(batch, dict):
+        return batch
+    return default_collate(batch)
+
+
+class _PassBatchSampler(Sampler):
+    """
+    Batch sampler yielding "num_batches" batches per iteration (epoch), taken from consecutive
+    passes over the dataset's "num_items" items (each pass in a new random order if "shuffle").
+    Each epoch continues from where the previous one stopped, so every item is used once before
+    any item is used again. A batch never spans two passes (the last batch of a pass may be smaller).
+
+    DataLoader workers draw batches ahead of their use, so the position only moves past a batch
+    when batch_consumed() is called (in the order the batches were drawn). An epoch that is not
+    used to the end continues from the first batch that was not consumed.
+    """
+    def __init__(self, num_items, batch_size, num_batches, shuffle=True, generator=None):
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.shuffle = shuffle
+        self.generator = generator
+        self.order = None
+        self.position = 0
+        self.drawn_positions = collections.deque()
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        order, position = self.order, self.position
+        self.drawn_positions = collections.deque()
+        for _ in range(self.num_batches):
+            if order is None or position >= self.num_items:
+                if self.shuffle:
+                    order = torch.randperm(self.num_items, generator=self.generator).tolist()
+                else:
+                    order = list(range(self.num_items))
+                position = 0
+            batch = order[position:position + self.batch_size]
+            position += len(batch)
+            self.drawn_positions.append((order, position))
+            yield batch
+
+    def batch_consumed(self):
+        """Moves the position past the oldest batch that was drawn but not consumed."""
+        self.order, self.position = self.drawn_positions.popleft()
+
+
+class MultiSourceDataLoader(object):
+    """
+    Loads batches from several datasets ("datasets" maps names to Datasets), where each batch comes
+    from a single dataset. Iterating over it yields {dataset name: batch} dicts with one entry (the
+    same format as batches of CombinedDataset). Each dataset has its own DataLoader (and its own
+    worker processes, "num_workers" split between datasets by their share of batches), so datasets
+    are read independently and no dataset's tiles are read more often than its batches need.
+
+    If "ratios" (dataset name -> weight) is given, an epoch has about "num_batches" batches,
+    split between datasets in proportion to their weights. By default, "num_batches" is the
+    largest number for which no dataset is read more than once per epoch. Datasets with weight 0
+    (or no weight) are still read exactly once per epoch, in addition, so that they can be scored
+    (the training loop does not update the model on them). Each dataset's batches continue from where its previous epoch stopped (see
+    _PassBatchSampler), so over several epochs every tile is used. If "ratios" is None, each
+    epoch goes through every dataset exactly once. If "shuffle", the order of tiles and of
+    datasets' batches is random (drawn from "generator").
+    """
+    def __init__(self, datasets, batch_size, ratios=None, num_batches=None, shuffle=True, num_workers=0,
+                 collate_fn=collate_batch, generator=None):
+        self.shuffle = shuffle
+        self.generator = generator
+        pass_batches = {name: math.ceil(len(dataset) / batch_size) for name, dataset in datasets.items() if len(dataset) > 0}
+        if ratios is None:
+            self.num_batches = pass_batches
+        else:
+            weights = {name: ratios.get(name, 0) for name in pass_batches if ratios.get(name, 0) > 0}
+            total_weight = sum(weights.values())
+            if len(weights) > 0 and num_batches is None:
+                num_batches = min(pass_batches[name] * total_weight / weight for name, weight in weights.items())
+            self.num_batches = dict()
+            for name in pass_batches:
+                if name in weights:
+                    self.num_batches[name] = max(1, int(round(num_batches * weights[name] / total_weight)))
+                else:
+                    self.num_batches[name] = pass_batches[name]
+
+        # Split the workers between datasets by their share of batches (largest remainders first),
+        # so that there are at most "num_workers" in total
+        total_batches = sum(self.num_batches.values())
+        worker_shares = {name: num_workers * dataset_batches / total_batches for name, dataset_batches in self.num_batches.items()}
+        dataset_workers = {name: int(share) for name, share in worker_shares.items()}
+        remaining_workers = num_workers - sum(dataset_workers.values())
+        for name in sorted(worker_shares, key=lambda name: worker_shares[name] - dataset_workers[name], reverse=True)[:remaining_workers]:
+            dataset_workers[name] += 1
+
+        self.samplers = dict()
+        self.loaders = dict()
+        for name, dataset_batches in self.num_batches.items():
+            self.samplers[name] = _PassBatchSampler(len(datasets[name]), batch_size, dataset_batches, shuffle=shuffle, generator=generator)
+            self.loaders[name] = DataLoader(datasets[name], batch_sampler=self.samplers[name], num_workers=dataset_workers[name],
+                                            collate_fn=collate_fn)
+
+    def __len__(self):
+        return sum(self.num_batches.values())
+
+    def _schedule(self):
+        # Order in which datasets' batches are returned
+        schedule = [name for name, dataset_batches in self.num_batches.items() for _ in range(dataset_batches)]
+        if self.shuffle:
+            schedule = [schedule[i] for i in torch.randperm(len(schedule), generator=self.generator).tolist()]
+        return schedule
+
+    def __iter__(self):
+        iterators = {name: iter(loader) for name, loader in self.loaders.items()}
+        for name in self._schedule():
+            batch = next(iterators[name])
+            self.samplers[name].batch_consumed()
+            yield {name: batch}
+
+
+def _collate_column(values):
+    # Collates the values of a metadata column as default_collate would collate them one sample at
+    # a time: numbers become a tensor, anything else (e.g. file names) a list
+    if values.dtype.kind in 'biuf':
+        return torch.as_tensor(values)
+    return values.tolist()
+
+
+def _metadata_arrays(tile_info, columns):
+    """
+    Returns the given columns of "tile_info" as a dict of NumPy arrays (one entry per row), which
+    datasets index directly instead of building a pandas row per sample. Only these arrays (not
+    the DataFrame) are then pickled into DataLoader workers. Numeric columns keep their dtype;
+    string columns (e.g. file names) become contiguous fixed-width string arrays.
+    """
+    arrays = dict()
+    for column in columns:
+        values = tile_info[column].to_numpy()
+        if values.dtype == object and all(isinstance(value, str) for value in values):
+            values = values.astype(str)
+        arrays[column] = values
+    return arrays
+
+
+def _metadata_value(value):
+    # Converts a value of a metadata array to the Python/NumPy scalar a pandas row would hold
+    if isinstance(value, np.str_):
+        return str(value)
+    return value
+
+
+def _batch_tile_tensors(batch, input_tiles, output_bands, multiplicative_noise_end_transform):
+    # Adds the "input_tile_without_mult_noise" and "input_tile" tensors of a batch of transformed tiles
+    if output_bands is None:
+        batch['input_tile_without_mult_noise'] = torch.tensor(input_tiles, dtype=torch.float)
+    else:
+        batch['input_tile_without_mult_noise'] = torch.tensor(input_tiles[:, output_bands], dtype=torch.float)
+    if multiplicative_noise_end_transform is not None:
+        input_tiles = tile_transforms.transform_batch(multiplicative_noise_end_transform, input_tiles)
+        if output_bands is None:
+            batch['input_tile'] = torch.tensor(input_tiles, dtype=torch.float)
+        else:
+            batch['input_tile'] = torch.tensor(input_tiles[:, output_bands], dtype=torch.float)
+    else:
+        batch['input_tile'] = batch['input_tile_without_mult_noise']
+    return batch
+
+
+def _band_projection(transform, multiplicative_noise_end_transform, bands, num_label_bands=0, extra_bands=[]):
+    """
+    Works out how a dataset that only returns "bands" of the input tile should read and transform
+    tiles. Returns (read_bands, transform, multiplicative_noise_end_transform, output_bands), where
+    "read_bands" are the bands to read (None for all bands), the transforms are to be applied to the
+    tile that was read, and "output_bands" are the indices of "bands" in the transformed tile (None
+    if they are the whole tile).
+
+    If possible, the transforms are projected onto the bands (see tile_transforms.project_transform),
+    so that other bands are never read, transformed or returned. "extra_bands" (e.g. the
+    missing-reflectance mask) are read even if they are not in "bands". Otherwise, the full tile is
+    read and transformed, and the bands are selected at the end.
+    """
+    if bands is None:
+        return None, transform, multiplicative_noise_end_transform, None
+    bands = list(bands)
+    read_bands = bands + [band for band in extra_bands if band not in bands]
+    try:
+        projected_transform = tile_transforms.project_transform(transform, read_bands, num_extra_bands=num_label_bands)
+        projected_noise_transform = tile_transforms.project_transform(multiplicative_noise_end_transform, read_bands)
+    except ValueError as e:
+        print('Cannot project transforms onto the selected bands (' + str(e) + '), reading all bands instead')
+        return None, transform, multiplicative_noise_end_transform, bands
+    if len(read_bands) == len(bands):
+        return read_bands, projected_transform, projected_noise_transform, None
+    return read_bands, projected_transform, projected_noise_transform, list(range(len(bands)))
+
+
+class SharedTileCache(object):
+    """
+    In-memory copies of the arrays a dataset reads for each of its items (e.g. a tile, or a tile
+    and its fine SIF labels), kept in shared memory (torch shared-memory tensors). DataLoader
+    workers, whether forked or spawned, map the same memory, so tiles are read from disk once and
+    are not copied into each worker. Items are read when the cache is created (a warm-up pass,
+    using "num_threads" threads).
+
+    At most "max_bytes" are used: only the first items that fit are cached, and get() returns
+    None for the other items (which the dataset reads from disk as before). Items whose arrays
+    have a different shape or dtype than the first item's are not cached either.
+    """
+    def __init__(self, read_item, num_items, max_bytes, num_threads=1):
+        self.num_items = num_items
+        self.max_bytes = max_bytes
+        self.slots = np.full(num_items, -1, dtype=np.int64)  # Index of each item in the cached arrays, or -1
+        self.tensors = []
+        self._arrays = None
+        if num_items == 0:
+            return
+        first_item = read_item(0)
+        capacity = min(num_items, max_bytes // sum(array.nbytes for array in first_item))
+        if capacity == 0:
+            return
+        self.tensors = [torch.from_numpy(np.empty((capacity,) + array.shape, dtype=array.dtype)).share_memory_()
+                        for array in first_item]
+        arrays = [tensor.numpy() for tensor in self.tensors]
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+            for idx, item in enumerate(executor.map(read_item, range(capacity))):
+                if all(array.shape == cached.shape[1:] and array.dtype == cached.dtype for array, cached in zip(item, arrays)):
+                    for array, cached in zip(item, arrays):
+                        cached[idx] = array
+                    self.slots[idx] = idx
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _get_arrays(self):
+        # Read-only NumPy views of the shared tensors
+        if self._arrays is None:
+            self._arrays = [tensor.numpy() for tensor in self.tensors]
+            for array in self._arrays:
+                array.setflags(write=False)
+        return self._arrays
+
+    @property
+    def num_bytes(self):
+        return sum(tensor.numel() * tensor.element_size() for tensor in self.tensors)
+
+    def get(self, idx):
+        """
+        Returns the cached arrays of item "idx" (read-only views into shared memory), or None if
+        the item is not cached.
+        """
+        slot = self.slots[idx]
+        if slot < 0:
+            return None
+        return [array[slot] for array in self._get_arrays()]
+
+    def print_stats(self):
+        print('Shared tile cache: %d of %d tiles (%.1f MB) in memory, budget %.1f MB' %
+              (np.count_nonzero(self.slots >= 0), self.num_items, self.num_bytes / 2**20, self.max_bytes / 2**20))
+
 
 class CoarseSIFDataset(Dataset):
     """
     Dataset mapping a tile (with reflectance/cover bands) to a single SIF value
     """
-    def __init__(self, tile_info, transform, multiplicative_noise_end_transform=None, tile_file_column='tile_file', coarse_sif_column='SIF'):
+    def __init__(self, tile_info, transform, multiplicative_noise_end_transform=None, tile_file_column='tile_file', coarse_sif_column='SIF',
+                 tile_store=None, bands=None):
         """
         Args:
             tile_info: Pandas dataframe containing metadata for each tile.
-            The tile is assumed to have shape (band x lat x long)
+            The tile is assumed to have shape (band x lat x long), and may be stored either
+            as a dense .npy array or in the packed .npz format (see tile_storage.py)
+            tile_store: optional tile_storage.TileShardStore. If set, tiles are read from the shards
+                        (at the "tile_offset" column, see TileShardStore.attach_offsets) instead of
+                        from individual files.
+            bands: optional list of bands (of the dense tile) to return. The transforms are then
+                   applied to these bands only, where possible (see _band_projection).
+        Tiles can be kept in shared memory with cache_tiles().
         """
-        self.tile_info = tile_info
         self.transform = transform
         self.multiplicative_noise_end_transform = multiplicative_noise_end_transform
         self.tile_file_column = tile_file_column
         self.coarse_sif_column = coarse_sif_column
+        self.tile_store = tile_store
+        self.bands = bands
+        self.tile_cache = None
+        columns = [tile_file_column, coarse_sif_column, 'lon', 'lat', 'date']
+        if tile_store is not None:
+            columns.append('tile_offset')
+        self.metadata = _metadata_arrays(tile_info, columns)
+        self.num_tiles = len(tile_info)
+        self.read_bands, self.tile_transform, self.tile_multiplicative_noise_end_transform, self.output_bands = \
+                _band_projection(transform, multiplicative_noise_end_transform, bands)
 
     def __len__(self):
-        return len(self.tile_info)
+        return self.num_tiles
+
+    def _load_tile(self, idx):
+        if self.tile_store is not None:
+            return self.tile_store.read_tile(self.metadata['tile_offset'][idx], bands=self.read_bands)
+        return tile_storage.load_tile(self.metadata[self.tile_file_column][idx], bands=self.read_bands)
+
+    def _read_tile(self, idx):
+        # Reads the tile from the shared tile cache if it is there (the result may then be read-only)
+        if self.tile_cache is not None:
+            cached = self.tile_cache.get(idx)
+            if cached is not None:
+                return cached[0]
+        return self._load_tile(idx)
+
+    def cache_tiles(self, max_bytes, num_threads=1):
+        """
+        Reads the tiles into shared memory, up to "max_bytes" (see SharedTileCache). Returns the
+        number of bytes used.
+        """
+        self.tile_cache = SharedTileCache(lambda idx: (self._load_tile(idx),), len(self), max_bytes, num_threads)
+        return self.tile_cache.num_bytes
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        current_tile_info = self.tile_info.iloc[idx]
-        input_tile = np.load(current_tile_info.loc[self.tile_file_column])
+        metadata = self.metadata
+        input_tile = self._read_tile(idx)
 
         # print('Idx', idx, 'Band means before transform', np.mean(input_tile, axis=(1, 2)))
         # tile_description = str(round(current_tile_info.loc['lat'], 5)) + '_lon_' + str(round(current_tile_info.loc['lon'], 5)) + '_' + current_tile_info.loc['date']
         # sif_utils.plot_tile(input_tile,  'lat_before_augment_lat_' + tile_description)
 
-        if self.transform:
-            input_tile = self.transform(input_tile)
+        if self.tile_transform:
+            if not input_tile.flags.writeable:
+                input_tile = input_tile.copy()  # Transforms modify the tile in place
+            input_tile = self.tile_transform(input_tile)
 
         # sif_utils.plot_tile(input_tile,  'lat_after_augment_lat_' + tile_description)
         # print('Idx', idx, 'Band means after transform', np.mean(input_tile, axis=(1,2)))
 
-        sample = {'coarse_sif': torch.tensor(current_tile_info[self.coarse_sif_column], dtype=torch.float),
-                  'lon': current_tile_info.loc['lon'],
-                  'lat': current_tile_info.loc['lat'],
-                  'tile_file': current_tile_info.loc[self.tile_file_column],
-                  'date': current_tile_info.loc['date']}
+        sample = {'coarse_sif': torch.tensor(metadata[self.coarse_sif_column][idx], dtype=torch.float),
+                  'lon': metadata['lon'][idx],
+                  'lat': metadata['lat'][idx],
+                  'tile_file': _metadata_value(metadata[self.tile_file_column][idx]),
+                  'date': _metadata_value(metadata['date'][idx])}
 
-        sample['input_tile_without_mult_noise'] = torch.tensor(input_tile, dtype=torch.float)
-        if self.multiplicative_noise_end_transform is not None:
-            input_tile_with_mult_noise = self.multiplicative_noise_end_transform(input_tile)
-            sample['input_tile'] = torch.tensor(input_tile_with_mult_noise, dtype=torch.float)
+        if self.output_bands is None:
+            sample['input_tile_without_mult_noise'] = torch.tensor(input_tile, dtype=torch.float)
+        else:
+            sample['input_tile_without_mult_noise'] = torch.tensor(input_tile[self.output_bands], dtype=torch.float)
+        if self.tile_multiplicative_noise_end_transform is not None:
+            input_tile = self.tile_multiplicative_noise_end_transform(input_tile)
+            if self.output_bands is None:
+                sample['input_tile'] = torch.tensor(input_tile, dtype=torch.float)
+            else:
+                sample['input_tile'] = torch.tensor(input_tile[self.output_bands], dtype=torch.float)
         else:
-            sample['input_tile'] = torch.tensor(input_tile, dtype=torch.float)
+            sample['input_tile'] = sample['input_tile_without_mult_noise']
 
         return sample
 
+    def __getitems__(self, indices):
+        """
+        Returns the samples at "indices" as one collated batch (the same fields as
+        default_collate([self[idx] for idx in indices])). The tiles are read into one array, and
+        transformed as a batch (see tile_transforms.transform_batch).
+        """
+        indices = np.asarray(indices)
+        batch_info = {column: values[indices] for column, values in self.metadata.items()}
+        input_tiles = None
+        for i in range(len(indices)):
+            input_tile = self._read_tile(indices[i])
+            if input_tiles is None:
+                input_tiles = np.empty((len(indices),) + input_tile.shape, dtype=input_tile.dtype)
+            input_tiles[i] = input_tile
+        if self.tile_transform:
+            input_tiles = tile_transforms.transform_batch(self.tile_transform, input_tiles)
+
+        batch = {'coarse_sif': torch.tensor(batch_info[self.coarse_sif_column], dtype=torch.float),
+                 'lon': _collate_column(batch_info['lon']),
+                 'lat': _collate_column(batch_info['lat']),
+                 'tile_file': _collate_column(batch_info[self.tile_file_column]),
+                 'date': _collate_column(batch_info['date'])}
+        return _batch_tile_tensors(batch, input_tiles, self.output_bands, self.tile_multiplicative_noise_end_transform)
+
 
 class FineSIFDataset(Dataset):
     """
@@ -106,15 +461,25 @@ class FineSIFDataset(Dataset):
                  fine_sif_file_column='fine_sif_file',
                  fine_soundings_file_column='fine_soundings_file',
                  coarse_sif_column='SIF',
-                 coarse_soundings_column='num_soundings'):
+                 coarse_soundings_column='num_soundings',
+                 tile_store=None, bands=None):
         """
         Args:
             tile_info: Pandas dataframe containing metadata for each tile.
-                        The tile is assumed to have shape (band x lat x long)
-            "fine_sif_file_column": column which contains fine SIF files, which are MASKED NUMPY 
-                                    ARRAYS. The mask is set to True if the pixel is invalid.
+                        The tile is assumed to have shape (band x lat x long), and may be stored
+                        either as a dense .npy array or in the packed .npz format (see tile_storage.py)
+            "fine_sif_file_column": column which contains fine SIF label files (see "Fine SIF labels"
+                                    in tile_storage.py). Old files are pickled MASKED NUMPY ARRAYS,
+                                    where the mask is set to True if the pixel is invalid.
+            "fine_soundings_file_column": column which contains fine soundings files (only used
+                                          for old fine SIF files; new datasets don't have it)
+            tile_store: optional tile_storage.TileShardStore. If set, tiles and fine SIF labels are
+                        read from the shards (at the "tile_offset"/"label_offset" columns, see
+                        TileShardStore.attach_offsets) instead of from individual files.
+            bands: optional list of bands (of the dense tile) to return. The transforms are then
+                   applied to these bands only, where possible (see _band_projection).
+        Tiles and their fine SIF labels can be kept in shared memory with cache_tiles().
         """
-        self.tile_info = tile_info
         self.transform = transform
         self.multiplicative_noise_end_transform = multiplicative_noise_end_transform
         self.tile_file_column = tile_file_column
@@ -122,11 +487,61 @@ class FineSIFDataset(Dataset):
         self.fine_soundings_file_column = fine_soundings_file_column
         self.coarse_sif_column = coarse_sif_column
         self.coarse_soundings_column = coarse_soundings_column
+        self.tile_store = tile_store
+        self.bands = bands
+        self.tile_cache = None
+        columns = [tile_file_column, coarse_sif_column, coarse_soundings_column, 'lon', 'lat', 'date', 'fraction_valid']
+        if tile_store is not None:
+            columns.extend(['tile_offset', 'label_offset'])
+        else:
+            columns.append(fine_sif_file_column)
+            if fine_soundings_file_column in tile_info.columns:
+                columns.append(fine_soundings_file_column)
+        self.metadata = _metadata_arrays(tile_info, columns)
+        self.num_tiles = len(tile_info)
+
+        # The missing-reflectance mask is always read, since it is used to mask out cloudy pixels
+        self.read_bands, self.tile_transform, self.tile_multiplicative_noise_end_transform, self.output_bands = \
+                _band_projection(transform, multiplicative_noise_end_transform, bands, num_label_bands=3,
+                                 extra_bands=[tile_storage.MISSING_REFLECTANCE_BAND])
+        if self.read_bands is None:
+            self.missing_reflectance_idx = -1
+        else:
+            self.missing_reflectance_idx = self.read_bands.index(tile_storage.MISSING_REFLECTANCE_BAND)
 
 
     def __len__(self):
-        return len(self.tile_info)
-
+        return self.num_tiles
+
+
+    def _load_tile_and_labels(self, idx):
+        # Returns (input_tile, fine_sif_tile, fine_sif_mask, fine_soundings_tile)
+        metadata = self.metadata
+        if self.tile_store is not None:
+            input_tile = self.tile_store.read_tile(metadata['tile_offset'][idx], bands=self.read_bands)
+            return (input_tile,) + tuple(self.tile_store.read_fine_sif(metadata['label_offset'][idx]))
+        input_tile = tile_storage.load_tile(metadata[self.tile_file_column][idx], bands=self.read_bands)
+        fine_soundings_file = None
+        if self.fine_soundings_file_column in metadata:
+            fine_soundings_file = metadata[self.fine_soundings_file_column][idx]
+        return (input_tile,) + tuple(tile_storage.load_fine_sif_labels(metadata[self.fine_sif_file_column][idx],
+                                                                       fine_soundings_file))
+
+    def _read_tile_and_labels(self, idx):
+        # Reads the tile and labels from the shared tile cache if they are there
+        if self.tile_cache is not None:
+            cached = self.tile_cache.get(idx)
+            if cached is not None:
+                return cached
+        return self._load_tile_and_labels(idx)
+
+    def cache_tiles(self, max_bytes, num_threads=1):
+        """
+        Reads the tiles and their fine SIF labels into shared memory, up to "max_bytes" (see
+        SharedTileCache). Returns the number of bytes used.
+        """
+        self.tile_cache = SharedTileCache(self._load_tile_and_labels, len(self), max_bytes, num_threads)
+        return self.tile_cache.num_bytes
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
@@ -134,18 +549,16 @@ class FineSIFDataset(Dataset):
         sample = {}
 
         # Read CFIS tile
-        current_tile_info = self.tile_info.iloc[idx]
-        input_tile = np.load(current_tile_info.loc[self.tile_file_column], allow_pickle=True)
-        fine_sif_tile = np.load(current_tile_info.loc[self.fine_sif_file_column], allow_pickle=True)
-        fine_soundings_tile = np.load(current_tile_info.loc[self.fine_soundings_file_column], allow_pickle=True)
+        metadata = self.metadata
+        input_tile, fine_sif_tile, fine_sif_mask, fine_soundings_tile = self._read_tile_and_labels(idx)
         # print('Cfis input tile', cfis_input_tile[])
         # Mark fine SIF entries with too few soundings as invalid (so that they don't get counted in the loss)
         # cfis_fine_sif_tile.mask[cfis_fine_soundings_tile < self.min_cfis_soundings] = True
         # cfis_coarse_sif = current_tile_info[self.cfis_coarse_sif_column]  # np.load(current_cfis_tile_info.loc[self.cfis_coarse_sif_column], allow_pickle=True)
-        if self.transform:
+        if self.tile_transform:
             consolidated_tile = np.concatenate([input_tile,
-                                                np.expand_dims(fine_sif_tile.data, axis=0),
-                                                np.expand_dims(fine_sif_tile.mask, axis=0),
+                                                np.expand_dims(fine_sif_tile, axis=0),
+                                                np.expand_dims(fine_sif_mask, axis=0),
                                                 np.expand_dims(fine_soundings_tile, axis=0)], axis=0)
             # original_input_channels = input_tile.shape[0]
             # print('random', consolidated_tile[:, 0, 0])
@@ -153,7 +566,7 @@ class FineSIFDataset(Dataset):
             # print('random', consolidated_tile[:, 2, 2])
             # print('random', consolidated_tile[:, 3, 3])
             # print('consolidated tile', consolidated_tile.shape)
-            consolidated_tile = self.transform(consolidated_tile)
+            consolidated_tile = self.tile_transform(consolidated_tile)
             # print('after transform', consolidated_tile.shape)
             # print('random', consolidated_tile[:, 0, 0])
             # print('random', consolidated_tile[:, 1, 1])
@@ -166,30 +579,213 @@ class FineSIFDataset(Dataset):
             fine_soundings_tile = consolidated_tile[-1]
 
             # Mark cloudy pixels as invalid ("fine_sif_mask" is 1 for invalid pixels,
-            # and input_tile[-1] is the missing reflectance mask, which is 1 when a pixel
-            # is covered by clouds)
-            fine_sif_mask = np.logical_or(fine_sif_mask, input_tile[-1])
+            # and input_tile[missing_reflectance_idx] is the missing reflectance mask, which
+            # is 1 when a pixel is covered by clouds)
+            fine_sif_mask = np.logical_or(fine_sif_mask, input_tile[self.missing_reflectance_idx])
 
         sample = {'fine_sif': torch.tensor(fine_sif_tile, dtype=torch.float),
                   'fine_sif_mask': torch.tensor(fine_sif_mask, dtype=torch.bool),
                   'fine_soundings': torch.tensor(fine_soundings_tile, dtype=torch.float),
-                  'coarse_sif': torch.tensor(current_tile_info[self.coarse_sif_column], dtype=torch.float),  #torch.tensor(cfis_coarse_sif, dtype=torch.float),
-                  'coarse_soundings': current_tile_info[self.coarse_soundings_column],
-                  'tile_file': current_tile_info.loc[self.tile_file_column],
-                  'lon': current_tile_info.loc['lon'],
-                  'lat': current_tile_info.loc['lat'],
-                  'date': current_tile_info.loc['date'],
-                  'fraction_valid': current_tile_info.loc['fraction_valid']}
-
-        sample['input_tile_without_mult_noise'] = torch.tensor(input_tile, dtype=torch.float)
-        if self.multiplicative_noise_end_transform is not None:
-            input_tile_with_mult_noise = self.multiplicative_noise_end_transform(input_tile)
-            sample['input_tile'] = torch.tensor(input_tile_with_mult_noise, dtype=torch.float)
+                  'coarse_sif': torch.tensor(metadata[self.coarse_sif_column][idx], dtype=torch.float),  #torch.tensor(cfis_coarse_sif, dtype=torch.float),
+                  'coarse_soundings': metadata[self.coarse_soundings_column][idx],
+                  'tile_file': _metadata_value(metadata[self.tile_file_column][idx]),
+                  'lon': metadata['lon'][idx],
+                  'lat': metadata['lat'][idx],
+                  'date': _metadata_value(metadata['date'][idx]),
+                  'fraction_valid': metadata['fraction_valid'][idx]}
+
+        if self.output_bands is None:
+            sample['input_tile_without_mult_noise'] = torch.tensor(input_tile, dtype=torch.float)
+        else:
+            sample['input_tile_without_mult_noise'] = torch.tensor(input_tile[self.output_bands], dtype=torch.float)
+        if self.tile_multiplicative_noise_end_transform is not None:
+            input_tile = self.tile_multiplicative_noise_end_transform(input_tile)
+            if self.output_bands is None:
+                sample['input_tile'] = torch.tensor(input_tile, dtype=torch.float)
+            else:
+                sample['input_tile'] = torch.tensor(input_tile[self.output_bands], dtype=torch.float)
+        else:
+            sample['input_tile'] = sample['input_tile_without_mult_noise']
+
+        return sample
+
+    def __getitems__(self, indices):
+        """
+        Returns the samples at "indices" as one collated batch (the same fields as
+        default_collate([self[idx] for idx in indices])). Each tile and its fine SIF labels are
+        read into one (batch x channels x H x W) array (the tile's bands, then fine SIF, invalid
+        mask and soundings), which is transformed as a batch (see tile_transforms.transform_batch).
+        """
+        indices = np.asarray(indices)
+        batch_info = {column: values[indices] for column, values in self.metadata.items()}
+        consolidated_tiles = None
+        for i in range(len(indices)):
+            input_tile, fine_sif_tile, fine_sif_mask, fine_soundings_tile = self._read_tile_and_labels(indices[i])
+            if consolidated_tiles is None:
+                num_bands = input_tile.shape[0]
+                consolidated_tiles = np.empty((len(indices), num_bands + 3) + input_tile.shape[1:],
+                                              dtype=np.result_type(input_tile, fine_sif_tile, fine_sif_mask, fine_soundings_tile))
+            consolidated_tiles[i, :num_bands] = input_tile
+            consolidated_tiles[i, -3] = fine_sif_tile
+            consolidated_tiles[i, -2] = fine_sif_mask
+            consolidated_tiles[i, -1] = fine_soundings_tile
+
+        if self.tile_transform:
+            consolidated_tiles = tile_transforms.transform_batch(self.tile_transform, consolidated_tiles)
+        input_tiles = consolidated_tiles[:, :-3]
+        fine_sif_masks = consolidated_tiles[:, -2] != 0
+        if self.tile_transform:
+            # Mark cloudy pixels as invalid (see __getitem__)
+            fine_sif_masks = np.logical_or(fine_sif_masks, input_tiles[:, self.missing_reflectance_idx])
+
+        batch = {'fine_sif': torch.tensor(consolidated_tiles[:, -3], dtype=torch.float),
+                 'fine_sif_mask': torch.tensor(fine_sif_masks, dtype=torch.bool),
+                 'fine_soundings': torch.tensor(consolidated_tiles[:, -1], dtype=torch.float),
+                 'coarse_sif': torch.tensor(batch_info[self.coarse_sif_column], dtype=torch.float),
+                 'coarse_soundings': _collate_column(batch_info[self.coarse_soundings_column]),
+                 'tile_file': _collate_column(batch_info[self.tile_file_column]),
+                 'lon': _collate_column(batch_info['lon']),
+                 'lat': _collate_column(batch_info['lat']),
+                 'date': _collate_column(batch_info['date']),
+                 'fraction_valid': _collate_column(batch_info['fraction_valid'])}
+        return _batch_tile_tensors(batch, input_tiles, self.output_bands, self.tile_multiplicative_noise_end_transform)
+
+
+def _identity_collate(sample):
+    return sample
+
+
+def _file_stamps(filenames):
+    # (size, modification time) of each file, or (-1, -1) for missing files, as an int64 array
+    stamps = np.full((len(filenames), 2), -1, dtype=np.int64)
+    for i, filename in enumerate(filenames):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        stamps[i] = (stat.st_size, stat.st_mtime_ns)
+    return stamps
+
+
+def tile_cache_key(dataset, band_statistics_file):
+    """
+    Returns a key identifying the samples produced by "dataset" (a CoarseSIFDataset or
+    FineSIFDataset with a deterministic transform): a hash of the band statistics file contents,
+    the transform and its parameters, the dataset's selected bands, the tile storage, the
+    dataset's metadata arrays, and the size and modification time of the files the samples are
+    read from (the tile and label files, or the shard files), so that rewritten files (e.g. by an
+    incremental rebuild) invalidate the cache.
+    """
+    key = hashlib.sha1()
+    with open(band_statistics_file, 'rb') as f:
+        key.update(f.read())
+    key.update(type(dataset).__name__.encode())
+    key.update(tile_transforms.describe_transform(dataset.transform).encode())
+    key.update(repr(None if dataset.bands is None else list(dataset.bands)).encode())
+    key.update(('files' if dataset.tile_store is None else dataset.tile_store.shard_dir).encode())
+    for column in sorted(dataset.metadata):
+        values = dataset.metadata[column]
+        key.update((column + str(values.dtype) + str(values.shape)).encode())
+        if values.dtype == object:
+            key.update(pd.util.hash_array(values).tobytes())
         else:
-            sample['input_tile'] = torch.tensor(input_tile, dtype=torch.float)
+            key.update(np.ascontiguousarray(values).tobytes())
+    if dataset.tile_store is None:
+        file_columns = [dataset.tile_file_column] + [getattr(dataset, column_attribute) for column_attribute in
+                                                     ['fine_sif_file_column', 'fine_soundings_file_column']
+                                                     if hasattr(dataset, column_attribute)]
+        data_files = [filename for column in file_columns if column in dataset.metadata
+                      for filename in dataset.metadata[column] if isinstance(filename, str)]
+    else:
+        shard_dir = dataset.tile_store.shard_dir
+        data_files = [os.path.join(shard_dir, f) for f in sorted(os.listdir(shard_dir))]
+    key.update(_file_stamps(data_files).tobytes())
+    return key.hexdigest()
+
+
+class CachedTileDataset(Dataset):
+    """
+    Wraps a CoarseSIFDataset/FineSIFDataset whose transform is deterministic (e.g. validation and
+    eval datasets, which only standardize/clip), and caches its fully transformed samples on disk
+    under "cache_dir/<key>" (see tile_cache_key). The first time a key is seen, every sample is
+    computed once (using "num_workers" processes); afterwards samples are read straight from
+    memory-mapped arrays, without reading tile files or running transforms. If the dataset only
+    returns some bands (its "bands" argument), only those bands are stored.
+    """
+    def __init__(self, dataset, cache_dir, band_statistics_file, num_workers=0):
+        assert tile_transforms.is_deterministic(dataset.transform), 'Only deterministic transforms can be cached'
+        assert dataset.multiplicative_noise_end_transform is None, 'Multiplicative noise is random, so cannot be cached'
+        self.cache_dir = os.path.join(cache_dir, tile_cache_key(dataset, band_statistics_file))
+        if not os.path.exists(os.path.join(self.cache_dir, 'info.parquet')):
+            self._build(dataset, num_workers)
+        info = pd.read_parquet(os.path.join(self.cache_dir, 'info.parquet'))
+        self.info = _metadata_arrays(info, info.columns)
+        self.num_tiles = len(info)
+        self.tensor_fields = [f[:-len('.npy')] for f in sorted(os.listdir(self.cache_dir)) if f.endswith('.npy')]
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _build(self, dataset, num_workers):
+        print('Caching', len(dataset), 'transformed tiles in', self.cache_dir)
+        temp_dir = self.cache_dir + '.tmp' + str(os.getpid())
+        os.makedirs(temp_dir)
+        arrays = dict()
+        info_rows = []
+        loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers, collate_fn=_identity_collate)
+        for idx, sample in enumerate(loader):
+            # "input_tile_without_mult_noise" is the same as "input_tile" when there is no multiplicative noise
+            del sample['input_tile_without_mult_noise']
+            info_row = dict()
+            for field, value in sample.items():
+                if not torch.is_tensor(value):
+                    info_row[field] = value
+                    continue
+                if field not in arrays:
+                    arrays[field] = np.lib.format.open_memmap(os.path.join(temp_dir, field + '.npy'), mode='w+',
+                                                              dtype=value.numpy().dtype, shape=(len(dataset),) + tuple(value.shape))
+                arrays[field][idx] = value.numpy()
+            info_rows.append(info_row)
+        for array in arrays.values():
+            array.flush()
+        pd.DataFrame(info_rows).to_parquet(os.path.join(temp_dir, 'info.parquet'))
+
+        # Another process may have built the same cache in the meantime; its result is identical
+        try:
+            os.rename(temp_dir, self.cache_dir)
+        except OSError:
+            shutil.rmtree(temp_dir)
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = {field: np.load(os.path.join(self.cache_dir, field + '.npy'), mmap_mode='r')
+                            for field in self.tensor_fields}
+        return self._arrays
 
+    def __len__(self):
+        return self.num_tiles
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        sample = {field: _metadata_value(values[idx]) for field, values in self.info.items()}
+        for field, array in self._get_arrays().items():
+            sample[field] = torch.from_numpy(np.array(array[idx]))
+        sample['input_tile_without_mult_noise'] = sample['input_tile']
         return sample
 
+    def __getitems__(self, indices):
+        """Returns the samples at "indices" as one collated batch (see CoarseSIFDataset.__getitems__)."""
+        indices = np.asarray(indices)
+        batch = {field: _collate_column(values[indices]) for field, values in self.info.items()}
+        for field, array in self._get_arrays().items():
+            batch[field] = torch.from_numpy(array[indices])
+        batch['input_tile_without_mult_noise'] = batch['input_tile']
+        return batch
+
 
 # class CombinedCfisOco2Dataset(Dataset):
 #     """Dataset mapping a tile (with reflectance/cover bands) to a coarse or fine resolution SIF map"""
@@ -483,20 +1079,21 @@ class SubtileListDataset(Dataset):
 
             num_subtiles: number of subtiles to sample
         """
-        self.tile_info = tile_info
         self.transform = transform
         self.tile_file_column = tile_file_column
         self.num_subtiles = num_subtiles
+        self.metadata = _metadata_arrays(tile_info, [tile_file_column, 'lon', 'lat', 'source', 'date', 'SIF'])
+        self.num_tiles = len(tile_info)
 
     def __len__(self):
-        return len(self.tile_info)
+        return self.num_tiles
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        current_tile_info = self.tile_info.iloc[idx]
-        tile = np.load(current_tile_info.loc[self.tile_file_column])
+        metadata = self.metadata
+        tile = np.load(metadata[self.tile_file_column][idx])
 
         # Chose some random sub-tiles
         if self.num_subtiles is not None:
@@ -512,13 +1109,13 @@ class SubtileListDataset(Dataset):
 
         tile = torch.tensor(tile, dtype=torch.float)
  
-        sample = {'lon': current_tile_info.loc['lon'],
-                  'lat': current_tile_info.loc['lat'],
-                  'tile_file': current_tile_info.loc[self.tile_file_column],
-                  'source': current_tile_info.loc['source'],
-                  'date': current_tile_info.loc['date'],
+        sample = {'lon': metadata['lon'][idx],
+                  'lat': metadata['lat'][idx],
+                  'tile_file': _metadata_value(metadata[self.tile_file_column][idx]),
+                  'source': _metadata_value(metadata['source'][idx]),
+                  'date': _metadata_value(metadata['date'][idx]),
                   #'year': year,
                   #'day_of_year': day_of_year,
                   'tile': tile,
-                  'SIF': current_tile_info.loc["SIF"]}
+                  'SIF': metadata['SIF'][idx]}
         return sample
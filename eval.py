@@ -19,10 +19,13 @@ import torch.nn as nn
 import torch.optim as optim
 
 import simple_cnn
-from datasets import FineSIFDataset
+from datasets import FineSIFDataset, CachedTileDataset, collate_batch
 from unet.unet_model import UNetContrastive, UNet2Contrastive, UNet, UNet2, PixelNN, UNet2Spectral
 import visualization_utils
 import sif_utils
+import metadata_store
+import tile_manifest
+import tile_storage
 import tile_transforms
 from sklearn.linear_model import Ridge
 from sklearn.neural_network import MLPRegressor
@@ -64,6 +67,11 @@ parser.add_argument('-match_coarse_1sounding', "--match_coarse_1sounding", actio
 parser.add_argument('-min_sif_clip', "--min_sif_clip", default=0.1, type=float, help="Before computing loss, clip outputs below this to this value.")
 parser.add_argument('-min_input', "--min_input", default=-3, type=float, help="Clip extreme input values to this many standard deviations below mean")
 parser.add_argument('-max_input', "--max_input", default=3, type=float, help="Clip extreme input values to this many standard deviations above mean")
+parser.add_argument('-tile_shard_dir', "--tile_shard_dir", default=None, type=str, help="If set, read tiles from the shards in this directory (created by data_processing/create_tile_shards.py) instead of individual tile files")
+parser.add_argument('-tile_cache_dir', "--tile_cache_dir", default=None, type=str, help="If set, cache the transformed eval tiles in this directory (see CachedTileDataset), so that they are only read and preprocessed once")
+parser.add_argument('-validate_files', "--validate_files", action='store_true', help="Before evaluating, check all tile/label files against the manifests written by the dataset builders (see tile_manifest.py)")
+parser.add_argument('-skip_checksums', "--skip_checksums", action='store_true', help="If validating files, only check that they exist and have the right size/shape (much faster than verifying checksums)")
+parser.add_argument('-validation_workers', "--validation_workers", default=1, type=int, help="Number of threads to use when validating files")
 
 
 args = parser.parse_args()
@@ -216,7 +224,7 @@ def eval_unet_fast(args, unet_model, dataloader, criterion, device, sif_mean, si
     for sample in dataloader:
         with torch.set_grad_enabled(False):
             # Read input tile
-            input_tiles_std = sample['input_tile'][:, BANDS, :, :].to(device)
+            input_tiles_std = sample['input_tile'].to(device)  # [batch, # channels (BANDS), height, width]
 
             # Read coarse-resolution SIF label
             true_coarse_sifs = sample['coarse_sif'].to(device)
@@ -313,7 +321,7 @@ def compare_unet_to_others(args, unet_model, dataloader, device, sif_mean, sif_s
     for sample in dataloader:
         with torch.set_grad_enabled(False):
             # Read input tile
-            input_tiles_std = sample['input_tile'].to(device)
+            input_tiles_std = sample['input_tile'].to(device)  # [batch, # channels (BANDS), height, width]
 
             # Read coarse-resolution SIF label
             true_coarse_sifs = sample['coarse_sif'].to(device)
@@ -324,7 +332,7 @@ def compare_unet_to_others(args, unet_model, dataloader, device, sif_mean, sif_s
             fine_soundings = sample['fine_soundings'].to(device)
 
             # Predict fine-resolution SIF using model
-            outputs = unet_model(input_tiles_std[:, BANDS, :, :])  # predicted_fine_sifs_std: (batch size, 1, H, W)
+            outputs = unet_model(input_tiles_std)  # predicted_fine_sifs_std: (batch size, 1, H, W)
             if type(outputs) == tuple:
                 outputs = outputs[0]
             predicted_fine_sifs_std = torch.squeeze(outputs, dim=1)  # outputs[:, 0, :, :]
@@ -532,7 +540,11 @@ def main():
 
 
     # Read CFIS coarse metadata
-    cfis_coarse_metadata = pd.read_csv(CFIS_COARSE_METADATA_FILE)
+    cfis_coarse_metadata = metadata_store.read_metadata(CFIS_COARSE_METADATA_FILE)
+    tile_store = None
+    if args.tile_shard_dir is not None:
+        tile_store = tile_storage.TileShardStore(args.tile_shard_dir)
+        cfis_coarse_metadata = tile_store.attach_offsets(cfis_coarse_metadata, CFIS_COARSE_METADATA_FILE)
 
     # Only include CFIS tiles with enough valid pixels
     cfis_coarse_metadata = cfis_coarse_metadata[(cfis_coarse_metadata['fraction_valid'] >= MIN_COARSE_FRACTION_VALID_PIXELS) &
@@ -541,6 +553,16 @@ def main():
     cfis_coarse_metadata = cfis_coarse_metadata[cfis_coarse_metadata[ALL_COVER_COLUMNS].sum(axis=1) >= 0.5]
     print('After filtering - CFIS coarse', len(cfis_coarse_metadata))
 
+    # Check dataset files before running the (long) evaluation
+    if args.validate_files:
+        if tile_store is not None:
+            files_to_validate = [(tile_manifest.shard_manifest_file(args.tile_shard_dir), None)]
+        else:
+            files_to_validate = [(tile_manifest.manifest_file(CFIS_COARSE_METADATA_FILE),
+                                  np.concatenate([cfis_coarse_metadata[column].dropna().values for column in ['tile_file', 'fine_sif_file', 'fine_soundings_file']
+                                                  if column in cfis_coarse_metadata.columns]))]
+        tile_manifest.validate_or_exit(files_to_validate, num_workers=args.validation_workers, verify_checksums=not args.skip_checksums)
+
     # Record results
     for MIN_EVAL_CFIS_SOUNDINGS in MIN_EVAL_CFIS_SOUNDINGS_EXPERIMENT:
         results_row = [args.model_path, MIN_EVAL_CFIS_SOUNDINGS, MIN_EVAL_FRACTION_VALID]
@@ -552,8 +574,9 @@ def main():
             EVAL_CFIS_RESULTS_CSV_FILE = os.path.join(RESULTS_DIR, 'cfis_results_' + args.model + '_' + str(RESOLUTION_METERS) + 'm_' + args.test_set + '.csv')
 
             # Read fine metadata at particular resolution
-            cfis_eval_metadata = pd.read_csv(CFIS_EVAL_METADATA_FILE)
-            cfis_eval_metadata = cfis_eval_metadata[(cfis_eval_metadata['fraction_valid'] >= 0.5) &  #(cfis_eval_metadata['SIF'] >= MIN_SIF_CLIP) &
+            # (only the test folds/dates are used below, so only those rows are read)
+            cfis_eval_metadata = metadata_store.read_metadata(CFIS_EVAL_METADATA_FILE, folds=TEST_FOLDS, dates=TEST_DATES, min_fraction_valid=0.5)
+            cfis_eval_metadata = cfis_eval_metadata[#(cfis_eval_metadata['SIF'] >= MIN_SIF_CLIP) &
                                                     # (cfis_eval_metadata['num_soundings'] >= MIN_EVAL_CFIS_SOUNDINGS) &  # Remove this condition for plotting purposes 
                                                     (cfis_eval_metadata['tile_file'].isin(set(cfis_coarse_metadata['tile_file'])))]
             # cfis_eval_metadata = cfis_eval_metadata[cfis_eval_metadata[ALL_COVER_COLUMNS].sum(axis=1) >= 0.5]
@@ -570,9 +593,8 @@ def main():
             print('Eval metadata', len(eval_test_set))
 
             # Read OCO2 metadata
-            oco2_metadata = pd.read_csv(OCO2_METADATA_FILE)
-            oco2_metadata = oco2_metadata[(oco2_metadata['num_soundings'] >= MIN_OCO2_SOUNDINGS) &
-                                            (oco2_metadata['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
+            oco2_metadata = metadata_store.read_metadata(OCO2_METADATA_FILE, folds=TRAIN_FOLDS, dates=TRAIN_DATES, min_num_soundings=MIN_OCO2_SOUNDINGS)
+            oco2_metadata = oco2_metadata[(oco2_metadata['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
                                             (oco2_metadata['SIF'] >= MIN_SIF_CLIP)]
             oco2_metadata = oco2_metadata[oco2_metadata[ALL_COVER_COLUMNS].sum(axis=1) >= 0.5]
 
@@ -622,9 +644,12 @@ def main():
             transform = transforms.Compose(transform_list)
 
             # Create dataset/dataloader
-            dataset = FineSIFDataset(coarse_test_set, transform, None)  # CombinedCfisOco2Dataset(coarse_train_set, None, transform, MIN_EVAL_CFIS_SOUNDINGS)
+            dataset = FineSIFDataset(coarse_test_set, transform, None, tile_store=tile_store, bands=BANDS)  # CombinedCfisOco2Dataset(coarse_train_set, None, transform, MIN_EVAL_CFIS_SOUNDINGS)
+            if args.tile_cache_dir is not None:
+                dataset = CachedTileDataset(dataset, args.tile_cache_dir, BAND_STATISTICS_FILE, num_workers=NUM_WORKERS)
             dataloader = torch.utils.data.DataLoader(dataset, batch_size=BATCH_SIZE,
-                                                    shuffle=False, num_workers=NUM_WORKERS)
+                                                    shuffle=False, num_workers=NUM_WORKERS,
+                                                    collate_fn=collate_batch)
 
             X_coarse_train = train_set[INPUT_COLUMNS]
             Y_coarse_train = train_set[OUTPUT_COLUMN].values.ravel()
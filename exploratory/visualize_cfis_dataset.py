@@ -3,6 +3,7 @@ import numpy as np
 import os
 import pandas as pd
 import sif_utils
+import tile_storage
 import torch
 import visualization_utils
 import matplotlib.pyplot as plt
@@ -114,14 +115,14 @@ plt.close()
 # Choose arbitrary tile, load data
 single_metadata = cfis_coarse_metadata_df.iloc[0]
 # print('Single metadata', single_metadata)
-true_fine_sifs = np.load(single_metadata.loc['fine_sif_file'], allow_pickle=True)
-valid_fine_sif_mask = np.logical_not(true_fine_sifs.mask)
-fine_soundings = np.load(single_metadata.loc['fine_soundings_file'], allow_pickle=True)
+true_fine_sifs, invalid_fine_sif_mask, fine_soundings = tile_storage.load_fine_sif_labels(single_metadata.loc['fine_sif_file'],
+                                                                                           single_metadata.get('fine_soundings_file'))
+valid_fine_sif_mask = np.logical_not(invalid_fine_sif_mask)
 # print('Fine soundings', fine_soundings)
 # print('Valid fine sif mask', valid_fine_sif_mask)
-true_eval_sifs, eval_fraction_valid, eval_soundings = sif_utils.downsample_sif(torch.tensor(true_fine_sifs.data).unsqueeze(0),
+true_eval_sifs, eval_fraction_valid, eval_soundings = sif_utils.downsample_sif(torch.tensor(true_fine_sifs).unsqueeze(0),
                                                                                torch.tensor(valid_fine_sif_mask).unsqueeze(0),
-                                                                               torch.tensor(fine_soundings).unsqueeze(0), 3)
+                                                                               torch.tensor(fine_soundings, dtype=torch.float).unsqueeze(0), 3)
 
 # Plot soundings/SIF - squeeze
 fig, axeslist = plt.subplots(ncols=2, nrows=1, figsize=(24, 12))
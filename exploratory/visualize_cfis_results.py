@@ -20,6 +20,7 @@ from sif_utils import lat_long_to_index, plot_histogram, get_subtiles_list, prin
 import sif_utils
 import cdl_utils
 import simple_cnn
+import tile_storage
 import tile_transforms
 import resnet
 from SAN import SAN
@@ -234,7 +235,7 @@ for large_tile_file, count in large_tile_files.iteritems(): # large_tile_rows in
     large_tile_rows = unet_results_cfis[unet_results_cfis['large_tile_file'] == large_tile_file]
     
     # Read an input tile
-    tile = np.load(large_tile_file)
+    tile = tile_storage.load_tile(large_tile_file)
 
     # Large tile description
     LAT = large_tile_rows.iloc[0]['large_tile_lat']
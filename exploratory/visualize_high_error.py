@@ -13,6 +13,7 @@ import sys
 import resnet
 import simple_cnn
 import sif_utils
+import tile_storage
 import tile_transforms
 import torchvision
 import torchvision.transforms as transforms
@@ -109,7 +110,7 @@ high_error_indices = sorted_indices[-NUM_TILES:][::-1]
 
 for high_error_idx in high_error_indices:
     row = results.iloc[high_error_idx]
-    high_error_tile = transform(np.load(row['tile_file']))
+    high_error_tile = transform(tile_storage.load_tile(row['tile_file']))
     tile_description = 'oco2_high_error_' + os.path.basename(row['tile_file'])
     title = 'Lat ' + str(round(row['lat'], 4)) + ', Lon ' + str(round(row['lon'], 4))
     if 'date' in row:
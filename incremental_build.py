@@ -0,0 +1,142 @@
+"""
+Incremental rebuilds for the dataset builders (data_processing/create_datasets.py and
+data_processing/create_cfis_grid.py).
+
+A builder splits its work into units (e.g. one Landsat reflectance file, or one CFIS/OCO-2 tile),
+and hashes the contents of each unit's inputs (raw files, plus any in-memory arrays or settings
+the outputs depend on). The build state, a JSON file next to the builder's output, records for
+each unit the hash of its inputs and the files it wrote. In incremental mode, units whose inputs
+hash is unchanged (and whose outputs all still exist) are skipped, and their metadata rows are
+kept from the previous metadata file (see BuildState.merge_metadata).
+
+File contents are hashed at most once per file: hashes are remembered in the build state, keyed
+by the file's size and modification time.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def read_previous_metadata(csv_file, index_col=None):
+    """
+    Returns the metadata written by a previous run to "csv_file", or None if there is none.
+    """
+    if not os.path.isfile(csv_file):
+        return None
+    return pd.read_csv(csv_file, index_col=index_col)
+
+
+class BuildState(object):
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.units = dict()  # unit -> {'inputs_hash': ..., 'outputs': [...]}
+        self.file_hashes = dict()  # filename -> [[size, mtime_ns], content hash]
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            self.units = state['units']
+            self.file_hashes = state['file_hashes']
+
+        # Units seen in this run, units rebuilt in this run, and the files written by previous
+        # builds of units that were rebuilt (or that no longer exist)
+        self.seen_units = set()
+        self.rebuilt_units = set()
+        self.replaced_files = set()
+
+    def file_hash(self, filename):
+        """
+        Returns the SHA-1 of the contents of "filename". The file is only read if it changed
+        (size or modification time) since its hash was last computed.
+        """
+        stat = os.stat(filename)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        if filename in self.file_hashes and self.file_hashes[filename][0] == fingerprint:
+            return self.file_hashes[filename][1]
+        content_hash = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK_BYTES)
+                if not chunk:
+                    break
+                content_hash.update(chunk)
+        self.file_hashes[filename] = [fingerprint, content_hash.hexdigest()]
+        return content_hash.hexdigest()
+
+    def inputs_hash(self, input_files, params=()):
+        """
+        Returns a hash of the contents of "input_files" (files that don't exist are hashed as
+        missing), and of "params" (numpy arrays, or values with a stable repr, e.g. numbers,
+        strings, and lists/tuples of them).
+        """
+        key = hashlib.sha1()
+        for filename in input_files:
+            key.update(filename.encode())
+            key.update(self.file_hash(filename).encode() if os.path.isfile(filename) else b'missing')
+        for param in params:
+            if isinstance(param, np.ndarray):
+                key.update((str(param.dtype) + str(param.shape)).encode())
+                key.update(np.ascontiguousarray(param).tobytes())
+            else:
+                key.update(repr(param).encode())
+        return key.hexdigest()
+
+    def needs_build(self, unit, inputs_hash):
+        """
+        Returns whether "unit" must be (re)built: True unless it was built before from the same
+        inputs, and all of its outputs still exist.
+        """
+        self.seen_units.add(unit)
+        if unit not in self.units:
+            return True
+        entry = self.units[unit]
+        return entry['inputs_hash'] != inputs_hash or not all(os.path.exists(f) for f in entry['outputs'])
+
+    def start_unit(self, unit, inputs_hash):
+        """
+        Records that "unit" is being built from inputs with the given hash. Returns the list of
+        the unit's outputs, to which the builder should append each file it writes.
+        """
+        self.seen_units.add(unit)
+        self.rebuilt_units.add(unit)
+        if unit in self.units:
+            self.replaced_files.update(self.units[unit]['outputs'])
+        self.units[unit] = {'inputs_hash': inputs_hash, 'outputs': []}
+        return self.units[unit]['outputs']
+
+    def _forget_unseen_units(self):
+        # Units that were not seen in this run no longer exist (e.g. their raw input was removed)
+        for unit in list(self.units.keys()):
+            if unit not in self.seen_units:
+                self.replaced_files.update(self.units[unit]['outputs'])
+                del self.units[unit]
+
+    def merge_metadata(self, old_metadata, new_metadata, file_column='tile_file'):
+        """
+        Merges the metadata rows written in this run ("new_metadata") into the previous metadata
+        file's rows ("old_metadata", or None if there was none): rows of files that were rebuilt
+        (or whose unit no longer exists) are replaced, and so are rows of files that no unit in the
+        build state wrote (e.g. rows written before build states existed); all other old rows are kept.
+        """
+        self._forget_unseen_units()
+        if old_metadata is None:
+            return new_metadata.reset_index(drop=True)
+        replaced_files = set(self.replaced_files)
+        for unit in self.rebuilt_units:
+            replaced_files.update(self.units[unit]['outputs'])
+        unit_files = set(filename for entry in self.units.values() for filename in entry['outputs'])
+        kept_metadata = old_metadata[old_metadata[file_column].isin(unit_files - replaced_files)]
+        print('Keeping', len(kept_metadata), 'of', len(old_metadata), 'previous metadata rows')
+        return pd.concat([kept_metadata, new_metadata], ignore_index=True)
+
+    def save(self):
+        self._forget_unseen_units()
+        print('Build state:', len(self.seen_units) - len(self.rebuilt_units), 'units up to date,',
+              len(self.rebuilt_units), 'rebuilt')
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'units': self.units, 'file_hashes': self.file_hashes}, f)
+        os.replace(temp_file, self.state_file)
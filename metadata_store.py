@@ -0,0 +1,154 @@
+"""
+Columnar storage for metadata files (e.g. cfis_fine_metadata.csv, cfis_metadata_<res>m.csv).
+
+Metadata writers save each file twice: the usual CSV (so that existing tools and notebooks keep
+working), and a Parquet copy next to it (same name, ".parquet" extension). The Parquet copy is
+typed, zstd-compressed, and sorted by (date, fold), so that each row group only covers a few
+dates/folds and its min/max statistics let the reader skip row groups that cannot match a filter.
+
+read_metadata() reads the Parquet copy if it exists and is up to date, pushing the fold, date,
+num_soundings and fraction_valid filters down into the Parquet reader. Otherwise it falls back to
+parsing the CSV and applying the same filters in pandas. Either way, the rows come back in their
+original order, indexed by their original row index.
+
+MetadataWriter builds a metadata file from blocks of rows given as column arrays (e.g. all fine
+pixels of a tile at once), spilling them to a temporary Parquet file instead of keeping millions
+of rows in memory as Python lists.
+"""
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARQUET_EXTENSION = '.parquet'
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# Columns used to order rows in the Parquet file (if present)
+SORT_COLUMNS = ['date', 'fold']
+
+# Integer columns that can be stored with a narrower type
+SMALL_INT_COLUMNS = ['fold', 'grid_fold']
+
+# Number of rows MetadataWriter buffers in memory before spilling them to disk
+WRITER_FLUSH_ROWS = 500000
+
+# Header of the index column in a CSV written by DataFrame.to_csv (when the index has no name)
+UNNAMED_INDEX_COLUMN = 'Unnamed: 0'
+
+
+def parquet_file(csv_file):
+    """Returns the path of the Parquet copy of the given metadata CSV file."""
+    return os.path.splitext(csv_file)[0] + PARQUET_EXTENSION
+
+
+def write_metadata(df, csv_file):
+    """
+    Writes the metadata DataFrame to "csv_file" (with its index, as DataFrame.to_csv does by
+    default), and also writes a Parquet copy (see parquet_file()).
+    """
+    df.to_csv(csv_file)
+
+    parquet_df = df.copy()
+    for column in SMALL_INT_COLUMNS:
+        if column in parquet_df.columns:
+            parquet_df[column] = parquet_df[column].astype('int8')
+    sort_columns = [column for column in SORT_COLUMNS if column in parquet_df.columns]
+    if len(sort_columns) > 0:
+        parquet_df = parquet_df.sort_values(sort_columns, kind='mergesort')
+    parquet_df.to_parquet(parquet_file(csv_file), engine='pyarrow', index=True, compression='zstd',
+                          row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+
+def read_metadata(csv_file, folds=None, dates=None, min_num_soundings=None, min_fraction_valid=None, columns=None):
+    """
+    Reads a metadata file (written by write_metadata(), or any metadata CSV), only keeping rows where "fold" is in
+    "folds", "date" is in "dates", "num_soundings" >= min_num_soundings, and
+    "fraction_valid" >= min_fraction_valid (filters that are None are not applied).
+    If "columns" is given, only those columns are read.
+    """
+    filters = []
+    if folds is not None:
+        filters.append(('fold', 'in', list(folds)))
+    if dates is not None:
+        filters.append(('date', 'in', list(dates)))
+    if min_num_soundings is not None:
+        filters.append(('num_soundings', '>=', min_num_soundings))
+    if min_fraction_valid is not None:
+        filters.append(('fraction_valid', '>=', min_fraction_valid))
+
+    parquet_filename = parquet_file(csv_file)
+    if os.path.isfile(parquet_filename) and (not os.path.isfile(csv_file) or
+                                             os.path.getmtime(parquet_filename) >= os.path.getmtime(csv_file)):
+        df = pd.read_parquet(parquet_filename, engine='pyarrow', columns=columns,
+                             filters=filters if len(filters) > 0 else None)
+        for column in SMALL_INT_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column].astype('int64')
+        return df.sort_index(kind='mergesort')
+
+    # No (up-to-date) Parquet copy: parse the CSV and filter in pandas
+    if os.path.isfile(parquet_filename):
+        print('Parquet copy is older than', csv_file, '- reading CSV instead')
+    # Column 0 is only the index if it is the unnamed index column written by DataFrame.to_csv
+    # (other metadata files, e.g. written with index=False, have no index column)
+    df = pd.read_csv(csv_file)
+    if len(df.columns) > 0 and df.columns[0] == UNNAMED_INDEX_COLUMN:
+        df = df.set_index(UNNAMED_INDEX_COLUMN)
+        df.index.name = None
+    if folds is not None:
+        df = df[df['fold'].isin(folds)]
+    if dates is not None:
+        df = df[df['date'].isin(dates)]
+    if min_num_soundings is not None:
+        df = df[df['num_soundings'] >= min_num_soundings]
+    if min_fraction_valid is not None:
+        df = df[df['fraction_valid'] >= min_fraction_valid]
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+class MetadataWriter(object):
+    """
+    Collects the rows of a metadata file in blocks. Each block is given as a dict from column name
+    to an array of values (or a single value, repeated for every row of the block). Blocks are
+    buffered, and every WRITER_FLUSH_ROWS rows written to a temporary Parquet file next to
+    "csv_file". to_dataframe() reads all rows back (in the order they were appended) and removes
+    the temporary file; the result can then be written with write_metadata().
+    """
+    def __init__(self, csv_file, columns, flush_rows=WRITER_FLUSH_ROWS):
+        self.columns = columns
+        self.flush_rows = flush_rows
+        self.spill_file = os.path.splitext(csv_file)[0] + '.partial' + PARQUET_EXTENSION
+        self.blocks = []
+        self.num_buffered_rows = 0
+        self.num_rows = 0
+        self.parquet_writer = None
+
+    def append(self, block):
+        block = pd.DataFrame(block, columns=self.columns)
+        self.blocks.append(block)
+        self.num_buffered_rows += len(block)
+        self.num_rows += len(block)
+        if self.num_buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.blocks) == 0:
+            return
+        table = pa.Table.from_pandas(pd.concat(self.blocks, ignore_index=True), preserve_index=False)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.spill_file, table.schema, compression='zstd')
+        self.parquet_writer.write_table(table.cast(self.parquet_writer.schema))
+        self.blocks = []
+        self.num_buffered_rows = 0
+
+    def to_dataframe(self):
+        self.flush()
+        if self.parquet_writer is None:
+            return pd.DataFrame(columns=self.columns)
+        self.parquet_writer.close()
+        self.parquet_writer = None
+        df = pd.read_parquet(self.spill_file, engine='pyarrow')
+        os.remove(self.spill_file)
+        return df
@@ -13,6 +13,7 @@ from matplotlib import cm
 from matplotlib.colors import Normalize 
 
 from datetime import datetime
+import tile_storage
 import visualization_utils
 
 from scipy.interpolate import interpn
@@ -123,6 +124,122 @@ def lat_long_to_index(lat, lon, dataset_top_bound, dataset_left_bound, resolutio
     return int(height_idx+eps), int(width_idx+eps)
 
 
+def lat_long_to_indices(lats, lons, dataset_top_bound, dataset_left_bound, resolution):
+    """Vectorized lat_long_to_index: returns arrays of height and width indices."""
+    height_idx = (dataset_top_bound - lats) / resolution[0]
+    width_idx = (lons - dataset_left_bound) / resolution[1]
+    eps = 1e-6
+    return (height_idx+eps).astype(np.int64), (width_idx+eps).astype(np.int64)
+
+
+def nearest_grid_values(grids, lats, lons):
+    """Given xarray DataArrays on the same "lat"/"lon" grid, returns (for each one) an array of shape
+    (len(lats), len(lons)), containing the values at the grid cells nearest to each (lat, lon) pair.
+    These are the values .sel(lat=lat, lon=lon, method='nearest') returns, but the nearest grid
+    cells are only computed once, and each DataArray is read with a single gather."""
+    lat_indices = grids[0].indexes['lat'].get_indexer(lats, method='nearest')
+    lon_indices = grids[0].indexes['lon'].get_indexer(lons, method='nearest')
+    return [grid.transpose('lat', 'lon').values[np.ix_(lat_indices, lon_indices)] for grid in grids]
+
+
+def load_sounding_array(filename):
+    """Memory-maps a raw array of soundings (.npy), so that it can be processed in chunks without
+    reading it all into memory. Arrays of Python objects can't be memory-mapped, and are loaded
+    fully (as float64)."""
+    try:
+        return np.load(filename, mmap_mode='r')
+    except ValueError:
+        return np.load(filename, allow_pickle=True).astype(np.float64)
+
+
+def grid_soundings(lats, lons, values, region_bounds, resolution, tile_size_pixels, tile_to_sum_array, tile_to_count_array,
+                   grid_offset=(0, 0), chunk_size=1000000):
+    """Adds the soundings at (lats, lons) to the per-pixel sums of "values" and sounding counts
+    of the tiles containing them.
+
+    "region_bounds" is (top, bottom, left, right); soundings outside it are ignored. Pixels are
+    given by *region indices* (relative to the region's top-left corner, see lat_long_to_index),
+    and tiles have size "tile_size_pixels", with the grid starting at region indices "grid_offset"
+    (soundings above/left of the grid are ignored). "tile_to_sum_array" and "tile_to_count_array"
+    map the region indices of each tile's top-left corner to (tile_size_pixels x tile_size_pixels)
+    arrays; they are updated in place (new tiles are added in the order of their first sounding).
+
+    The soundings are processed "chunk_size" at a time, so the arrays can be memory-mapped."""
+    top_bound, bottom_bound, left_bound, right_bound = region_bounds
+    pixels_per_tile = tile_size_pixels * tile_size_pixels
+    for start in range(0, len(lats), chunk_size):
+        chunk_lats = np.asarray(lats[start:start+chunk_size])
+        chunk_lons = np.asarray(lons[start:start+chunk_size])
+        chunk_values = np.asarray(values[start:start+chunk_size])
+        in_region = (chunk_lats >= bottom_bound) & (chunk_lats <= top_bound) & (chunk_lons >= left_bound) & (chunk_lons <= right_bound)
+        chunk_lats, chunk_lons, chunk_values = chunk_lats[in_region], chunk_lons[in_region], chunk_values[in_region]
+
+        # Region indices of each sounding
+        lat_idx, lon_idx = lat_long_to_indices(chunk_lats, chunk_lons, top_bound, left_bound, resolution)
+        in_grid = (lat_idx >= grid_offset[0]) & (lon_idx >= grid_offset[1])
+        num_outside_grid = np.count_nonzero(~in_grid)
+        if num_outside_grid > 0:
+            print('Attention -', num_outside_grid, 'points outside OCO2 grid')
+        lat_idx, lon_idx, chunk_values = lat_idx[in_grid], lon_idx[in_grid], chunk_values[in_grid]
+        if len(lat_idx) == 0:
+            continue
+
+        # Top-left corner of the tile containing each sounding, and the sounding's pixel within the tile
+        tile_lat_idx = (lat_idx - grid_offset[0]) // tile_size_pixels * tile_size_pixels + grid_offset[0]
+        tile_lon_idx = (lon_idx - grid_offset[1]) // tile_size_pixels * tile_size_pixels + grid_offset[1]
+        pixel_idx = (lat_idx - tile_lat_idx) * tile_size_pixels + (lon_idx - tile_lon_idx)
+
+        # Sum values and count soundings per occupied (tile, pixel) bin. Bins are numbered
+        # tile-major, so the bins of each tile are a contiguous range of the sorted unique bins.
+        tiles, first_sounding, sounding_tile = np.unique(np.stack([tile_lat_idx, tile_lon_idx], axis=1), axis=0,
+                                                         return_index=True, return_inverse=True)
+        bins = sounding_tile.reshape(-1) * pixels_per_tile + pixel_idx
+        occupied_bins, sounding_bin = np.unique(bins, return_inverse=True)
+        sums = np.bincount(sounding_bin.reshape(-1), weights=chunk_values, minlength=len(occupied_bins))
+        counts = np.bincount(sounding_bin.reshape(-1), minlength=len(occupied_bins))
+        bin_rows, bin_cols = np.divmod(occupied_bins % pixels_per_tile, tile_size_pixels)
+        tile_bin_starts = np.searchsorted(occupied_bins, np.arange(len(tiles) + 1) * pixels_per_tile)
+        for i in np.argsort(first_sounding, kind='stable'):
+            tile_indices = (int(tiles[i, 0]), int(tiles[i, 1]))
+            if tile_indices not in tile_to_sum_array:
+                tile_to_sum_array[tile_indices] = np.zeros([tile_size_pixels, tile_size_pixels])
+                tile_to_count_array[tile_indices] = np.zeros([tile_size_pixels, tile_size_pixels])
+            tile_bins = slice(tile_bin_starts[i], tile_bin_starts[i + 1])
+            tile_to_sum_array[tile_indices][bin_rows[tile_bins], bin_cols[tile_bins]] += sums[tile_bins]
+            tile_to_count_array[tile_indices][bin_rows[tile_bins], bin_cols[tile_bins]] += counts[tile_bins]
+
+
+
+def compute_block_band_averages(input_tile, invalid_mask, block_size, missing_reflectance_idx=-1):
+    """Compute average input features for every block of the tile, over valid pixels.
+
+    "input_tile" should be of shape (# channels x height x width), and "invalid_mask" of shape
+    (height x width). "block_size" is an int (square blocks), or a (block height, block width)
+    tuple; pass input_tile.shape[1:] for the average of the whole tile. Returns an array of shape
+    (# channels x height / block height x width / block width). As with AvgPool2d, rows/columns at
+    the bottom/right edge that do not fill a whole block are dropped.
+
+    As in compute_band_averages, the "missing reflectance" feature is averaged over all pixels of
+    the block. Blocks with no valid pixels have NaN averages for the other features.
+    """
+    assert input_tile.shape[1] == invalid_mask.shape[0] and input_tile.shape[2] == invalid_mask.shape[1]
+    if isinstance(block_size, int):
+        block_size = (block_size, block_size)
+    block_height, block_width = block_size
+    num_rows = input_tile.shape[1] // block_height
+    num_cols = input_tile.shape[2] // block_width
+    input_tile = input_tile[:, :num_rows*block_height, :num_cols*block_width]
+    valid_mask = np.logical_not(invalid_mask[:num_rows*block_height, :num_cols*block_width])
+
+    # Sum each block (in float64) by viewing the tile as (channels x rows x block height x cols x block width)
+    blocks_shape = (input_tile.shape[0], num_rows, block_height, num_cols, block_width)
+    valid_sums = np.where(valid_mask, input_tile, 0).reshape(blocks_shape).sum(axis=(2, 4), dtype=np.float64)
+    num_valid = valid_mask.reshape(blocks_shape[1:]).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average_input_features = valid_sums / num_valid
+    average_input_features[missing_reflectance_idx] = input_tile[missing_reflectance_idx].reshape(blocks_shape[1:]).mean(axis=(1, 3), dtype=np.float64)
+    return average_input_features.astype(np.result_type(input_tile.dtype, np.float32))
+
 
 def compute_band_averages(input_tile, invalid_mask, missing_reflectance_idx=-1):
     """Compute average input features for this subregion, over valid pixels.
@@ -152,10 +269,10 @@ def compute_band_averages(input_tile, invalid_mask, missing_reflectance_idx=-1):
     return average_input_features
 
 
-def extract_input_subtile(min_lon, max_lon, min_lat, max_lat, input_tiles_dir, subtile_size_pixels,
-                          res, input_channels=43, reflectance_tile_pixels=371):
-    # Figure out which reflectance files to open. For each edge of the bounding box,
-    # find the left/top bound of the surrounding reflectance large tile.
+def reflectance_tile_names(min_lon, max_lon, min_lat, max_lat, input_tiles_dir):
+    """Returns the names (without extension) of the 0.1-degree reflectance files that overlap the
+    bounding box, as a list of columns (from left to right), each listing files from top to bottom."""
+    # For each edge of the bounding box, find the left/top bound of the surrounding reflectance large tile.
     min_lon_tile_left = (math.floor(min_lon * 10) / 10)
     max_lon_tile_left = (math.floor(max_lon * 10) / 10)
     min_lat_tile_top = (math.ceil(min_lat * 10) / 10)
@@ -171,21 +288,38 @@ def extract_input_subtile(min_lon, max_lon, min_lat, max_lat, input_tiles_dir, s
     # print("File left lons", file_left_lons)
     # print("File top lats", file_top_lats)
 
+    columns = []
+    for file_left_lon in file_left_lons:
+        rows = []
+        for file_top_lat in file_top_lats:
+            file_center_lon = round(file_left_lon + 0.05, 2)
+            file_center_lat = round(file_top_lat - 0.05, 2)
+            rows.append(input_tiles_dir + "/reflectance_lat_" + str(file_center_lat) +  \
+                        "_lon_" + str(file_center_lon))
+        columns.append(rows)
+    return columns
+
+
+def extract_input_subtile(min_lon, max_lon, min_lat, max_lat, input_tiles_dir, subtile_size_pixels,
+                          res, input_channels=43, reflectance_tile_pixels=371, tile_loader=tile_storage.load_tile):
+    # "tile_loader" reads a reflectance file given its filename (e.g. a cached version of
+    # tile_storage.load_tile, when extracting many neighbouring subtiles)
+    # Figure out which reflectance files to open, and the top-left corner of the top-left file.
+    min_lon_tile_left = (math.floor(min_lon * 10) / 10)
+    max_lat_tile_top = (math.ceil(max_lat * 10) / 10)
+    large_tile_names = reflectance_tile_names(min_lon, max_lon, min_lat, max_lat, input_tiles_dir)
 
     # Because a sub-tile could span multiple files, patch together all of the files that
     # contain any portion of the sub-tile
     columns = []
     FILE_EXISTS = False  # Set to True if at least one file exists
-    for file_left_lon in file_left_lons:
+    for column_tile_names in large_tile_names:
         rows = []
-        for file_top_lat in file_top_lats:
+        for large_tile_name in column_tile_names:
             # Find what reflectance file to read from
-            file_center_lon = round(file_left_lon + 0.05, 2)
-            file_center_lat = round(file_top_lat - 0.05, 2)
-            large_tile_filename = input_tiles_dir + "/reflectance_lat_" + str(file_center_lat) +  \
-                                  "_lon_" + str(file_center_lon) + ".npy"
-            if not os.path.exists(large_tile_filename):
-                print('Needed data file', large_tile_filename, 'does not exist!')
+            large_tile_filename = tile_storage.find_tile_file(large_tile_name)
+            if large_tile_filename is None:
+                print('Needed data file', large_tile_name + '.npy/.npz', 'does not exist!')
                 # For now, consider the data for this section as missing
                 missing_tile = np.zeros((input_channels, reflectance_tile_pixels,
                                          reflectance_tile_pixels))
@@ -193,7 +327,7 @@ def extract_input_subtile(min_lon, max_lon, min_lat, max_lat, input_tiles_dir, s
                 rows.append(missing_tile)
             else:
                 # print('Large tile filename', large_tile_filename)
-                large_tile = np.load(large_tile_filename)
+                large_tile = tile_loader(large_tile_filename)
                 rows.append(large_tile)
                 FILE_EXISTS = True
 
@@ -257,6 +391,29 @@ def downsample_sif(sif_array, valid_sif_mask, soundings_array, resolution_pixels
     return coarse_sifs, fraction_valid, coarse_soundings
 
 
+def summed_area_table(array):
+    """
+    Returns the summed-area table of "array" over its last two axes, in float64, with a leading
+    row and column of zeros: sat[..., i, j] is the sum of array[..., :i, :j].
+    """
+    sat = np.zeros(array.shape[:-2] + (array.shape[-2] + 1, array.shape[-1] + 1))
+    np.cumsum(array, axis=-2, out=sat[..., 1:, 1:])
+    np.cumsum(sat[..., 1:, 1:], axis=-1, out=sat[..., 1:, 1:])
+    return sat
+
+
+def block_sums(sat, block_size):
+    """
+    Given a summed-area table (see summed_area_table), returns the sums over non-overlapping
+    block_size x block_size blocks. As with AvgPool2d, rows/columns at the bottom/right edge
+    that do not fill a whole block are dropped.
+    """
+    num_rows = (sat.shape[-2] - 1) // block_size
+    num_cols = (sat.shape[-1] - 1) // block_size
+    corners = sat[..., 0:num_rows*block_size+1:block_size, 0:num_cols*block_size+1:block_size]
+    return corners[..., 1:, 1:] - corners[..., :-1, 1:] - corners[..., 1:, :-1] + corners[..., :-1, :-1]
+
+
 # Inefficient method, used to double-check correctness of downsampling
 def downsample_sif_for_loop(sif_array, valid_sif_mask, soundings_array, resolution_pixels):
     # Zero out SIFs for invalid pixels (pixels with no valid SIF label, or cloudy pixels).
@@ -0,0 +1,63 @@
+"""
+Checks that BandStatistics (band_statistics.py) merged from several parts matches a single pass.
+"""
+import numpy as np
+
+import band_statistics
+
+
+def random_values(rng, num_values):
+    values = np.column_stack((rng.normal(5, 2, num_values), rng.uniform(-1, 1, num_values) * 1000,
+                              rng.integers(0, 2, num_values).astype(float)))
+    values[rng.random(num_values) < 0.2, 0] = np.nan
+    return values
+
+
+def test_merge_matches_single_pass():
+    rng = np.random.default_rng(0)
+    values = random_values(rng, 1000)
+    single_pass = band_statistics.BandStatistics(['a', 'b', 'c'])
+    single_pass.update(values)
+
+    # Merge parts of different sizes (including an empty one), in a shuffled order
+    parts = np.split(values, [10, 300, 300, 750])
+    part_statistics = []
+    for part in parts:
+        statistics = band_statistics.BandStatistics(['a', 'b', 'c'])
+        statistics.update(part)
+        part_statistics.append(statistics)
+    merged = band_statistics.BandStatistics(['a', 'b', 'c'])
+    for i in rng.permutation(len(parts)):
+        merged.merge(part_statistics[i])
+
+    np.testing.assert_array_equal(merged.count, single_pass.count)
+    np.testing.assert_allclose(merged.mean, single_pass.mean)
+    np.testing.assert_allclose(merged.std(), single_pass.std())
+    np.testing.assert_array_equal(merged.min, single_pass.min)
+    np.testing.assert_array_equal(merged.max, single_pass.max)
+    np.testing.assert_array_equal(merged.histograms, single_pass.histograms)
+    np.testing.assert_array_equal(merged.bin_exponent, single_pass.bin_exponent)
+
+
+def test_statistics_match_numpy():
+    values = random_values(np.random.default_rng(1), 500)
+    statistics = band_statistics.BandStatistics(range(3))
+    for block in np.array_split(values, 7):
+        statistics.update(block)
+    np.testing.assert_array_equal(statistics.count, (~np.isnan(values)).sum(axis=0))
+    np.testing.assert_allclose(statistics.mean, np.nanmean(values, axis=0))
+    np.testing.assert_allclose(statistics.std(), np.nanstd(values, axis=0, ddof=1))
+    for band in range(3):
+        counts, edges = statistics.histogram(band)
+        assert counts.sum() == statistics.count[band]
+        assert edges[0] <= np.nanmin(values[:, band]) and np.nanmax(values[:, band]) < edges[-1]
+
+
+def test_pixel_statistics_are_deviations_from_given_means():
+    values = random_values(np.random.default_rng(2), 200)
+    statistics = band_statistics.BandStatistics(range(3))
+    statistics.update(values)
+    means = np.array([4.0, 0.0, 0.5])
+    pixel_statistics = band_statistics.pixel_statistics_dataframe(statistics, means, np.ones(3))
+    np.testing.assert_allclose(pixel_statistics['std'], np.sqrt(np.nanmean((values - means) ** 2, axis=0)))
+    np.testing.assert_array_equal(pixel_statistics['mean'], means)
@@ -0,0 +1,122 @@
+"""
+Checks incremental rebuilds (incremental_build.py): which previous metadata rows are kept when
+units are replaced, added or removed, and how manifests (tile_manifest.py) are rebuilt.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+import incremental_build
+import tile_manifest
+
+
+def write_array(filename, value):
+    np.save(filename, np.full(3, value, dtype=np.float32))
+    return filename
+
+
+def run_build(state_file, units, old_metadata=None):
+    """
+    Simulates one incremental build. "units" maps unit name -> (inputs hash, output files). Units
+    whose inputs changed are rebuilt: their files are (re)written, and get metadata rows. Returns
+    the merged metadata.
+    """
+    build_state = incremental_build.BuildState(state_file)
+    new_rows = []
+    for unit, (inputs_hash, output_files) in units.items():
+        if not build_state.needs_build(unit, inputs_hash):
+            continue
+        unit_outputs = build_state.start_unit(unit, inputs_hash)
+        for filename in output_files:
+            write_array(filename, len(new_rows))
+            unit_outputs.append(filename)
+            new_rows.append({'tile_file': filename, 'SIF': float(len(new_rows))})
+    metadata = build_state.merge_metadata(old_metadata, pd.DataFrame(new_rows, columns=['tile_file', 'SIF']))
+    build_state.save()
+    return metadata
+
+
+def test_replaced_added_and_removed_units(tmp_path):
+    state_file = str(tmp_path / 'build_state.json')
+    a, b, c, c2, d = [str(tmp_path / (name + '.npy')) for name in ['a', 'b', 'c', 'c2', 'd']]
+
+    metadata = run_build(state_file, {'u1': ('h1', [a, b]), 'u2': ('h2', [c])})
+    assert metadata['tile_file'].tolist() == [a, b, c]
+
+    # u2's inputs changed (it now writes a different file), and u3 is new: u1's rows are kept
+    metadata = run_build(state_file, {'u1': ('h1', [a, b]), 'u2': ('h2 changed', [c2]), 'u3': ('h3', [d])}, metadata)
+    assert sorted(metadata['tile_file']) == sorted([a, b, c2, d])
+
+    # u1 no longer exists: its rows are dropped, the others are kept as they are
+    metadata = run_build(state_file, {'u2': ('h2 changed', [c2]), 'u3': ('h3', [d])}, metadata)
+    assert sorted(metadata['tile_file']) == sorted([c2, d])
+
+
+def test_rebuilt_unit_rewriting_same_file_has_one_row(tmp_path):
+    state_file = str(tmp_path / 'build_state.json')
+    a = str(tmp_path / 'a.npy')
+    metadata = run_build(state_file, {'u1': ('h1', [a])})
+    metadata = run_build(state_file, {'u1': ('h1 changed', [a])}, metadata)
+    assert metadata['tile_file'].tolist() == [a]
+
+
+def test_unit_with_missing_output_is_rebuilt(tmp_path):
+    state_file = str(tmp_path / 'build_state.json')
+    a, b = str(tmp_path / 'a.npy'), str(tmp_path / 'b.npy')
+    metadata = run_build(state_file, {'u1': ('h1', [a]), 'u2': ('h2', [b])})
+    os.remove(b)
+    metadata = run_build(state_file, {'u1': ('h1', [a]), 'u2': ('h2', [b])}, metadata)
+    assert sorted(metadata['tile_file']) == sorted([a, b])
+    assert os.path.isfile(b)
+
+
+def test_rows_without_unit_are_replaced(tmp_path):
+    # Rows written before build states existed are not kept (their unit rewrites them)
+    state_file = str(tmp_path / 'build_state.json')
+    a, legacy = str(tmp_path / 'a.npy'), str(tmp_path / 'legacy.npy')
+    old_metadata = pd.DataFrame({'tile_file': [legacy, a], 'SIF': [0.0, 1.0]})
+    metadata = run_build(state_file, {'u1': ('h1', [a])}, old_metadata)
+    assert metadata['tile_file'].tolist() == [a]
+
+
+def test_inputs_hash_changes_with_file_contents(tmp_path):
+    build_state = incremental_build.BuildState(str(tmp_path / 'build_state.json'))
+    input_file = write_array(str(tmp_path / 'input.npy'), 1)
+    first_hash = build_state.inputs_hash([input_file], params=[1, 'x'])
+    assert build_state.inputs_hash([input_file], params=[1, 'x']) == first_hash
+    assert build_state.inputs_hash([input_file], params=[2, 'x']) != first_hash
+    write_array(input_file, 2)
+    os.utime(input_file, ns=(0, 12345))
+    assert build_state.inputs_hash([input_file], params=[1, 'x']) != first_hash
+
+
+def test_manifest_rebuilt_with_new_entries(tmp_path):
+    manifest_filename = str(tmp_path / 'metadata_manifest.csv')
+    a, b, c = [write_array(str(tmp_path / (name + '.npy')), 0) for name in ['a', 'b', 'c']]
+    writer = tile_manifest.ManifestWriter('first')
+    writer.add(a)
+    writer.add(b)
+    writer.write(manifest_filename)
+
+    # Second run: b is rewritten, and c (written before manifests existed) is referenced but
+    # was not recorded in this run; a is no longer referenced
+    write_array(b, 1)
+    writer = tile_manifest.ManifestWriter('second')
+    writer.add(b)
+    writer.write(manifest_filename, files=[b, c], append=True)
+    manifest = pd.read_csv(manifest_filename, keep_default_na=False, dtype={'checksum': str})
+    assert manifest['path'].tolist() == [b, c]
+    assert manifest['stage'].tolist() == ['second', 'second']
+    assert tile_manifest.validate_files(manifest_filename) == []
+
+    # Third run: nothing rewritten, so the existing entries are kept
+    writer = tile_manifest.ManifestWriter('third')
+    writer.write(manifest_filename, files=[c, b], append=True)
+    manifest = pd.read_csv(manifest_filename, keep_default_na=False, dtype={'checksum': str})
+    assert manifest['path'].tolist() == [c, b]
+    assert manifest['stage'].tolist() == ['second', 'second']
+
+    # A file changed after the manifest was written is reported
+    write_array(c, 2)
+    problems = tile_manifest.validate_files(manifest_filename, files=[b, c])
+    assert len(problems) == 1 and problems[0].startswith(c)
@@ -0,0 +1,87 @@
+"""
+Checks the epoch accounting of MultiSourceDataLoader (datasets.py): batches per dataset under
+"ratios", ratio-0 datasets read exactly once per epoch, the worker split, and epochs continuing
+from the last consumed batch.
+"""
+import collections
+import torch
+from torch.utils.data import Dataset
+
+from datasets import MultiSourceDataLoader
+
+
+class IndexDataset(Dataset):
+    def __init__(self, num_items):
+        self.num_items = num_items
+
+    def __len__(self):
+        return self.num_items
+
+    def __getitem__(self, idx):
+        return idx
+
+
+def epoch_batches(loader):
+    # (dataset name, list of items) of each batch of one epoch
+    batches = []
+    for batch in loader:
+        (name, items), = batch.items()
+        batches.append((name, items.tolist()))
+    return batches
+
+
+def test_batches_per_dataset_follow_ratios():
+    datasets = {'a': IndexDataset(100), 'b': IndexDataset(100), 'c': IndexDataset(25)}
+    loader = MultiSourceDataLoader(datasets, batch_size=10, ratios={'a': 2, 'b': 1, 'c': 0}, num_batches=30,
+                                   generator=torch.Generator().manual_seed(0))
+    assert loader.num_batches == {'a': 20, 'b': 10, 'c': 3}
+    assert len(loader) == 33
+    for _ in range(2):
+        counts = collections.Counter(name for name, _ in epoch_batches(loader))
+        assert counts == {'a': 20, 'b': 10, 'c': 3}
+
+
+def test_default_num_batches_reads_no_dataset_twice():
+    datasets = {'a': IndexDataset(40), 'b': IndexDataset(100)}
+    loader = MultiSourceDataLoader(datasets, batch_size=10, ratios={'a': 1, 'b': 1})
+    assert loader.num_batches == {'a': 4, 'b': 4}
+
+
+def test_ratio_zero_dataset_read_exactly_once_per_epoch():
+    datasets = {'train': IndexDataset(50), 'score_only': IndexDataset(23)}
+    loader = MultiSourceDataLoader(datasets, batch_size=5, ratios={'train': 1}, num_batches=4,
+                                   generator=torch.Generator().manual_seed(0))
+    for _ in range(3):
+        items = [item for name, batch_items in epoch_batches(loader) if name == 'score_only' for item in batch_items]
+        assert sorted(items) == list(range(23))
+
+
+def test_epochs_continue_through_passes():
+    loader = MultiSourceDataLoader({'a': IndexDataset(30)}, batch_size=4, ratios={'a': 1}, num_batches=3,
+                                   generator=torch.Generator().manual_seed(0))
+    items = [item for _ in range(5) for _, batch_items in epoch_batches(loader) for item in batch_items]
+
+    # A pass is 8 batches (the last with 2 items); 15 batches cover one pass and most of the next
+    assert sorted(items[:30]) == list(range(30))
+    assert len(set(items[30:])) == len(items[30:])
+
+
+def test_partially_consumed_epoch_does_not_skip_batches():
+    loader = MultiSourceDataLoader({'a': IndexDataset(40)}, batch_size=4, ratios={'a': 1}, num_batches=10,
+                                   num_workers=2, shuffle=False)
+    items = []
+    for batch_idx, batch in enumerate(loader):
+        items.extend(batch['a'].tolist())
+        if batch_idx == 2:
+            break
+    for batch in loader:
+        items.extend(batch['a'].tolist())
+    assert items[:40] == list(range(40))
+
+
+def test_workers_split_by_share_of_batches():
+    datasets = {'a': IndexDataset(100), 'b': IndexDataset(100), 'c': IndexDataset(100)}
+    loader = MultiSourceDataLoader(datasets, batch_size=10, ratios={'a': 1, 'b': 1, 'c': 1}, num_workers=4)
+    workers = {name: dataset_loader.num_workers for name, dataset_loader in loader.loaders.items()}
+    assert sum(workers.values()) == 4
+    assert sorted(workers.values()) == [1, 1, 2]
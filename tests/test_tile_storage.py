@@ -0,0 +1,86 @@
+"""
+Round-trip checks of the packed tile format and fine SIF labels (tile_storage.py).
+"""
+import numpy as np
+
+import tile_storage
+
+
+def random_tile(rng, height=7, width=9):
+    # Dense tile: random continuous bands, at most one cover mask per pixel, random missing mask.
+    # Odd sizes, so that the bit-packed missing mask does not fill whole bytes.
+    tile = np.zeros((tile_storage.NUM_INPUT_BANDS, height, width), dtype=np.float32)
+    tile[tile_storage.CONTINUOUS_BANDS] = rng.normal(size=(len(tile_storage.CONTINUOUS_BANDS), height, width))
+    cover_class = rng.integers(0, len(tile_storage.COVER_BANDS) + 1, size=(height, width))
+    rows, cols = np.nonzero(cover_class)
+    tile[tile_storage.COVER_BANDS[0] - 1 + cover_class[rows, cols], rows, cols] = 1
+    tile[tile_storage.MISSING_REFLECTANCE_BAND] = rng.random((height, width)) < 0.3
+    return tile
+
+
+def test_packed_tile_round_trip(tmp_path):
+    tile = random_tile(np.random.default_rng(0))
+    filename = str(tmp_path / ('tile' + tile_storage.PACKED_TILE_EXTENSION))
+    tile_storage.save_packed_tile(filename, tile)
+    loaded = tile_storage.load_tile(filename)
+    assert loaded.dtype == np.float32
+    np.testing.assert_array_equal(loaded, tile)
+
+    bands = [3, tile_storage.MISSING_REFLECTANCE_BAND, tile_storage.COVER_BANDS[4], 0]
+    np.testing.assert_array_equal(tile_storage.load_tile(filename, bands=bands), tile[bands])
+
+    # Dense (.npy) tiles are read as they are
+    dense_filename = str(tmp_path / ('tile' + tile_storage.DENSE_TILE_EXTENSION))
+    np.save(dense_filename, tile)
+    np.testing.assert_array_equal(tile_storage.load_tile(dense_filename), tile)
+
+
+def test_missing_reflectance_mask_is_bit_packed():
+    tile = random_tile(np.random.default_rng(1), height=5, width=5)
+    packed = tile_storage.pack_tile(tile)
+    assert packed['missing_reflectance'].dtype == np.uint8
+    assert packed['missing_reflectance'].shape == (4,)  # ceil(25 / 8) bytes
+    np.testing.assert_array_equal(tile_storage.unpack_missing_reflectance(packed['missing_reflectance'], 5, 5),
+                                  tile[tile_storage.MISSING_REFLECTANCE_BAND])
+
+
+def test_quantized_round_trip_error_bound(tmp_path):
+    rng = np.random.default_rng(2)
+    tile = random_tile(rng)
+    band_means = np.zeros(tile_storage.NUM_INPUT_BANDS)
+    band_stds = np.ones(tile_storage.NUM_INPUT_BANDS)
+    band_means[tile_storage.CONTINUOUS_BANDS] = rng.normal(size=len(tile_storage.CONTINUOUS_BANDS))
+    band_stds[tile_storage.CONTINUOUS_BANDS] = rng.uniform(0.5, 2, size=len(tile_storage.CONTINUOUS_BANDS))
+    tile[tile_storage.CONTINUOUS_BANDS] = (band_means[tile_storage.CONTINUOUS_BANDS, np.newaxis, np.newaxis] +
+                                           tile[tile_storage.CONTINUOUS_BANDS] * band_stds[tile_storage.CONTINUOUS_BANDS, np.newaxis, np.newaxis])
+    quantization = tile_storage.quantization_params(band_means, band_stds)
+
+    filename = str(tmp_path / ('tile' + tile_storage.PACKED_TILE_EXTENSION))
+    tile_storage.save_packed_tile(filename, tile, quantization=quantization)
+    with np.load(filename) as packed_file:
+        assert packed_file['continuous_quantized'].dtype == np.int16
+        assert 'continuous' not in packed_file
+    loaded = tile_storage.load_tile(filename)
+
+    # Continuous bands are within the quantization error (after standardization); other bands are exact
+    standardized_error = np.abs(loaded - tile)[tile_storage.CONTINUOUS_BANDS] / band_stds[tile_storage.CONTINUOUS_BANDS, np.newaxis, np.newaxis]
+    assert standardized_error.max() <= tile_storage.MAX_QUANTIZATION_ERROR_STDS * 1.01
+    np.testing.assert_array_equal(loaded[12:], tile[12:])
+
+    # Values beyond the quantized range saturate
+    tile[0, 0, 0] = band_means[0] + 100 * band_stds[0]
+    packed = tile_storage.pack_tile(tile, quantization=quantization)
+    assert packed['continuous_quantized'][0, 0, 0] == tile_storage.QUANTIZED_MAX
+
+
+def test_fine_sif_labels_round_trip(tmp_path):
+    rng = np.random.default_rng(3)
+    fine_sif = rng.random((6, 4))
+    fine_sif_mask = rng.random((6, 4)) < 0.5
+    fine_soundings = rng.integers(0, 50, size=(6, 4)).astype(np.float64)
+    filename = str(tmp_path / 'fine_sif.npy')
+    tile_storage.save_fine_sif_labels(filename, np.ma.array(fine_sif, mask=fine_sif_mask), fine_soundings)
+    loaded_sif, loaded_mask, loaded_soundings = tile_storage.load_fine_sif_labels(filename)
+    np.testing.assert_allclose(loaded_sif, fine_sif.astype(loaded_sif.dtype))
+    np.testing.assert_array_equal(loaded_mask, fine_sif_mask)
+    np.testing.assert_array_equal(loaded_soundings, fine_soundings)
@@ -0,0 +1,176 @@
+"""
+Manifests of the files written by the dataset builders (input tiles, fine SIF labels, shards).
+
+Each builder records every file it writes, and saves a manifest (a CSV file) next to its output,
+with one row per file: path, array shape and dtype, size in bytes, CRC-32 checksum, and the
+stage (builder) that produced it. Before a long training or evaluation run, validate_files()
+checks the files against the manifest in one pass (optionally using several threads), so that
+missing or truncated files are found up front, instead of as a worker crash in the middle of
+an epoch.
+"""
+import concurrent.futures
+import os
+import zlib
+import numpy as np
+import pandas as pd
+
+import tile_storage
+
+MANIFEST_COLUMNS = ['path', 'shape', 'dtype', 'num_bytes', 'checksum', 'stage']
+SHARD_MANIFEST_FILE = 'shard_manifest.csv'
+CHECKSUM_CHUNK_BYTES = 1 << 20
+
+# Maximum number of problems to print
+MAX_PROBLEMS_TO_PRINT = 20
+
+
+def manifest_file(metadata_file):
+    """Returns the path of the manifest of the files referenced by the given metadata file."""
+    return os.path.splitext(metadata_file)[0] + '_manifest.csv'
+
+
+def shard_manifest_file(shard_dir):
+    return os.path.join(shard_dir, SHARD_MANIFEST_FILE)
+
+
+def file_checksum(filename):
+    """Returns the CRC-32 checksum of the file's contents, as a hex string."""
+    checksum = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHECKSUM_CHUNK_BYTES)
+            if not chunk:
+                break
+            checksum = zlib.crc32(chunk, checksum)
+    return format(checksum, '08x')
+
+
+def array_info(filename):
+    """
+    Returns the (shape, dtype) of the array stored in "filename", as strings. For packed tiles
+    (.npz), this is the shape of the dense tile they decode to. Old (pickled) fine SIF files
+    have no header, so their shape and dtype are empty.
+    """
+    if filename.endswith(tile_storage.PACKED_TILE_EXTENSION):
+        with np.load(filename) as packed_file:
+            height, width = packed_file['cover_class'].shape
+        return str((tile_storage.NUM_INPUT_BANDS, height, width)), str(np.dtype(np.float32))
+    if tile_storage.is_pickled_fine_sif_file(filename):
+        return '', ''
+    array = np.load(filename, mmap_mode='r')
+    return str(array.shape), str(array.dtype)
+
+
+def manifest_entry(filename, stage):
+    shape, dtype = array_info(filename)
+    return {'path': filename, 'shape': shape, 'dtype': dtype, 'num_bytes': os.path.getsize(filename),
+            'checksum': file_checksum(filename), 'stage': stage}
+
+
+class ManifestWriter(object):
+    """
+    Records the files written by one dataset builder ("stage"). Call add() after each file is
+    written (or rewritten), and write() to save the manifest.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.entries = dict()
+
+    def add(self, filename):
+        self.entries[filename] = manifest_entry(filename, self.stage)
+
+    def write(self, manifest_filename, files=None, append=False):
+        """
+        Writes the entries of "files" (all recorded files if None) to "manifest_filename". If
+        "append" is True, existing entries of the manifest are kept (unless they were recorded again);
+        if "files" is also given, only the existing entries of "files" are kept.
+        """
+        old_manifest = None
+        if append and os.path.isfile(manifest_filename):
+            old_manifest = pd.read_csv(manifest_filename, keep_default_na=False, dtype={'checksum': str})
+        if files is None:
+            manifest = pd.DataFrame(list(self.entries.values()), columns=MANIFEST_COLUMNS)
+            if old_manifest is not None:
+                manifest = pd.concat([old_manifest[~old_manifest['path'].isin(manifest['path'])], manifest])
+        else:
+            # Files that were not recorded in this run keep their existing entry (files missing from
+            # the existing manifest, e.g. written before manifests existed, are recorded now)
+            old_entries = dict()
+            if old_manifest is not None:
+                old_entries = {row['path']: row for row in old_manifest.to_dict('records')}
+            entries = []
+            for filename in pd.unique(np.asarray(files)):
+                if filename in self.entries:
+                    entries.append(self.entries[filename])
+                elif filename in old_entries:
+                    entries.append(old_entries[filename])
+                else:
+                    entries.append(manifest_entry(filename, self.stage))
+            manifest = pd.DataFrame(entries, columns=MANIFEST_COLUMNS)
+        manifest.to_csv(manifest_filename, index=False)
+        print('Wrote manifest', manifest_filename, '(' + str(len(manifest)) + ' files)')
+
+
+def check_entry(entry, verify_checksum=True):
+    """
+    Checks one manifest entry (a dict with MANIFEST_COLUMNS) against the file on disk. Returns a
+    description of the problem, or None if the file is OK.
+    """
+    filename = entry['path']
+    if not os.path.isfile(filename):
+        return filename + ': missing'
+    num_bytes = os.path.getsize(filename)
+    if num_bytes != int(entry['num_bytes']):
+        return filename + ': size is ' + str(num_bytes) + ' bytes, expected ' + str(entry['num_bytes'])
+    try:
+        shape, dtype = array_info(filename)
+    except Exception as e:
+        return filename + ': could not be read (' + str(e) + ')'
+    if shape != entry['shape'] or dtype != entry['dtype']:
+        return filename + ': has shape ' + shape + ' and dtype ' + dtype + ', expected ' + entry['shape'] + ' and ' + entry['dtype']
+    if verify_checksum and file_checksum(filename) != entry['checksum']:
+        return filename + ': checksum does not match (file was modified or corrupted)'
+    return None
+
+
+def validate_files(manifest_filename, files=None, num_workers=1, verify_checksums=True):
+    """
+    Checks files against the manifest "manifest_filename": all files in the manifest, or only
+    "files" (which must then all be listed in the manifest). Uses "num_workers" threads. Returns a
+    list of problems (empty if all files are OK).
+    """
+    manifest = pd.read_csv(manifest_filename, keep_default_na=False, dtype={'checksum': str})
+    problems = []
+    if files is not None:
+        files = pd.unique(np.asarray(files))
+        unlisted = np.setdiff1d(files, manifest['path'].values)
+        problems.extend([filename + ': not listed in ' + manifest_filename for filename in unlisted])
+        manifest = manifest[manifest['path'].isin(files)]
+
+    entries = manifest.to_dict('records')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        results = executor.map(lambda entry: check_entry(entry, verify_checksums), entries)
+        problems.extend([problem for problem in results if problem is not None])
+    return problems
+
+
+def validate_or_exit(manifest_files_to_check, num_workers=1, verify_checksums=True):
+    """
+    Validates a list of (manifest file, files to check or None) pairs (see validate_files), and
+    exits if any file has a problem. Manifests that don't exist (e.g. for datasets built before
+    manifests were written) are skipped with a warning.
+    """
+    problems = []
+    for manifest_filename, files in manifest_files_to_check:
+        if not os.path.isfile(manifest_filename):
+            print('WARNING: no manifest', manifest_filename, '- not validating these files')
+            continue
+        problems.extend(validate_files(manifest_filename, files, num_workers=num_workers, verify_checksums=verify_checksums))
+    if len(problems) > 0:
+        print('Found', len(problems), 'problems with dataset files:')
+        for problem in problems[:MAX_PROBLEMS_TO_PRINT]:
+            print('   ', problem)
+        if len(problems) > MAX_PROBLEMS_TO_PRINT:
+            print('    ...')
+        exit(1)
+    print('All dataset files match their manifests')
@@ -0,0 +1,635 @@
+"""
+On-disk storage formats for input tiles.
+
+A dense input tile is a float32 array of shape (band x lat x long) with 43 bands:
+12 continuous bands (Landsat reflectance and FLDAS), 30 binary CDL cover masks, and a
+binary missing-reflectance mask. Since each pixel has at most one cover type, the
+packed format stores the 30 cover masks as a single uint8 "class index" plane, and the
+missing-reflectance mask as a bit plane. Only the continuous bands are stored as floats
+(optionally quantized to int16, see "Quantized continuous bands").
+"""
+import collections
+import json
+import os
+import numpy as np
+import pandas as pd
+
+NUM_INPUT_BANDS = 43
+CONTINUOUS_BANDS = list(range(0, 12))
+COVER_BANDS = list(range(12, 42))
+MISSING_REFLECTANCE_BAND = 42
+
+# In the cover class plane, 0 means the pixel is not one of the masked cover types,
+# and k+1 means the pixel has the cover type of band COVER_BANDS[k].
+NO_COVER_CLASS = 0
+
+PACKED_TILE_EXTENSION = '.npz'
+DENSE_TILE_EXTENSION = '.npy'
+
+# Quantized continuous bands (see "quantize_continuous") cover each band's mean +/- this many
+# standard deviations; values further from the mean are saturated. This range is much wider than
+# the range inputs are clipped to (ClipTile, usually +/- 3 standard deviations).
+QUANTIZED_STD_RANGE = 16
+QUANTIZED_MAX = np.iinfo(np.int16).max
+
+# Maximum error of a (non-saturated) quantized value, after standardization
+MAX_QUANTIZATION_ERROR_STDS = QUANTIZED_STD_RANGE / (2 * QUANTIZED_MAX)
+
+
+# ========================= Quantized continuous bands =========================
+# The continuous bands can optionally be stored as int16 "q", with a per-band scale and offset:
+#     value = offset + q * scale
+# where offset is the band's mean, and scale is chosen so that the int16 range covers
+# +/- QUANTIZED_STD_RANGE standard deviations. Since the bands are standardized right after
+# loading, the quantization error of a standardized value is at most MAX_QUANTIZATION_ERROR_STDS.
+def quantization_params(band_means, band_stds):
+    """
+    Returns (scale, offset) float32 arrays for quantizing the continuous bands, given the
+    mean/std of each band of the dense tile (e.g. from cfis_band_statistics_train.csv).
+    """
+    band_means = np.asarray(band_means, dtype=np.float64)[CONTINUOUS_BANDS]
+    band_stds = np.asarray(band_stds, dtype=np.float64)[CONTINUOUS_BANDS]
+    assert np.all(band_stds > 0)
+    scale = band_stds * QUANTIZED_STD_RANGE / QUANTIZED_MAX
+    return scale.astype(np.float32), band_means.astype(np.float32)
+
+
+def read_quantization_params(band_statistics_file):
+    """
+    Reads quantization parameters from a band statistics file (with "mean" and "std" columns,
+    one row per band of the dense tile).
+    """
+    band_statistics = pd.read_csv(band_statistics_file)
+    return quantization_params(band_statistics['mean'].values, band_statistics['std'].values)
+
+
+def quantize_continuous(continuous, scale, offset):
+    """
+    Quantizes a (12 x H x W) array of continuous bands to int16 (saturating out-of-range values)
+    """
+    assert np.all(np.isfinite(continuous))
+    quantized = np.rint((continuous - offset[:, np.newaxis, np.newaxis]) / scale[:, np.newaxis, np.newaxis])
+    return np.clip(quantized, -QUANTIZED_MAX, QUANTIZED_MAX).astype(np.int16)
+
+
+def dequantize_continuous(quantized, scale, offset):
+    """
+    Inverse of "quantize_continuous" (up to quantization error). Returns float32.
+    """
+    return offset[:, np.newaxis, np.newaxis] + quantized.astype(np.float32) * scale[:, np.newaxis, np.newaxis]
+
+
+def cover_class_table(cover_codes):
+    """
+    Returns a 256-entry lookup table from CDL code to cover class: k+1 for cover_codes[k] (the
+    code of the cover mask in band COVER_BANDS[k]), NO_COVER_CLASS for all other codes.
+    """
+    assert len(cover_codes) == len(COVER_BANDS) and len(set(cover_codes)) == len(cover_codes)
+    table = np.full(256, NO_COVER_CLASS, dtype=np.uint8)
+    table[np.asarray(cover_codes)] = np.arange(1, len(cover_codes) + 1)
+    return table
+
+
+def encode_cover_classes(cover_codes, table):
+    """
+    Converts a (H x W) plane of CDL codes into a cover class plane (uint8, as stored in packed
+    tiles), with a single table lookup per pixel ("table" comes from "cover_class_table").
+    """
+    if cover_codes.dtype == np.uint8:
+        return table[cover_codes]
+    in_table = (cover_codes >= 0) & (cover_codes < len(table))
+    return np.where(in_table, table[np.where(in_table, cover_codes, 0)], NO_COVER_CLASS).astype(np.uint8)
+
+
+def dense_tile(continuous, cover_class, missing_reflectance):
+    """
+    Builds a dense (43 x H x W) float32 tile from its continuous bands (12 x H x W), its cover
+    class plane and its missing-reflectance mask (H x W).
+    """
+    height, width = cover_class.shape
+    tile = np.zeros((NUM_INPUT_BANDS, height, width), dtype=np.float32)
+    tile[CONTINUOUS_BANDS] = continuous
+    tile[MISSING_REFLECTANCE_BAND] = missing_reflectance
+
+    # Set the cover mask of each pixel that has a cover type
+    rows, cols = np.nonzero(cover_class)
+    tile[COVER_BANDS[0] - 1 + cover_class[rows, cols].astype(int), rows, cols] = 1
+    return tile
+
+
+def band_averages(continuous, cover_class, missing_reflectance):
+    """
+    Returns the average of each band of the dense tile built from these planes (see dense_tile),
+    without building it: the missing-reflectance mask is averaged over all pixels, and the other
+    bands over the pixels with reflectance data (NaN if there are none), as in
+    sif_utils.compute_band_averages. Cover masks are averaged by counting the cover classes.
+    """
+    valid = ~missing_reflectance.reshape(-1).astype(bool)
+    num_valid = np.count_nonzero(valid)
+    averages = np.empty(NUM_INPUT_BANDS, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages[CONTINUOUS_BANDS] = continuous.reshape((continuous.shape[0], -1))[:, valid].sum(axis=1, dtype=np.float64) / num_valid
+        class_counts = np.bincount(cover_class.reshape(-1)[valid], minlength=len(COVER_BANDS) + 1)
+        averages[COVER_BANDS] = class_counts[1:] / num_valid
+    averages[MISSING_REFLECTANCE_BAND] = (valid.size - num_valid) / valid.size
+    return averages.astype(np.float32)
+
+
+def pack_tile_planes(continuous, cover_class, missing_reflectance, quantization=None):
+    """
+    Like "pack_tile", but takes the continuous bands (12 x H x W), cover class plane and
+    missing-reflectance mask directly, instead of a dense tile.
+    """
+    packed = {'cover_class': cover_class.astype(np.uint8),
+              'missing_reflectance': np.packbits(missing_reflectance.astype(bool), axis=None)}
+    if quantization is None:
+        packed['continuous'] = continuous.astype(np.float32)
+    else:
+        scale, offset = quantization
+        packed['continuous_quantized'] = quantize_continuous(continuous, scale, offset)
+        packed['continuous_scale'] = scale
+        packed['continuous_offset'] = offset
+    return packed
+
+
+def pack_tile(tile, quantization=None):
+    """
+    Converts a dense (43 x H x W) tile into a dictionary of packed arrays:
+        "continuous": (12 x H x W) float32 array of the continuous bands
+        "cover_class": (H x W) uint8 array containing the cover class index of each pixel
+        "missing_reflectance": missing-reflectance mask, packed into bits (np.packbits)
+    If "quantization" (a (scale, offset) tuple, see "quantization_params") is given, the
+    continuous bands are instead stored as "continuous_quantized" (int16), along with
+    "continuous_scale" and "continuous_offset".
+    """
+    assert tile.ndim == 3 and tile.shape[0] == NUM_INPUT_BANDS
+    cover_masks = tile[COVER_BANDS, :, :]
+    missing_reflectance = tile[MISSING_REFLECTANCE_BAND, :, :]
+
+    # The packed format can only represent binary, mutually-exclusive cover masks
+    assert np.all((cover_masks == 0) | (cover_masks == 1))
+    assert np.all(np.sum(cover_masks, axis=0) <= 1)
+    assert np.all((missing_reflectance == 0) | (missing_reflectance == 1))
+
+    has_cover = np.any(cover_masks, axis=0)
+    cover_class = np.where(has_cover, np.argmax(cover_masks, axis=0) + 1, NO_COVER_CLASS).astype(np.uint8)
+    return pack_tile_planes(tile[CONTINUOUS_BANDS, :, :], cover_class, missing_reflectance, quantization=quantization)
+
+
+def unpack_continuous(packed, band_indices=None):
+    """
+    Returns the continuous bands of a packed tile as float32 (dequantizing them if needed).
+    If "band_indices" is given, only those continuous bands (indices into CONTINUOUS_BANDS) are returned.
+    """
+    if 'continuous_quantized' not in packed:
+        if band_indices is None:
+            return packed['continuous']
+        return packed['continuous'][band_indices]
+    scale = packed['continuous_scale']
+    offset = packed['continuous_offset']
+    if band_indices is None:
+        return dequantize_continuous(packed['continuous_quantized'], scale, offset)
+    return dequantize_continuous(packed['continuous_quantized'][band_indices], scale[band_indices], offset[band_indices])
+
+
+def unpack_missing_reflectance(packed_missing_reflectance, height, width):
+    """
+    Expands a bit-packed missing-reflectance mask into a (H x W) uint8 array
+    """
+    return np.unpackbits(packed_missing_reflectance, count=height * width).reshape((height, width))
+
+
+def unpack_tile(packed, expand_covers=True):
+    """
+    Inverse of "pack_tile". If "expand_covers" is True, returns the dense (43 x H x W) float32 tile.
+    Otherwise, the cover masks are not expanded: returns a (13 x H x W) float32 tile containing
+    the continuous bands followed by the missing-reflectance mask, along with the (H x W)
+    cover class plane (which can be passed straight to a model with an embedding layer).
+    """
+    continuous = unpack_continuous(packed)
+    cover_class = packed['cover_class']
+    height, width = cover_class.shape
+    missing_reflectance = unpack_missing_reflectance(packed['missing_reflectance'], height, width)
+
+    if not expand_covers:
+        tile = np.empty((len(CONTINUOUS_BANDS) + 1, height, width), dtype=np.float32)
+        tile[0:len(CONTINUOUS_BANDS)] = continuous
+        tile[-1] = missing_reflectance
+        return tile, cover_class
+
+    return dense_tile(continuous, cover_class, missing_reflectance)
+
+
+def unpack_tile_bands(packed, bands):
+    """
+    Like "unpack_tile", but only constructs the requested bands (indices into the dense
+    43-band tile). Returns a (len(bands) x H x W) float32 array. Continuous bands that are not
+    requested are never read (or dequantized).
+    """
+    bands = list(bands)
+    for band in bands:
+        if band < 0 or band >= NUM_INPUT_BANDS:
+            raise ValueError('Invalid band ' + str(band))
+    cover_class = packed['cover_class']
+    height, width = cover_class.shape
+    tile = np.empty((len(bands), height, width), dtype=np.float32)
+
+    continuous_positions = [i for i, band in enumerate(bands) if band in CONTINUOUS_BANDS]
+    if len(continuous_positions) > 0:
+        tile[continuous_positions] = unpack_continuous(packed, [CONTINUOUS_BANDS.index(bands[i]) for i in continuous_positions])
+    for i, band in enumerate(bands):
+        if band in COVER_BANDS:
+            tile[i] = (cover_class == band - COVER_BANDS[0] + 1)
+        elif band == MISSING_REFLECTANCE_BAND:
+            tile[i] = unpack_missing_reflectance(packed['missing_reflectance'], height, width)
+    return tile
+
+
+def save_packed_tile(filename, tile, quantization=None):
+    """
+    Writes a dense (43 x H x W) tile to "filename" (which should end in ".npz") in packed format
+    (with quantized continuous bands, if "quantization" is given)
+    """
+    np.savez(filename, **pack_tile(tile, quantization=quantization))
+
+
+def save_packed_tile_planes(filename, continuous, cover_class, missing_reflectance, quantization=None):
+    """
+    Like "save_packed_tile", but takes the planes of the tile (see "pack_tile_planes"), which
+    avoids re-deriving the cover class plane from the dense cover masks.
+    """
+    np.savez(filename, **pack_tile_planes(continuous, cover_class, missing_reflectance, quantization=quantization))
+
+
+def load_packed_tile(filename):
+    """
+    Reads the packed arrays of a tile written by "save_packed_tile"
+    """
+    with np.load(filename) as packed_file:
+        return {key: packed_file[key] for key in packed_file.files}
+
+
+def load_tile(filename, expand_covers=True, bands=None):
+    """
+    Reads an input tile, which may either be stored in packed format (.npz), or as a dense
+    (43 x H x W) array (.npy). See "unpack_tile" for the meaning of "expand_covers".
+    If "bands" is given, only those bands of the dense tile are read (and "expand_covers" is ignored).
+    """
+    if filename.endswith(PACKED_TILE_EXTENSION):
+        if bands is not None:
+            return unpack_tile_bands(load_packed_tile(filename), bands)
+        return unpack_tile(load_packed_tile(filename), expand_covers=expand_covers)
+
+    if bands is not None:
+        return np.asarray(np.load(filename, mmap_mode='r')[list(bands)])
+    tile = np.load(filename)
+    if expand_covers:
+        return tile
+    return unpack_tile(pack_tile(tile), expand_covers=False)
+
+
+class TileCache(object):
+    """
+    Least-recently-used cache of tiles read by "loader" (load_tile by default), keeping at most
+    "max_bytes" of tile arrays in memory. Calling the cache with a filename returns the tile
+    (read-only, since it is shared), so the cache can be passed as the "tile_loader" of
+    sif_utils.extract_input_subtile.
+    """
+    def __init__(self, max_bytes, loader=load_tile):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.tiles = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, filename):
+        if filename in self.tiles:
+            self.hits += 1
+            self.tiles.move_to_end(filename)
+            return self.tiles[filename]
+        self.misses += 1
+        tile = self.loader(filename)
+        tile.setflags(write=False)
+        if tile.nbytes > self.max_bytes:
+            return tile
+        self.tiles[filename] = tile
+        self.num_bytes += tile.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted_tile = self.tiles.popitem(last=False)
+            self.num_bytes -= evicted_tile.nbytes
+            self.evictions += 1
+        return tile
+
+    def print_stats(self):
+        hit_rate = self.hits / max(self.hits + self.misses, 1)
+        print('Tile cache: %d hits, %d misses (hit rate %.3f), %d evictions, %d tiles (%.1f MB) in memory' %
+              (self.hits, self.misses, hit_rate, self.evictions, len(self.tiles), self.num_bytes / 1e6))
+
+
+def find_tile_file(filename_without_extension):
+    """
+    Returns the path of the tile with the given name, preferring the packed format.
+    Returns None if the tile does not exist in either format.
+    """
+    for extension in [PACKED_TILE_EXTENSION, DENSE_TILE_EXTENSION]:
+        if os.path.exists(filename_without_extension + extension):
+            return filename_without_extension + extension
+    return None
+
+
+# ============================= Fine SIF labels =============================
+# Fine SIF labels of a tile are stored (without pickling) as a single record, whose fields are
+# contiguous (H x W) planes:
+#     "sif": float32 SIF of each pixel
+#     "soundings": uint16 number of soundings in each pixel
+#     "invalid": bool, True if the pixel is invalid (this is the mask of the old masked arrays)
+# Since each field is a contiguous plane, the file can be memory-mapped and each plane read
+# without copying. Older label files are pickled numpy masked arrays (MaskedArray.dump), with
+# the soundings stored in a separate file.
+MAX_FINE_SOUNDINGS = np.iinfo(np.uint16).max
+
+
+def fine_sif_label_dtype(height, width):
+    return np.dtype([('sif', np.float32, (height, width)),
+                     ('soundings', np.uint16, (height, width)),
+                     ('invalid', np.bool_, (height, width))])
+
+
+def pack_fine_sif_labels(fine_sif, fine_sif_mask, fine_soundings):
+    """
+    Combines (H x W) fine SIF, invalid mask and soundings arrays into a fine SIF label record
+    (an array of shape (1,)).
+    """
+    assert fine_sif.shape == fine_sif_mask.shape == fine_soundings.shape
+    assert np.all(fine_soundings >= 0) and np.all(fine_soundings <= MAX_FINE_SOUNDINGS)
+    assert np.all(np.round(fine_soundings) == fine_soundings), 'Soundings must be integer counts'
+    labels = np.zeros(1, dtype=fine_sif_label_dtype(*fine_sif.shape))
+    labels['sif'][0] = fine_sif
+    labels['soundings'][0] = fine_soundings
+    labels['invalid'][0] = fine_sif_mask
+    return labels
+
+
+def save_fine_sif_labels(filename, fine_sif_array, fine_soundings):
+    """
+    Writes fine SIF labels to "filename". "fine_sif_array" is a masked array (where the mask is
+    True for invalid pixels).
+    """
+    np.save(filename, pack_fine_sif_labels(fine_sif_array.data, np.ma.getmaskarray(fine_sif_array), fine_soundings))
+
+
+def is_pickled_fine_sif_file(filename):
+    """
+    Returns True if "filename" is an old fine SIF file (a pickled masked array)
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(np.lib.format.MAGIC_PREFIX)) != np.lib.format.MAGIC_PREFIX
+
+
+def load_fine_sif_labels(filename, fine_soundings_file=None):
+    """
+    Reads fine SIF labels, and returns (fine_sif, fine_sif_mask, fine_soundings) arrays of shape
+    (H x W). "fine_sif_mask" is True for invalid pixels. For files in the label format above, these are
+    read-only views into the memory-mapped file. For old (pickled) files, the soundings are read
+    from "fine_soundings_file".
+    """
+    if is_pickled_fine_sif_file(filename):
+        fine_sif_array = np.load(filename, allow_pickle=True)
+        fine_soundings = np.load(fine_soundings_file)
+        return fine_sif_array.data, np.ma.getmaskarray(fine_sif_array), fine_soundings
+
+    labels = np.load(filename, mmap_mode='r')
+    return labels['sif'][0], labels['invalid'][0], labels['soundings'][0]
+
+
+# ================================ Tile shards ================================
+# A shard directory stores many packed tiles in a few large arrays, which can be memory-mapped
+# instead of opening one small file per tile:
+#     tiles_continuous.npy:          (num_tiles x 12 x H x W) float32, or int16 if quantized
+#                                    (continuous_scale.npy/continuous_offset.npy then hold the
+#                                    per-band quantization parameters)
+#     tiles_cover_class.npy:         (num_tiles x H x W) uint8
+#     tiles_missing_reflectance.npy: (num_tiles x ceil(H*W/8)) uint8 (bit-packed)
+#     fine_sif_labels.npy:           (num_fine_sif_tiles) fine SIF label records (see above)
+# For each metadata file, "<metadata name>_shard_index.csv" maps each row of the metadata file
+# (in file order) to the offset of its tile, and of its fine SIF labels (or -1 if it has none).
+TILE_SHARD_ARRAYS = ['tiles_continuous', 'tiles_cover_class', 'tiles_missing_reflectance']
+FINE_SIF_SHARD_ARRAYS = ['fine_sif_labels']
+
+
+def shard_array_file(shard_dir, array_name):
+    return os.path.join(shard_dir, array_name + '.npy')
+
+
+def shard_index_file(shard_dir, metadata_file):
+    metadata_name = os.path.splitext(os.path.basename(metadata_file))[0]
+    return os.path.join(shard_dir, metadata_name + '_shard_index.csv')
+
+
+def create_tile_shards(shard_dir, num_tiles, num_fine_sif_tiles, height, width, quantization=None):
+    """
+    Creates (empty) shard arrays on disk, and returns a dictionary mapping each array name
+    to a writable memory-map of it. If "quantization" is given, the continuous bands are stored
+    quantized (tiles should then be packed with the same quantization).
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    continuous_dtype = np.float32
+    if quantization is not None:
+        continuous_dtype = np.int16
+        np.save(shard_array_file(shard_dir, 'continuous_scale'), quantization[0])
+        np.save(shard_array_file(shard_dir, 'continuous_offset'), quantization[1])
+    shapes = {'tiles_continuous': ((num_tiles, len(CONTINUOUS_BANDS), height, width), continuous_dtype),
+              'tiles_cover_class': ((num_tiles, height, width), np.uint8),
+              'tiles_missing_reflectance': ((num_tiles, (height * width + 7) // 8), np.uint8),
+              'fine_sif_labels': ((num_fine_sif_tiles,), fine_sif_label_dtype(height, width))}
+    arrays = dict()
+    for array_name, (shape, dtype) in shapes.items():
+        arrays[array_name] = np.lib.format.open_memmap(shard_array_file(shard_dir, array_name),
+                                                       mode='w+', dtype=dtype, shape=shape)
+    return arrays
+
+
+class TileShardStore(object):
+    """
+    Read-only access to tiles (and fine SIF labels) stored in a shard directory. The arrays are
+    memory-mapped lazily, so each DataLoader worker opens its own mapping (and only the
+    path is pickled when the dataset is sent to workers).
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = {array_name: np.load(shard_array_file(self.shard_dir, array_name), mmap_mode='r')
+                            for array_name in TILE_SHARD_ARRAYS + FINE_SIF_SHARD_ARRAYS}
+            if self._arrays['tiles_continuous'].dtype == np.int16:
+                self._arrays['continuous_scale'] = np.load(shard_array_file(self.shard_dir, 'continuous_scale'))
+                self._arrays['continuous_offset'] = np.load(shard_array_file(self.shard_dir, 'continuous_offset'))
+        return self._arrays
+
+    def read_packed_tile(self, tile_offset):
+        """
+        Returns the packed arrays (see "pack_tile") of the tile at "tile_offset". These are
+        views into the memory-mapped shards; nothing is copied.
+        """
+        arrays = self._get_arrays()
+        packed = {'cover_class': arrays['tiles_cover_class'][tile_offset],
+                  'missing_reflectance': arrays['tiles_missing_reflectance'][tile_offset]}
+        if 'continuous_scale' in arrays:
+            packed['continuous_quantized'] = arrays['tiles_continuous'][tile_offset]
+            packed['continuous_scale'] = arrays['continuous_scale']
+            packed['continuous_offset'] = arrays['continuous_offset']
+        else:
+            packed['continuous'] = arrays['tiles_continuous'][tile_offset]
+        return packed
+
+    def read_tile(self, tile_offset, expand_covers=True, bands=None):
+        """
+        Returns the tile at "tile_offset" (see "unpack_tile"). If "bands" is given, only those
+        bands are read from the shards (see "unpack_tile_bands").
+        """
+        if bands is not None:
+            return unpack_tile_bands(self.read_packed_tile(tile_offset), bands)
+        return unpack_tile(self.read_packed_tile(tile_offset), expand_covers=expand_covers)
+
+    def read_fine_sif(self, label_offset):
+        """
+        Returns (fine_sif, fine_sif_mask, fine_soundings) arrays for the labels at "label_offset".
+        "fine_sif_mask" is True for invalid pixels.
+        """
+        assert label_offset >= 0, 'This tile has no fine SIF labels'
+        fine_sif_labels = self._get_arrays()['fine_sif_labels']
+        return fine_sif_labels['sif'][label_offset], fine_sif_labels['invalid'][label_offset], fine_sif_labels['soundings'][label_offset]
+
+    def attach_offsets(self, metadata, metadata_file, tile_file_column='tile_file'):
+        """
+        Adds "tile_offset" and "label_offset" columns to "metadata", which must have been read
+        from "metadata_file" (possibly filtered, but with the original row index preserved).
+        """
+        shard_index = pd.read_csv(shard_index_file(self.shard_dir, metadata_file))
+        rows = metadata.index.values
+        if len(rows) > 0 and rows.max() >= len(shard_index):
+            raise ValueError('Shard index ' + shard_index_file(self.shard_dir, metadata_file) + ' has fewer rows than ' + metadata_file)
+        if not np.array_equal(shard_index[tile_file_column].values[rows], metadata[tile_file_column].values):
+            raise ValueError('Shard index ' + shard_index_file(self.shard_dir, metadata_file) + ' does not match ' +
+                             metadata_file + '; rebuild the shards with data_processing/create_tile_shards.py')
+        metadata['tile_offset'] = shard_index['tile_offset'].values[rows]
+        metadata['label_offset'] = shard_index['label_offset'].values[rows]
+        return metadata
+
+
+# ============================= Reflectance mosaic =============================
+# A reflectance mosaic stores all the 0.1-degree reflectance tiles of one date as a grid of
+# (CHUNK x CHUNK) chunks in *region indices* (pixel indices relative to the top-left corner of
+# the whole region). The chunk grid starts at (origin_row, origin_col), which is chosen to match
+# the CFIS/OCO-2 tile grid, so an aligned tile is exactly one chunk. Only chunks that overlap
+# some reflectance tile are stored; they are packed (like tiles in the shards) into
+# memory-mapped arrays, and "chunk_index.csv" maps each (chunk_row, chunk_col) to its offset.
+MOSAIC_ARRAYS = ['continuous', 'cover_class', 'missing_reflectance']
+MOSAIC_INFO_FILE = 'mosaic_info.json'
+MOSAIC_CHUNK_INDEX_FILE = 'chunk_index.csv'
+
+
+def create_reflectance_mosaic(mosaic_dir, chunks, chunk_size, origin_row, origin_col, top_bound, left_bound, res):
+    """
+    Creates an (empty) mosaic containing the given list of (chunk_row, chunk_col) chunks, and
+    returns a dictionary mapping each array name to a writable memory-map of it. Chunk i of
+    "chunks" is stored at offset i.
+    """
+    if not os.path.exists(mosaic_dir):
+        os.makedirs(mosaic_dir)
+    with open(os.path.join(mosaic_dir, MOSAIC_INFO_FILE), 'w') as info_file:
+        json.dump({'chunk_size': chunk_size, 'origin_row': origin_row, 'origin_col': origin_col,
+                   'top_bound': top_bound, 'left_bound': left_bound, 'res': list(res)}, info_file)
+    chunk_index = pd.DataFrame(chunks, columns=['chunk_row', 'chunk_col'])
+    chunk_index['offset'] = np.arange(len(chunks))
+    chunk_index.to_csv(os.path.join(mosaic_dir, MOSAIC_CHUNK_INDEX_FILE), index=False)
+
+    shapes = {'continuous': ((len(chunks), len(CONTINUOUS_BANDS), chunk_size, chunk_size), np.float32),
+              'cover_class': ((len(chunks), chunk_size, chunk_size), np.uint8),
+              'missing_reflectance': ((len(chunks), (chunk_size * chunk_size + 7) // 8), np.uint8)}
+    arrays = dict()
+    for array_name, (shape, dtype) in shapes.items():
+        arrays[array_name] = np.lib.format.open_memmap(shard_array_file(mosaic_dir, array_name),
+                                                       mode='w+', dtype=dtype, shape=shape)
+    return arrays
+
+
+class ReflectanceMosaic(object):
+    """
+    Read-only access to a reflectance mosaic (see "create_reflectance_mosaic"). Like
+    TileShardStore, the arrays are memory-mapped lazily.
+    """
+    def __init__(self, mosaic_dir):
+        self.mosaic_dir = mosaic_dir
+        with open(os.path.join(mosaic_dir, MOSAIC_INFO_FILE)) as info_file:
+            self.info = json.load(info_file)
+        self.chunk_size = self.info['chunk_size']
+        self.origin_row = self.info['origin_row']
+        self.origin_col = self.info['origin_col']
+        chunk_index = pd.read_csv(os.path.join(mosaic_dir, MOSAIC_CHUNK_INDEX_FILE))
+        self.chunk_offsets = dict(zip(zip(chunk_index['chunk_row'], chunk_index['chunk_col']), chunk_index['offset']))
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = {array_name: np.load(shard_array_file(self.mosaic_dir, array_name), mmap_mode='r')
+                            for array_name in MOSAIC_ARRAYS}
+        return self._arrays
+
+    def read_window(self, top_idx, left_idx, height, width, bands=None):
+        """
+        Returns the (len(bands) x height x width) window whose top-left pixel is at region indices
+        (top_idx, left_idx), reading only the chunks (and bands) that overlap it. Parts of the
+        window that are not covered by any reflectance tile are filled like missing files in
+        sif_utils.extract_input_subtile (zeros, with the missing-reflectance band set to 1).
+        Returns None if no part of the window is covered.
+        """
+        if bands is None:
+            bands = list(range(NUM_INPUT_BANDS))
+        bands = list(bands)
+        window = np.zeros((len(bands), height, width), dtype=np.float32)
+        if MISSING_REFLECTANCE_BAND in bands:
+            window[bands.index(MISSING_REFLECTANCE_BAND)] = 1
+
+        arrays = self._get_arrays()
+        found_chunk = False
+        first_chunk_row = (top_idx - self.origin_row) // self.chunk_size
+        last_chunk_row = (top_idx + height - 1 - self.origin_row) // self.chunk_size
+        first_chunk_col = (left_idx - self.origin_col) // self.chunk_size
+        last_chunk_col = (left_idx + width - 1 - self.origin_col) // self.chunk_size
+        for chunk_row in range(first_chunk_row, last_chunk_row + 1):
+            for chunk_col in range(first_chunk_col, last_chunk_col + 1):
+                if (chunk_row, chunk_col) not in self.chunk_offsets:
+                    continue
+                found_chunk = True
+                offset = self.chunk_offsets[(chunk_row, chunk_col)]
+                chunk = unpack_tile_bands({array_name: arrays[array_name][offset] for array_name in MOSAIC_ARRAYS}, bands)
+
+                # Overlap between the window and this chunk, in region indices
+                chunk_top = self.origin_row + chunk_row * self.chunk_size
+                chunk_left = self.origin_col + chunk_col * self.chunk_size
+                top = max(top_idx, chunk_top)
+                bottom = min(top_idx + height, chunk_top + self.chunk_size)
+                left = max(left_idx, chunk_left)
+                right = min(left_idx + width, chunk_left + self.chunk_size)
+                window[:, top-top_idx:bottom-top_idx, left-left_idx:right-left_idx] = \
+                        chunk[:, top-chunk_top:bottom-chunk_top, left-chunk_left:right-chunk_left]
+
+        if not found_chunk:
+            return None
+        return window
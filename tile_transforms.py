@@ -1,9 +1,12 @@
+import copy
 import numpy as np
 import random
 import torch
 import torch.nn.functional as F
 from skimage.transform import resize
 
+import tile_storage
+
 
 class NormalizeReflectance(object):
     """
@@ -12,8 +15,8 @@ class NormalizeReflectance(object):
     def __init__(self, reflectance_bands=list(range(0, 9))):
         self.reflectance_bands = reflectance_bands
     def __call__(self, tile):
-        normalized_bands = tile[self.reflectance_bands, :, :] / np.linalg.norm(tile[self.reflectance_bands, :, :], axis=0, keepdims=True)
-        tile[self.reflectance_bands, :, :] = np.nan_to_num(normalized_bands, nan=0, posinf=0, neginf=0)
+        normalized_bands = tile[..., self.reflectance_bands, :, :] / np.linalg.norm(tile[..., self.reflectance_bands, :, :], axis=-3, keepdims=True)
+        tile[..., self.reflectance_bands, :, :] = np.nan_to_num(normalized_bands, nan=0, posinf=0, neginf=0)
         return tile
 
 
@@ -29,7 +32,7 @@ class StandardizeTile(object):
         self.band_stds = band_stds[bands_to_transform, np.newaxis, np.newaxis]
 
     def __call__(self, tile):
-        tile[self.bands_to_transform, :, :] = (tile[self.bands_to_transform, :, :] - self.band_means) / self.band_stds
+        tile[..., self.bands_to_transform, :, :] = (tile[..., self.bands_to_transform, :, :] - self.band_means) / self.band_stds
         return tile
 
 
@@ -42,7 +45,7 @@ class TanhTile(object):
         self.tanh_stretch = tanh_stretch
     
     def __call__(self, tile):
-        tile[self.bands_to_transform, :, :] = np.tanh(tile[self.bands_to_transform, :, :] / self.tanh_stretch)
+        tile[..., self.bands_to_transform, :, :] = np.tanh(tile[..., self.bands_to_transform, :, :] / self.tanh_stretch)
         return tile
 
 class ClipTile(object):
@@ -56,7 +59,7 @@ class ClipTile(object):
 
     def __call__(self, tile):
         if self._min_input is not None and self._max_input is not None:
-            tile[self.bands_to_transform, :, :] = np.clip(tile[self.bands_to_transform, :, :], a_min=self._min_input, a_max=self._max_input)
+            tile[..., self.bands_to_transform, :, :] = np.clip(tile[..., self.bands_to_transform, :, :], a_min=self._min_input, a_max=self._max_input)
         return tile
 
 
@@ -67,9 +70,9 @@ class GaussianNoise(object):
 
     def __call__(self, tile):
         #print('Before noise', tile[self.continuous_bands, 0:3, 0:3])
-        continuous_bands_shape = tile[self.bands_to_transform, :, :].shape
+        continuous_bands_shape = tile[..., self.bands_to_transform, :, :].shape
         noise = np.random.normal(loc=0, scale=self.standard_deviation, size=continuous_bands_shape)
-        tile[self.bands_to_transform, :, :] = tile[self.bands_to_transform, :, :] + noise
+        tile[..., self.bands_to_transform, :, :] = tile[..., self.bands_to_transform, :, :] + noise
         #print('After noise', tile[self.bands_to_transform, 0:3, 0:3])
         return tile
 
@@ -86,17 +89,17 @@ class MultiplicativeGaussianNoise(object):
         # Undo standardization
         # print("======================")
         # print("Start - pixel", tile[self.bands_to_transform, 50, 50])
-        continuous_bands = (tile[self.bands_to_transform, :, :] * self.band_stds) + self.band_means
+        continuous_bands = (tile[..., self.bands_to_transform, :, :] * self.band_stds) + self.band_means
         # print("After unstd", continuous_bands[:, 50, 50])
 
-        # Apply noise
-        noise = np.random.normal(loc=0, scale=self.standard_deviation)
+        # Apply noise (one value per tile)
+        noise = np.random.normal(loc=0, scale=self.standard_deviation, size=tile.shape[:-3])
         # print("Noise", noise)
-        continuous_bands = continuous_bands * (1 + noise)
+        continuous_bands = continuous_bands * (1 + noise[..., np.newaxis, np.newaxis, np.newaxis])
         # print("After noise", continuous_bands[:, 50, 50])
 
         # Re-standardize
-        tile[self.bands_to_transform, :, :] = (continuous_bands - self.band_means) / self.band_stds
+        tile[..., self.bands_to_transform, :, :] = (continuous_bands - self.band_means) / self.band_stds
         # print("After std", tile[self.bands_to_transform, 50, 50])
 
         return tile
@@ -110,8 +113,10 @@ class MultiplicativeGaussianNoiseRaw(object):
         self.standard_deviation = standard_deviation
 
     def __call__(self, tile):
-        noise = np.random.normal(loc=0, scale=self.standard_deviation)
-        tile[self.bands_to_transform, :, :] = tile[self.bands_to_transform, :, :] * (1 + noise)
+        # One value per tile
+        noise = np.random.normal(loc=0, scale=self.standard_deviation, size=tile.shape[:-3])
+        scale = (1 + noise[..., np.newaxis, np.newaxis, np.newaxis]).astype(tile.dtype)
+        tile[..., self.bands_to_transform, :, :] = tile[..., self.bands_to_transform, :, :] * scale
         return tile
 
 
@@ -122,9 +127,9 @@ class ColorDistortion(object):
         self.standard_deviation = standard_deviation
 
     def __call__(self, tile):
-        noise = np.random.normal(loc=0, scale=self.standard_deviation, size=(len(self.bands_to_transform)))
-        noise = noise[:, np.newaxis, np.newaxis].astype(np.float32)
-        tile[self.bands_to_transform, :, :] = tile[self.bands_to_transform, :, :] + noise
+        noise = np.random.normal(loc=0, scale=self.standard_deviation, size=tile.shape[:-3] + (len(self.bands_to_transform),))
+        noise = noise[..., np.newaxis, np.newaxis].astype(np.float32)
+        tile[..., self.bands_to_transform, :, :] = tile[..., self.bands_to_transform, :, :] + noise
         return tile
 
 
@@ -398,6 +403,141 @@ class ShrinkTile(object):
         #print('Random pixel', resized_tile[:, 3, 8])
         return resized_tile
 
+
+# Transforms whose output only depends on their input (so their results can be cached)
+DETERMINISTIC_TRANSFORMS = (NormalizeReflectance, StandardizeTile, TanhTile, ClipTile, ComputeVegetationIndices, ResizeTile, ShrinkTile)
+
+
+# Transforms that can also be applied to a whole batch of tiles (batch x bands x H x W) in one call
+# (random ones draw separate values for each tile of the batch). Other transforms only take a
+# single tile (see "transform_batch").
+BATCH_TRANSFORMS = (NormalizeReflectance, StandardizeTile, TanhTile, ClipTile, GaussianNoise, MultiplicativeGaussianNoise,
+                    MultiplicativeGaussianNoiseRaw, ColorDistortion)
+
+
+def transform_batch(transform, tiles):
+    """
+    Applies "transform" (which may be None, a single transform, or a Compose) to each tile of
+    "tiles", an array of shape (batch x bands x H x W), and returns the transformed batch ("tiles"
+    may be modified in place). Transforms in BATCH_TRANSFORMS are applied to the whole batch at
+    once; other transforms are applied to one tile at a time. Random transforms draw their values
+    in a different order than when each tile is transformed on its own, so the batch is
+    distributed the same way, but is not identical.
+    """
+    if transform is None:
+        return tiles
+    if hasattr(transform, 'transforms'):
+        for t in transform.transforms:
+            tiles = transform_batch(t, tiles)
+        return tiles
+    if isinstance(transform, BATCH_TRANSFORMS):
+        return transform(tiles)
+    return np.stack([transform(tile) for tile in tiles])
+
+
+def is_deterministic(transform):
+    """
+    Returns whether "transform" (which may be None, a single transform, or a Compose) is deterministic
+    """
+    if transform is None:
+        return True
+    if hasattr(transform, 'transforms'):
+        return all(is_deterministic(t) for t in transform.transforms)
+    return isinstance(transform, DETERMINISTIC_TRANSFORMS)
+
+
+def describe_transform(transform):
+    """
+    Returns a string describing "transform" (which may be None, a single transform, or a Compose)
+    and all of its parameters. Two transforms with the same description produce the same output.
+    """
+    if transform is None:
+        return 'None'
+    if hasattr(transform, 'transforms'):
+        return '[' + ', '.join(describe_transform(t) for t in transform.transforms) + ']'
+    params = []
+    for name, value in sorted(vars(transform).items()):
+        if isinstance(value, (np.ndarray, torch.Tensor)):
+            value = value.tolist()
+        elif isinstance(value, range):
+            value = list(value)
+        params.append(name + '=' + repr(value))
+    return type(transform).__name__ + '(' + ', '.join(params) + ')'
+
+
+# Band index attributes of each transform that can be applied to a subset of the bands (see
+# "project_transform"), as (independent attribute, per-band attributes, coupled attributes):
+#   - each band in the "independent" attribute is transformed on its own, so bands that are not
+#     kept can be dropped, along with their entries in the "per-band" arrays (which are aligned
+#     with the independent attribute)
+#   - all bands in a "coupled" attribute (a list, or a single index) must be kept
+# Transforms that treat every band the same way have no band attributes.
+BAND_ATTRIBUTES = {
+    NormalizeReflectance: (None, [], ['reflectance_bands']),
+    StandardizeTile: ('bands_to_transform', ['band_means', 'band_stds'], []),
+    TanhTile: ('bands_to_transform', [], []),
+    ClipTile: ('bands_to_transform', [], []),
+    GaussianNoise: ('bands_to_transform', [], []),
+    MultiplicativeGaussianNoise: ('bands_to_transform', ['band_means', 'band_stds'], []),
+    MultiplicativeGaussianNoiseRaw: ('bands_to_transform', [], []),
+    ColorDistortion: ('bands_to_transform', [], []),
+    RandomJigsaw: (None, [], []),
+    RandomFlipAndRotate: (None, [], []),
+    ResizeTile: ('discrete_bands', [], []),
+    RandomCrop: (None, [], []),
+    Cutout: ('reflectance_indices', [], ['missing_reflectance_idx']),
+    ToFloatTensor: (None, [], []),
+}
+
+
+def project_transform(transform, bands, num_extra_bands=0):
+    """
+    Returns a copy of "transform" (which may be None, a single transform, or a Compose) that can be
+    applied to a tile containing only "bands" of the dense 43-band tile (in that order), followed by
+    "num_extra_bands" other channels (e.g. fine SIF labels). On such a tile, the copy has the same
+    effect as "transform" has on the corresponding channels of the full tile. (Transforms that draw
+    a random value per band, like GaussianNoise, only draw values for the kept bands.)
+    Raises ValueError if this is impossible (e.g. for transforms that add or combine bands).
+    """
+    if transform is None:
+        return None
+    if hasattr(transform, 'transforms'):
+        projected = copy.copy(transform)
+        projected.transforms = [project_transform(t, bands, num_extra_bands) for t in transform.transforms]
+        return projected
+    if type(transform) not in BAND_ATTRIBUTES:
+        raise ValueError(type(transform).__name__ + ' cannot be applied to a subset of bands')
+
+    # Position of each channel of the full tile (with extra channels) in the projected tile
+    full_num_bands = tile_storage.NUM_INPUT_BANDS + num_extra_bands
+    positions = {band: i for i, band in enumerate(bands)}
+    for i in range(num_extra_bands):
+        positions[tile_storage.NUM_INPUT_BANDS + i] = len(bands) + i
+
+    def full_index(band):
+        if band < -full_num_bands or band >= full_num_bands:
+            raise ValueError('Invalid band ' + str(band) + ' in ' + type(transform).__name__)
+        return band + full_num_bands if band < 0 else band
+
+    independent_attribute, per_band_attributes, coupled_attributes = BAND_ATTRIBUTES[type(transform)]
+    projected = copy.copy(transform)
+    if independent_attribute is not None:
+        kept = [i for i, band in enumerate(getattr(transform, independent_attribute)) if full_index(band) in positions]
+        setattr(projected, independent_attribute,
+                [positions[full_index(getattr(transform, independent_attribute)[i])] for i in kept])
+        for attribute in per_band_attributes:
+            setattr(projected, attribute, getattr(transform, attribute)[kept])
+    for attribute in coupled_attributes:
+        value = getattr(transform, attribute)
+        coupled_bands = [value] if np.isscalar(value) else list(value)
+        missing_bands = [band for band in coupled_bands if full_index(band) not in positions]
+        if len(missing_bands) > 0:
+            raise ValueError(type(transform).__name__ + ' needs bands ' + str(missing_bands) + ', which are not selected')
+        projected_bands = [positions[full_index(band)] for band in coupled_bands]
+        setattr(projected, attribute, projected_bands[0] if np.isscalar(value) else projected_bands)
+    return projected
+
+
 if __name__ == '__main__':
     example_tensor = [[[0.4, 0.5, 1.8], [0.9, 1.0, 3.5]], [[100., 200., 1000.], [150., 250., 5000.]], [[0, 0, 0], [1, 1, 0]]]
     example_tensor = np.array(example_tensor)
@@ -22,10 +22,13 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch import autograd
 from torch.autograd import grad
-from datasets import CombinedDataset, CoarseSIFDataset, FineSIFDataset
+from datasets import CoarseSIFDataset, FineSIFDataset, CachedTileDataset, MultiSourceDataLoader
 from unet.unet_model import UNetContrastive, UNet2Contrastive, UNet, UNet2, PixelNN, UNet2Spectral
 import visualization_utils
 import sif_utils
+import metadata_store
+import tile_manifest
+import tile_storage
 import tile_transforms
 import tqdm
 import mtadam
@@ -49,7 +52,8 @@ FINE_SIF_DATASETS = {'train': ['CFIS_2016'],
                      'val': ['CFIS_2016']}
 MODEL_SELECTION_DATASET = 'CFIS_2016'
 
-# Ratios - how often a batch from each dataset should be sampled during training
+# Ratios - how often a batch from each dataset should be sampled during training (see MultiSourceDataLoader).
+# Datasets with ratio 0 are still read once per epoch and scored, but the coarse loss is not backpropagated.
 UPDATE_FRACTIONS = {'CFIS_2016': 1,
                     'OCO2_2016': 1,
                     'OCO2_2018': 0,
@@ -86,6 +90,7 @@ parser.add_argument('-wd', "--weight_decay", default=1e-4, type=float, help='wei
 parser.add_argument('-epoch', "--max_epoch", default=100, type=int, help='max epoch to train')
 parser.add_argument('-patience', "--patience", default=5, type=int, help="Early stopping patience (stop if val loss doesn't improve for this many epochs)")
 parser.add_argument('-bs', "--batch_size", default=128, type=int, help="Batch size")
+parser.add_argument('-epoch_batches', "--epoch_batches", default=None, type=int, help="Number of training batches per epoch, split between datasets according to UPDATE_FRACTIONS. By default, the largest number for which no dataset is read more than once per epoch.")
 parser.add_argument('-num_workers', "--num_workers", default=4, type=int, help="Number of dataloader workers")
 parser.add_argument('-from_pretrained', "--from_pretrained", default=False, action='store_true', help='Whether to initialize from pre-trained model')
 parser.add_argument('-visualize', "--visualize", default=False, action='store_true', help='Plot visualizations')
@@ -143,6 +148,14 @@ parser.add_argument('-resize_dim', "--resize_dim", default=100, type=int, help="
 parser.add_argument('-random_crop', "--random_crop", action='store_true')
 parser.add_argument('-crop_dim', "--crop_dim", default=80, type=int, help="If the 'random_crop' augmentation is used, the dimension to crop.")
 parser.add_argument('-label_noise', "--label_noise", default=0, type=float, help="Add random noise with this standard deviation to the label")
+
+# Data loading
+parser.add_argument('-tile_shard_dir', "--tile_shard_dir", default=None, type=str, help="If set, read tiles from the shards in this directory (created by data_processing/create_tile_shards.py) instead of individual tile files")
+parser.add_argument('-tile_cache_dir', "--tile_cache_dir", default=None, type=str, help="If set, cache the transformed validation tiles in this directory (see CachedTileDataset), so that they are only read and preprocessed once")
+parser.add_argument('-shared_tile_cache_mb', "--shared_tile_cache_mb", default=0, type=float, help="If set, read up to this many MB of train (and uncached validation) tiles into shared memory before training (see SharedTileCache), so that dataloader workers don't re-read them from disk every epoch")
+parser.add_argument('-validate_files', "--validate_files", action='store_true', help="Before training, check all tile/label files against the manifests written by the dataset builders (see tile_manifest.py)")
+parser.add_argument('-skip_checksums', "--skip_checksums", action='store_true', help="If validating files, only check that they exist and have the right size/shape (much faster than verifying checksums)")
+parser.add_argument('-validation_workers', "--validation_workers", default=1, type=int, help="Number of threads to use when validating files")
 args = parser.parse_args()
 
 # Set random seeds
@@ -650,8 +663,8 @@ def train_model(args, model, dataloaders, criterion, optimizer, device, sif_mean
                 # Loop through all datasets in this sample
                 for dataset_name, sample in combined_sample.items():
                     # Read input tile
-                    input_tiles_std = sample['input_tile'][:, BANDS, :, :].to(device)  # [batch, # channels, height, width]
-                    input_tiles_without_mult_noise = sample['input_tile_without_mult_noise'][:, BANDS, :, :].to(device)
+                    input_tiles_std = sample['input_tile'].to(device)  # [batch, # channels (BANDS), height, width]
+                    input_tiles_without_mult_noise = sample['input_tile_without_mult_noise'].to(device)
 
                     # Read coarse-resolution SIF label
                     true_coarse_sifs = sample['coarse_sif'].to(device)
@@ -749,7 +762,7 @@ def train_model(args, model, dataloaders, criterion, optimizer, device, sif_mean
                             loss = coarse_loss
 
                         # Backpropagate coarse loss
-                        if phase == 'train' and random.random() < UPDATE_FRACTIONS[dataset_name] and dataset_name in COARSE_SIF_DATASETS[phase] and not args.fine_supervision: # and not np.isnan(fine_loss.item()):
+                        if phase == 'train' and UPDATE_FRACTIONS.get(dataset_name, 0) > 0 and dataset_name in COARSE_SIF_DATASETS[phase] and not args.fine_supervision: # and not np.isnan(fine_loss.item()):
                             optimizer.zero_grad()
                             if args.optimizer == "MTAdam":
                                 print("MTadam")
@@ -1097,9 +1110,19 @@ val_transform = transforms.Compose(transform_list_val)
 # Read dataset metadata files
 train_datasets = dict()
 val_datasets = dict()
+files_to_validate = []  # (manifest file, files to check) pairs
+validate_shards = False
+if args.tile_shard_dir is not None:
+    tile_store = tile_storage.TileShardStore(args.tile_shard_dir)
 
 for dataset_name, dataset_file in DATASET_FILES.items():
-    metadata = pd.read_csv(dataset_file)
+    metadata = metadata_store.read_metadata(dataset_file)
+
+    # If this dataset was packed into the tile shards, look up where each tile is stored
+    dataset_tile_store = None
+    if args.tile_shard_dir is not None and os.path.exists(tile_storage.shard_index_file(args.tile_shard_dir, dataset_file)):
+        metadata = tile_store.attach_offsets(metadata, dataset_file)
+        dataset_tile_store = tile_store
 
     # Filter tiles
     if 'CFIS' in dataset_name:
@@ -1139,15 +1162,50 @@ for dataset_name, dataset_file in DATASET_FILES.items():
     # Create Dataset objects
     if dataset_name in COARSE_SIF_DATASETS['train'] or dataset_name in FINE_SIF_DATASETS['train']:
         if 'CFIS' in dataset_name:
-            train_datasets[dataset_name] = FineSIFDataset(train_set, train_transform, multiplicative_noise_end_transform)
+            train_datasets[dataset_name] = FineSIFDataset(train_set, train_transform, multiplicative_noise_end_transform, tile_store=dataset_tile_store,
+                                                          bands=BANDS)
         else:
-            train_datasets[dataset_name] = CoarseSIFDataset(train_set, train_transform, multiplicative_noise_end_transform)
+            train_datasets[dataset_name] = CoarseSIFDataset(train_set, train_transform, multiplicative_noise_end_transform, tile_store=dataset_tile_store,
+                                                            bands=BANDS)
     if dataset_name in COARSE_SIF_DATASETS['val'] or dataset_name in FINE_SIF_DATASETS['val']:
         if 'CFIS' in dataset_name:
-            val_datasets[dataset_name] = FineSIFDataset(val_set, val_transform, None)
+            val_datasets[dataset_name] = FineSIFDataset(val_set, val_transform, None, tile_store=dataset_tile_store, bands=BANDS)
         else:
-            val_datasets[dataset_name] = CoarseSIFDataset(val_set, val_transform, None)
+            val_datasets[dataset_name] = CoarseSIFDataset(val_set, val_transform, None, tile_store=dataset_tile_store, bands=BANDS)
 
+    # Record which files this dataset reads (tiles read from the shards are checked against the shard manifest)
+    used_sets = [split_set for split_set, split_datasets in [(train_set, train_datasets), (val_set, val_datasets)] if dataset_name in split_datasets]
+    if len(used_sets) > 0:
+        if dataset_tile_store is not None:
+            validate_shards = True
+        else:
+            used_rows = pd.concat(used_sets)
+            file_columns = [column for column in ['tile_file', 'fine_sif_file', 'fine_soundings_file'] if column in used_rows.columns]
+            files_to_validate.append((tile_manifest.manifest_file(dataset_file),
+                                      np.concatenate([used_rows[column].dropna().values for column in file_columns])))
+
+# Check dataset files before starting a long training run (or caching validation tiles)
+if args.validate_files:
+    if validate_shards:
+        files_to_validate.append((tile_manifest.shard_manifest_file(args.tile_shard_dir), None))
+    tile_manifest.validate_or_exit(files_to_validate, num_workers=args.validation_workers, verify_checksums=not args.skip_checksums)
+
+if args.tile_cache_dir is not None:
+    for dataset_name in val_datasets:
+        val_datasets[dataset_name] = CachedTileDataset(val_datasets[dataset_name], args.tile_cache_dir, BAND_STATISTICS_FILE,
+                                                       num_workers=args.num_workers)
+
+# Read tiles into shared memory (train datasets first), up to the memory budget. Tiles that don't
+# fit are read from disk as before.
+if args.shared_tile_cache_mb > 0:
+    remaining_bytes = int(args.shared_tile_cache_mb * 1024 * 1024)
+    print('Shared tile cache budget:', args.shared_tile_cache_mb, 'MB')
+    for dataset_name, dataset in list(train_datasets.items()) + list(val_datasets.items()):
+        if not hasattr(dataset, 'cache_tiles'):  # e.g. CachedTileDataset
+            continue
+        remaining_bytes -= dataset.cache_tiles(remaining_bytes, num_threads=max(args.num_workers, 1))
+        print(dataset_name + ':', end=' ')
+        dataset.tile_cache.print_stats()
 
 # Print params for reference
 print("=========================== PARAMS ===========================")
@@ -1227,12 +1285,12 @@ print(PARAM_STRING)
 g = torch.Generator()
 g.manual_seed(args.seed)
 
-# Set up datasets and dataloaders
-datasets = {'train': CombinedDataset(train_datasets),
-            'val': CombinedDataset(val_datasets)}
-dataloaders = {x: torch.utils.data.DataLoader(datasets[x], batch_size=args.batch_size,
-                                              shuffle=True, num_workers=args.num_workers)
-               for x in ['train', 'val']}
+# Set up dataloaders. Each batch comes from one dataset; training batches are drawn from the
+# datasets in the ratios given by UPDATE_FRACTIONS, and validation goes through each dataset once.
+dataloaders = {'train': MultiSourceDataLoader(train_datasets, args.batch_size, ratios=UPDATE_FRACTIONS, num_batches=args.epoch_batches,
+                                              num_workers=args.num_workers, generator=g),
+               'val': MultiSourceDataLoader(val_datasets, args.batch_size, num_workers=args.num_workers, generator=g)}
+print('Batches per epoch:', {x: dataloaders[x].num_batches for x in dataloaders})
 
 # Initialize model
 if args.batch_norm:
@@ -21,6 +21,7 @@ from sklearn.preprocessing import MinMaxScaler, StandardScaler, normalize
 from sklearn.tree import DecisionTreeRegressor
 from sklearn.neighbors import KNeighborsRegressor
 from sif_utils import plot_histogram, print_stats
+import metadata_store
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-method', "--method", choices=["Ridge_Regression", "Gradient_Boosting_Regressor", "MLP", "Random_Forest", "Nearest_Neighbors"], type=str, help='Method type. MLP is the fully-connected artificial neural netwoprk.')
@@ -165,6 +166,14 @@ COVER_COLUMNS_TO_PLOT = ['grassland_pasture', 'corn', 'soybean', 'deciduous_fore
 
 
 
+# Read metadata files once (the loops below only filter them further). Fine metadata is read
+# lazily per resolution. Only rows from the dates we use are loaded.
+ALL_DATES = sorted(set(TRAIN_DATES + TEST_DATES))
+oco2_metadata_all = metadata_store.read_metadata(OCO2_METADATA_FILE, dates=ALL_DATES, min_num_soundings=MIN_OCO2_SOUNDINGS)
+cfis_coarse_metadata_all = metadata_store.read_metadata(CFIS_COARSE_METADATA_FILE, dates=ALL_DATES,
+                                                        min_fraction_valid=min(MIN_COARSE_FRACTION_VALID_PIXELS))
+cfis_fine_metadata_all = dict()
+
 for min_coarse_fraction_valid in MIN_COARSE_FRACTION_VALID_PIXELS:
     # Different ways of filtering fine pixels
     for min_fine_cfis_soundings in MIN_FINE_CFIS_SOUNDINGS:
@@ -173,25 +182,23 @@ for min_coarse_fraction_valid in MIN_COARSE_FRACTION_VALID_PIXELS:
 
             for resolution in RESOLUTION_METERS:
                 # Filter OCO2 tiles
-                oco2_metadata = pd.read_csv(OCO2_METADATA_FILE)
-                oco2_metadata = oco2_metadata[(oco2_metadata['num_soundings'] >= MIN_OCO2_SOUNDINGS) &
-                                            (oco2_metadata['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
-                                            (oco2_metadata['SIF'] >= MIN_SIF_CLIP)]
+                oco2_metadata = oco2_metadata_all[(oco2_metadata_all['missing_reflectance'] <= MAX_OCO2_CLOUD_COVER) &
+                                                  (oco2_metadata_all['SIF'] >= MIN_SIF_CLIP)]
                 oco2_metadata = oco2_metadata[oco2_metadata[ALL_COVER_COLUMNS].sum(axis=1) >= 0.5]
 
                 # Read CFIS coarse datapoints - only include CFIS tiles with enough valid pixels
-                cfis_coarse_metadata = pd.read_csv(CFIS_COARSE_METADATA_FILE)
-                cfis_coarse_metadata = cfis_coarse_metadata[(cfis_coarse_metadata['fraction_valid'] >= min_coarse_fraction_valid) &
-                                                            (cfis_coarse_metadata['SIF'] >= MIN_SIF_CLIP) &
-                                                            (cfis_coarse_metadata['missing_reflectance'] <= MAX_CFIS_CLOUD_COVER)]
+                cfis_coarse_metadata = cfis_coarse_metadata_all[(cfis_coarse_metadata_all['fraction_valid'] >= min_coarse_fraction_valid) &
+                                                                (cfis_coarse_metadata_all['SIF'] >= MIN_SIF_CLIP) &
+                                                                (cfis_coarse_metadata_all['missing_reflectance'] <= MAX_CFIS_CLOUD_COVER)]
                 cfis_coarse_metadata = cfis_coarse_metadata[cfis_coarse_metadata[ALL_COVER_COLUMNS].sum(axis=1) >= 0.5]
 
                 # Read fine metadata at particular resolution
-                CFIS_FINE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_metadata_' + str(resolution) + 'm.csv')
-                cfis_fine_metadata = pd.read_csv(CFIS_FINE_METADATA_FILE)
+                if resolution not in cfis_fine_metadata_all:
+                    CFIS_FINE_METADATA_FILE = os.path.join(METADATA_DIR, 'cfis_metadata_' + str(resolution) + 'm.csv')
+                    cfis_fine_metadata_all[resolution] = metadata_store.read_metadata(CFIS_FINE_METADATA_FILE, dates=ALL_DATES, min_fraction_valid=0.5)
+                cfis_fine_metadata = cfis_fine_metadata_all[resolution]
                 cfis_fine_metadata = cfis_fine_metadata[(cfis_fine_metadata['SIF'] >= MIN_SIF_CLIP) &
-                                                        (cfis_fine_metadata['tile_file'].isin(set(cfis_coarse_metadata['tile_file']))) &
-                                                        (cfis_fine_metadata['fraction_valid'] >= 0.5)]
+                                                        (cfis_fine_metadata['tile_file'].isin(set(cfis_coarse_metadata['tile_file'])))]
 
                 # Compute NDVI
                 oco2_metadata["NDVI"] = (oco2_metadata["ref_5"] - oco2_metadata["ref_4"]) / (oco2_metadata["ref_5"] + oco2_metadata["ref_4"])
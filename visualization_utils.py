@@ -4,6 +4,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 import os
 import sif_utils
+import tile_storage
 import tile_transforms
 import torchvision.transforms as transforms
 
@@ -75,7 +76,7 @@ def plot_figures(output_file, figures, nrows = 1, ncols=1, cmap=None):
 def plot_rgb_images(image_rows, image_filename_column, output_file, RGB_BANDS=[3, 2, 1]):
     images = {}
     for idx, image_row in image_rows.iterrows():
-        subtile = np.load(image_row[image_filename_column]).transpose((1, 2, 0))
+        subtile = tile_storage.load_tile(image_row[image_filename_column]).transpose((1, 2, 0))
         title = 'Lat' + str(round(image_row['lat'], 6)) + ', Lon' + str(round(image_row['lon'], 6)) + ' (SIF = ' + str(round(image_row['SIF'], 3)) + ')'
         #print('BLUE: max', np.max(subtile[:, :, 1]), 'min', np.min(subtile[:, :, 1]))
         #print('GREEN: max', np.max(subtile[:, :, 2]), 'min', np.min(subtile[:, :, 2]))
@@ -93,7 +94,7 @@ def plot_band_images(image_rows, image_filename_column, output_file_prefix):
         band_images[band] = {}
 
     for idx, image_row in image_rows.iterrows():
-        subtile = np.load(image_row[image_filename_column]).transpose((1, 2, 0))
+        subtile = tile_storage.load_tile(image_row[image_filename_column]).transpose((1, 2, 0))
         title = 'Lat' + str(round(image_row['lat'], 6)) + ', Lon' + str(round(image_row['lon'], 6)) + ' (SIF = ' + str(round(image_row['SIF'], 3)) + ')'
         for band, max_value in band_to_max.items():
             band_images[band][title] = subtile[:, :, band] / max_value
@@ -107,7 +108,7 @@ def plot_cdl_layers_multiple(image_rows, image_filename_column, output_file, cdl
     # Load all tiles and store the CDL bands
     images = {}
     for idx, image_row in image_rows.iterrows():
-        cdl_layers = np.load(image_row[image_filename_column])[cdl_bands, :, :]
+        cdl_layers = tile_storage.load_tile(image_row[image_filename_column])[cdl_bands, :, :]
         title = 'Lat' + str(round(image_row['lat'], 6)) + ', Lon' + str(round(image_row['lon'], 6)) + ' (SIF = ' + str(round(image_row['SIF'], 3)) + ')'
         images[title] = cdl_layers
 